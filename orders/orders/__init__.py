@@ -0,0 +1,5 @@
+# Приложение Celery загружается вместе с Django, чтобы задачи
+# отправлялись с настройками CELERY_* (брокер, очереди, маршруты)
+from .celery import app as celery_app
+
+__all__ = ('celery_app',)
@@ -10,6 +10,18 @@ app = Celery('orders')
 app.autodiscover_tasks()
 app.config_from_object('django.conf:settings', namespace='CELERY')
 
+
+def worker_argv(queue):
+    """
+    Аргументы запуска воркера для очереди queue (см. CELERY_QUEUE_WORKERS).
+    """
+    from django.conf import settings
+
+    options = settings.CELERY_QUEUE_WORKERS[queue]
+    return ['worker', '--queues', queue, '--hostname', f'{queue}@%h',
+            '--concurrency', str(options['concurrency']),
+            '--prefetch-multiplier', str(options['prefetch_multiplier'])]
+
 @app.task(bind=True)
 def debug_task(self):
     print(f'Request: {self.request!r}')
\ No newline at end of file
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 import os
+import sys
 from pathlib import Path
 
 from dotenv import load_dotenv
@@ -29,6 +30,9 @@ SECRET_KEY = 'django-insecure-q6)vilutpe&m(qu&##!jwef)17!69l*ff110cgv3thfx!c8p9$
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
 
+# Запуск тестов (manage.py test)
+TESTING = sys.argv[1:2] == ['test']
+
 ALLOWED_HOSTS = ['*']
 
 
@@ -165,6 +169,109 @@ CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_IMPORTS = ("shop_app.tasks",)
 
+# Очереди задач: каждую обслуживает свой воркер (python manage.py celery_worker <очередь>),
+# поэтому долгий импорт не задерживает письма. Результаты хранятся только у задач,
+# результат которых читается (ignore_result=False), и не дольше CELERY_RESULT_EXPIRES.
+CELERY_TASK_DEFAULT_QUEUE = 'default'
+CELERY_TASK_IGNORE_RESULT = True
+CELERY_RESULT_EXPIRES = 60 * 60
+CELERY_TASK_ROUTES = {
+    'shop_app.tasks.send_email': {'queue': 'email', 'priority': 0},
+    'shop_app.tasks.deliver_mail': {'queue': 'email', 'priority': 2},
+    'shop_app.tasks.notify_state_change': {'queue': 'email', 'priority': 5},
+    'shop_app.tasks.send_order_digests': {'queue': 'email', 'priority': 7},
+    'shop_app.tasks.run_import_job': {'queue': 'import'},
+    'shop_app.tasks.import_feed': {'queue': 'import'},
+    'shop_app.tasks.flush_carts': {'queue': 'maintenance'},
+    'shop_app.tasks.purge_idempotency_keys': {'queue': 'maintenance', 'priority': 9},
+}
+# Приоритеты в Redis: 0 - наивысший, задачи без приоритета получают CELERY_TASK_DEFAULT_PRIORITY
+CELERY_TASK_DEFAULT_PRIORITY = 5
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'queue_order_strategy': 'priority',
+    'priority_steps': list(range(10)),
+}
+# Параметры воркеров по очередям: письма - короткие задачи с большой предвыборкой,
+# импорт - долгие, воркер берет их по одной
+CELERY_QUEUE_WORKERS = {
+    'email': {'concurrency': 4, 'prefetch_multiplier': 8},
+    'import': {'concurrency': 2, 'prefetch_multiplier': 1},
+    'maintenance': {'concurrency': 1, 'prefetch_multiplier': 1},
+    'default': {'concurrency': 2, 'prefetch_multiplier': 4},
+}
+
+# Кэш общий для веб-процессов и воркеров Celery (ход импорта и т.п.).
+# Без REDIS_CACHE_URL используется локальная память процесса.
+if os.getenv('REDIS_CACHE_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_CACHE_URL'),
+        }
+    }
+
+# Корзины покупателей: Redis (по умолчанию тот же, что и для кэша),
+# перенос измененных корзин в БД раз в CART_FLUSH_INTERVAL секунд
+CART_REDIS_URL = os.getenv('CART_REDIS_URL', os.getenv('REDIS_CACHE_URL'))
+CART_TTL = 30 * 24 * 60 * 60
+CART_FLUSH_INTERVAL = 60
+
+# Сводки изменений статусов заказов отправляются раз в NOTIFICATION_DIGEST_INTERVAL секунд
+NOTIFICATION_DIGEST_INTERVAL = 60
+NOTIFICATION_DIGEST_BATCH_SIZE = 1000
+
+CELERY_BEAT_SCHEDULE = {
+    'flush-carts': {
+        'task': 'shop_app.tasks.flush_carts',
+        'schedule': CART_FLUSH_INTERVAL,
+    },
+    'deliver-mail': {
+        'task': 'shop_app.tasks.deliver_mail',
+        'schedule': 60,
+    },
+    'send-order-digests': {
+        'task': 'shop_app.tasks.send_order_digests',
+        'schedule': NOTIFICATION_DIGEST_INTERVAL,
+    },
+    'purge-idempotency-keys': {
+        'task': 'shop_app.tasks.purge_idempotency_keys',
+        'schedule': 60 * 60,
+    },
+}
+
+# Письма: очередь в Redis (по умолчанию тот же, что и для кэша) отправляется
+# пачками по MAIL_BATCH_SIZE через MAIL_DELIVER_DELAY секунд после первого письма;
+# при обрыве соединения неподтвержденные письма отправляются повторно до MAIL_RETRIES раз
+MAIL_REDIS_URL = os.getenv('MAIL_REDIS_URL', os.getenv('REDIS_CACHE_URL'))
+MAIL_BATCH_SIZE = 100
+MAIL_RETRIES = 2
+MAIL_DELIVER_DELAY = 1
+
+# Пользователи по токенам кэшируются в общем кэше на AUTH_TOKEN_CACHE_TTL секунд
+# и в памяти процесса (не больше AUTH_TOKEN_LOCAL_SIZE) на AUTH_TOKEN_LOCAL_TTL секунд
+AUTH_TOKEN_CACHE_TTL = 5 * 60
+AUTH_TOKEN_LOCAL_TTL = 10
+AUTH_TOKEN_LOCAL_SIZE = 10000
+
+# Ответы на запросы с заголовком Idempotency-Key хранятся IDEMPOTENCY_KEY_TTL секунд
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+# Запрос без ответа дольше IDEMPOTENCY_KEY_LOCK_TIMEOUT секунд считается прерванным, и повтор
+# выполняет его заново. Должно быть больше наибольшего времени выполнения запроса
+IDEMPOTENCY_KEY_LOCK_TIMEOUT = 60
+
+# Смена статусов заказов: наибольшее число заказов в одной операции
+ORDER_TRANSITION_MAX_ORDERS = 10000
+
+# Полнотекстовый поиск товаров
+SEARCH_TS_CONFIG = os.getenv('SEARCH_TS_CONFIG', 'russian')
+SEARCH_RESULTS_LIMIT = 100
+
+# Импорт прайс-листов: размер пачки для пакетных запросов
+IMPORT_BATCH_SIZE = 1000
+
+# Экспорт каталога: число позиций, читаемых из БД за один запрос
+EXPORT_CHUNK_SIZE = 2000
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/4.2/howto/static-files/
 
@@ -199,7 +306,7 @@ REST_FRAMEWORK = {
     ),
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
     'DEFAULT_AUTHENTICATION_CLASSES':
-        ['rest_framework.authentication.TokenAuthentication'],
+        ['shop_app.authentication.CachedTokenAuthentication'],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
@@ -217,6 +324,10 @@ REST_FRAMEWORK = {
     }
 }
 
+if TESTING:
+    # Тесты отправляют много запросов от одних и тех же пользователей
+    REST_FRAMEWORK['DEFAULT_THROTTLE_CLASSES'] = []
+
 BATON = {
     'SITE_HEADER': 'API Shop',
     'SITE_TITLE': 'API Shop',
@@ -0,0 +1,14 @@
+from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+class ShopAppConfig(AppConfig):
+    name = 'shop_app'
+
+    def ready(self):
+        """
+        Импортируем сигналы и создаем поисковый индекс после миграций
+        """
+        from . import signals
+
+        post_migrate.connect(signals.create_search_index, sender=self)
@@ -0,0 +1,129 @@
+"""
+Аутентификация по токену с кэшированием пользователя.
+
+Пользователь по токену ищется сначала в LRU-кэше процесса, затем в общем
+кэше (Redis, без REDIS_CACHE_URL - память процесса) и только потом в БД.
+При выходе, смене токена и любом сохранении пользователя (пароль,
+is_active) записи удаляются из общего кэша и кэша текущего процесса
+(см. signals); в других процессах запись живет не дольше
+AUTH_TOKEN_LOCAL_TTL секунд. В кэше хранятся значения полей пользователя
+без хэша пароля; пароль загружается из БД только при обращении к нему.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from .models import User
+
+CACHED_FIELDS = [field.attname for field in User._meta.concrete_fields if field.attname != 'password']
+
+
+class LocalCache:
+    """
+    LRU-кэш с временем жизни записей в памяти процесса.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+local_cache = LocalCache(settings.AUTH_TOKEN_LOCAL_SIZE, settings.AUTH_TOKEN_LOCAL_TTL)
+
+
+def cache_key(token_key):
+    # Сам токен в кэш не попадает
+    return 'auth-token:' + hashlib.sha256(token_key.encode('utf-8')).hexdigest()
+
+
+def get_cached_user(token_key):
+    """
+    Пользователь из кэша или None. Поле password отложено.
+    """
+    key = cache_key(token_key)
+    values = local_cache.get(key)
+    if values is None:
+        values = cache.get(key)
+        if values is None:
+            return None
+        local_cache.set(key, values)
+    # Каждый запрос получает свой объект: изменения пользователя в запросе не попадают в кэш
+    return User.from_db(DEFAULT_DB_ALIAS, CACHED_FIELDS, [values[name] for name in CACHED_FIELDS])
+
+
+def cache_user(token_key, user):
+    key = cache_key(token_key)
+    values = {name: getattr(user, name) for name in CACHED_FIELDS}
+    cache.set(key, values, timeout=settings.AUTH_TOKEN_CACHE_TTL)
+    local_cache.set(key, values)
+
+
+def invalidate_tokens(token_keys):
+    """
+    Удаляет токены из кэша сразу и еще раз после фиксации транзакции,
+    чтобы параллельный запрос не вернул в кэш старые данные.
+    """
+    keys = [cache_key(token_key) for token_key in token_keys]
+    if not keys:
+        return
+
+    def invalidate():
+        cache.delete_many(keys)
+        for key in keys:
+            local_cache.delete(key)
+
+    invalidate()
+    transaction.on_commit(invalidate)
+
+
+def invalidate_user(user_id):
+    invalidate_tokens(Token.objects.filter(user_id=user_id).values_list('key', flat=True))
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication без запроса к БД для токенов из кэша.
+    """
+
+    def authenticate_credentials(self, key):
+        user = get_cached_user(key)
+        if user is None:
+            user, token = super().authenticate_credentials(key)
+            cache_user(key, user)
+            return user, token
+        return user, Token(key=key, user_id=user.id)
@@ -0,0 +1,199 @@
+"""
+Хранилище корзин покупателей.
+
+Строки корзины (id позиции магазина -> количество) хранятся в хэше Redis
+cart:<id пользователя>, поэтому изменение корзины - один запрос к Redis
+вместо нескольких SQL-запросов. В БД (заказ в статусе basket и его
+OrderItem) корзина переносится отложенно: при оформлении заказа или
+периодической задачей flush_carts для корзин, измененных с прошлого
+переноса. Без CART_REDIS_URL хранилище в памяти процесса используется
+только при DEBUG и в тестах: у каждого процесса оно свое.
+"""
+import threading
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+
+from .models import Order, OrderItem
+from .totals import apply_changes, get_offers, line_changes
+
+DIRTY_KEY = 'cart:dirty'
+
+
+class MemoryCartStorage:
+    """
+    Корзины в памяти процесса: для тестов и разработки.
+    """
+
+    def __init__(self):
+        self.carts = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+    def get(self, user_id):
+        with self.lock:
+            return dict(self.carts.get(user_id, {}))
+
+    def set(self, user_id, product_info_id, quantity):
+        with self.lock:
+            self.carts.setdefault(user_id, {})[product_info_id] = quantity
+            self.dirty.add(user_id)
+
+    def increment(self, user_id, lines):
+        with self.lock:
+            cart = self.carts.setdefault(user_id, {})
+            for product_info_id, quantity in lines.items():
+                cart[product_info_id] = cart.get(product_info_id, 0) + quantity
+            self.dirty.add(user_id)
+            return {product_info_id: cart[product_info_id] for product_info_id in lines}
+
+    def remove(self, user_id, product_info_ids):
+        with self.lock:
+            cart = self.carts.get(user_id, {})
+            removed = [cart.pop(product_info_id) for product_info_id in product_info_ids if product_info_id in cart]
+            if removed:
+                self.dirty.add(user_id)
+            return len(removed)
+
+    def clear(self, user_id):
+        with self.lock:
+            self.carts.pop(user_id, None)
+            self.dirty.add(user_id)
+
+    def pop_dirty(self, count):
+        with self.lock:
+            return [self.dirty.pop() for _ in range(min(count, len(self.dirty)))]
+
+    def mark_dirty(self, user_ids):
+        with self.lock:
+            self.dirty.update(user_ids)
+
+
+class RedisCartStorage:
+    """
+    Корзины в хэшах Redis. Изменение корзины и отметка о необходимости
+    переноса в БД отправляются одним пайплайном.
+    """
+
+    def __init__(self, url, ttl):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def key(self, user_id):
+        return f'cart:{user_id}'
+
+    def get(self, user_id):
+        return {int(product_info_id): int(quantity)
+                for product_info_id, quantity in self.client.hgetall(self.key(user_id)).items()}
+
+    def set(self, user_id, product_info_id, quantity):
+        pipe = self.client.pipeline()
+        pipe.hset(self.key(user_id), product_info_id, quantity)
+        pipe.expire(self.key(user_id), self.ttl)
+        pipe.sadd(DIRTY_KEY, user_id)
+        pipe.execute()
+
+    def increment(self, user_id, lines):
+        """
+        Увеличивает количество позиций (HINCRBY) в одной транзакции MULTI/EXEC.
+        Возвращает новые количества.
+        """
+        pipe = self.client.pipeline()
+        for product_info_id, quantity in lines.items():
+            pipe.hincrby(self.key(user_id), product_info_id, quantity)
+        pipe.expire(self.key(user_id), self.ttl)
+        pipe.sadd(DIRTY_KEY, user_id)
+        return dict(zip(lines, pipe.execute()))
+
+    def remove(self, user_id, product_info_ids):
+        if not product_info_ids:
+            return 0
+        pipe = self.client.pipeline()
+        pipe.hdel(self.key(user_id), *product_info_ids)
+        pipe.sadd(DIRTY_KEY, user_id)
+        return pipe.execute()[0]
+
+    def clear(self, user_id):
+        pipe = self.client.pipeline()
+        pipe.delete(self.key(user_id))
+        pipe.sadd(DIRTY_KEY, user_id)
+        pipe.execute()
+
+    def pop_dirty(self, count):
+        return [int(user_id) for user_id in self.client.spop(DIRTY_KEY, count) or []]
+
+    def mark_dirty(self, user_ids):
+        if user_ids:
+            self.client.sadd(DIRTY_KEY, *user_ids)
+
+
+@lru_cache(maxsize=None)
+def get_cart_storage():
+    if settings.CART_REDIS_URL:
+        return RedisCartStorage(settings.CART_REDIS_URL, settings.CART_TTL)
+    if not (settings.DEBUG or settings.TESTING):
+        raise ImproperlyConfigured('CART_REDIS_URL is required when DEBUG is off')
+    return MemoryCartStorage()
+
+
+@transaction.atomic
+def flush_cart(user_id, lines=None, reprice=False):
+    """
+    Переносит корзину пользователя в заказ basket. Возвращает заказ
+    или None, если корзина пуста. Несуществующие позиции пропускаются.
+    Позиции, уже перенесенные в заказ, сохраняют цену, по которой были
+    добавлены; с reprice=True все позиции получают текущую цену.
+    """
+    if lines is None:
+        lines = get_cart_storage().get(user_id)
+
+    order = Order.objects.select_for_update().filter(user_id=user_id, state='basket').first()
+    old_lines = {}
+    if order is not None:
+        old_lines = {product_info_id: (quantity, price) for product_info_id, quantity, price in
+                     OrderItem.objects.filter(order=order).values_list('product_info_id', 'quantity', 'price')}
+    offers = get_offers(set(lines) | set(old_lines))
+    lines = {product_info_id: (quantity, old_lines[product_info_id][1]
+                               if product_info_id in old_lines and not reprice else offers[product_info_id][1])
+             for product_info_id, quantity in lines.items() if product_info_id in offers}
+
+    if not lines:
+        if order is not None:
+            order.delete()
+        return None
+    if order is None:
+        order = Order.objects.create(user_id=user_id, state='basket')
+
+    # Итоги при пакетных операциях с позициями обновляются здесь же, см. signals
+    OrderItem.objects.filter(order=order).exclude(product_info_id__in=list(lines)).delete()
+    OrderItem.objects.bulk_create(
+        [OrderItem(order=order, product_info_id=product_info_id, quantity=quantity, price=price)
+         for product_info_id, (quantity, price) in lines.items()],
+        update_conflicts=True, unique_fields=['order', 'product_info'], update_fields=['quantity', 'price'],
+    )
+    apply_changes(order.id, line_changes(old_lines, lines, offers))
+    return order
+
+
+def flush_dirty_carts(batch_size=500):
+    """
+    Переносит в БД все корзины, измененные с прошлого переноса.
+    Корзина, которую не удалось перенести, остается в очереди.
+    """
+    storage = get_cart_storage()
+    flushed = 0
+    while True:
+        user_ids = storage.pop_dirty(batch_size)
+        if not user_ids:
+            return flushed
+        for index, user_id in enumerate(user_ids):
+            try:
+                flush_cart(user_id)
+            except Exception:
+                storage.mark_dirty(user_ids[index:])
+                raise
+            flushed += 1
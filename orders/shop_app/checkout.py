@@ -0,0 +1,112 @@
+"""
+Оформление заказа из корзины.
+
+Остатки списываются одним условным UPDATE для всех позиций заказа:
+quantity = quantity - n только там, где quantity >= n. Перед этим строки
+ProductInfo блокируются SELECT ... FOR UPDATE в порядке id, поэтому
+параллельные оформления с общими товарами ждут друг друга, а не
+взаимоблокируются. Если хотя бы одной позиции не хватает, списание
+откатывается и возвращается список недостающих позиций.
+
+Оформленный заказ разбивается на части по магазинам (ShopOrder) со своей
+стоимостью доставки; стоимость доставки заказа - их сумма.
+"""
+from collections import defaultdict
+from functools import reduce
+from operator import or_
+
+from django.db import connection, transaction
+from django.db.models import Case, F, PositiveIntegerField, Q, Value, When
+
+from .cart import flush_cart, get_cart_storage
+from .models import OrderItem, ProductInfo, Shop, ShopOrder
+from .signals import new_order
+
+
+class CheckoutError(Exception):
+    """
+    Заказ не может быть оформлен.
+    """
+
+
+class InsufficientStock(CheckoutError):
+    """
+    Недостаточно остатков; items - список недостающих позиций.
+    """
+
+    def __init__(self, items):
+        super().__init__('Insufficient stock')
+        self.items = items
+
+
+class _StockConflict(Exception):
+    pass
+
+
+def reserve_stock(lines):
+    """
+    Списывает остатки позиций {id позиции магазина: количество}.
+    Должна вызываться внутри транзакции.
+    """
+    ids = sorted(lines)
+    if connection.features.has_select_for_update:
+        list(ProductInfo.objects.select_for_update().filter(id__in=ids).order_by('id').values_list('id', flat=True))
+
+    condition = reduce(or_, (Q(id=product_info_id, quantity__gte=quantity)
+                             for product_info_id, quantity in lines.items()))
+    decrement = Case(*[When(id=product_info_id, then=Value(quantity)) for product_info_id, quantity in lines.items()],
+                     output_field=PositiveIntegerField())
+    try:
+        with transaction.atomic():
+            if ProductInfo.objects.filter(condition).update(quantity=F('quantity') - decrement) != len(lines):
+                raise _StockConflict
+    except _StockConflict:
+        available = dict(ProductInfo.objects.filter(id__in=ids).values_list('id', 'quantity'))
+        raise InsufficientStock([
+            {'product_info_id': product_info_id, 'requested': lines[product_info_id],
+             'available': available.get(product_info_id, 0)}
+            for product_info_id in ids if available.get(product_info_id, 0) < lines[product_info_id]
+        ])
+
+
+def split_by_shop(order, state='new'):
+    """
+    Разбивает заказ на части по магазинам: итоги и стоимость доставки
+    каждой части считаются за один проход по позициям заказа по ценам,
+    сохраненным в позициях. Возвращает общую стоимость доставки.
+    """
+    subtotals = defaultdict(lambda: [0, 0])
+    for shop_id, price, quantity in OrderItem.objects.filter(order=order).values_list(
+            'product_info__shop_id', 'price', 'quantity'):
+        subtotals[shop_id][0] += price * quantity
+        subtotals[shop_id][1] += quantity
+    shops = Shop.objects.in_bulk(list(subtotals))
+    shop_orders = [ShopOrder(order=order, shop_id=shop_id, state=state, total_sum=total_sum, items_count=items_count,
+                             delivery_cost=shops[shop_id].get_delivery_cost(total_sum))
+                   for shop_id, (total_sum, items_count) in subtotals.items()]
+    ShopOrder.objects.bulk_create(shop_orders, update_conflicts=True, unique_fields=['order', 'shop'],
+                                  update_fields=['state', 'total_sum', 'items_count', 'delivery_cost'])
+    return sum(shop_order.delivery_cost for shop_order in shop_orders)
+
+
+def checkout(user, contact=None):
+    """
+    Оформляет корзину пользователя в заказ в статусе new.
+    Оформленные позиции удаляются из корзины после фиксации транзакции.
+    """
+    storage = get_cart_storage()
+    lines = storage.get(user.id)
+    if not lines:
+        raise CheckoutError('Cart is empty')
+
+    with transaction.atomic():
+        reserve_stock(lines)
+        # Заказ оформляется по текущим ценам, как их показывает корзина
+        order = flush_cart(user.id, lines, reprice=True)
+        order.state = 'new'
+        order.contact = contact
+        order.delivery_cost = split_by_shop(order)
+        order.save(update_fields=['state', 'contact', 'delivery_cost'])
+        transaction.on_commit(lambda: storage.remove(user.id, list(lines)))
+        transaction.on_commit(lambda: new_order.send(sender=checkout, user_id=user.id, order_id=order.id))
+    return order
@@ -0,0 +1,92 @@
+"""
+Экспорт каталога магазина.
+
+Позиции читаются через iterator(chunk_size=...) с предзагрузкой параметров
+для каждой пачки, а результат отдается генератором строк. Поэтому экспорт
+работает в постоянной памяти и может сразу отдаваться клиенту через
+StreamingHttpResponse.
+"""
+import csv
+import io
+import json
+
+import yaml
+from django.conf import settings
+from django.db.models import Prefetch
+
+from .models import Category, ProductInfo, ProductParameter
+
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
+
+CSV_COLUMNS = ['id', 'category', 'model', 'name', 'price', 'price_rrc', 'quantity', 'parameters']
+
+
+def iter_goods(shop, chunk_size=None):
+    """
+    Позиции магазина в формате раздела goods прайс-листа.
+    """
+    product_infos = ProductInfo.objects.filter(shop=shop).select_related('product').prefetch_related(
+        Prefetch('product_parameters', queryset=ProductParameter.objects.select_related('parameter'))
+    ).order_by('id')
+    for product_info in product_infos.iterator(chunk_size=chunk_size or settings.EXPORT_CHUNK_SIZE):
+        yield {
+            'id': product_info.external_id,
+            'category': product_info.product.category_id,
+            'model': product_info.model,
+            'name': product_info.product.name,
+            'price': product_info.price,
+            'price_rrc': product_info.price_rrc,
+            'quantity': product_info.quantity,
+            'parameters': {parameter.parameter.name: parameter.value
+                           for parameter in product_info.product_parameters.all()},
+        }
+
+
+def _dump_yaml(data):
+    return yaml.dump(data, Dumper=SafeDumper, allow_unicode=True, sort_keys=False)
+
+
+def export_yaml(shop):
+    """
+    YAML в той же схеме, что и data/shop1.yaml.
+    """
+    categories = [{'id': category_id, 'name': name} for category_id, name in
+                  Category.objects.filter(shops=shop).order_by('id').values_list('id', 'name')]
+    yield _dump_yaml({'shop': shop.name, 'categories': categories})
+    yield '\ngoods:\n'
+    for item in iter_goods(shop):
+        yield _dump_yaml([item])
+
+
+def export_jsonl(shop):
+    """
+    Одна позиция goods на строку.
+    """
+    for item in iter_goods(shop):
+        yield json.dumps(item, ensure_ascii=False) + '\n'
+
+
+def export_csv(shop):
+    """
+    Одна позиция на строку, параметры - JSON-объектом в последней колонке.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    for item in iter_goods(shop):
+        item['parameters'] = json.dumps(item['parameters'], ensure_ascii=False)
+        writer.writerow([item[column] for column in CSV_COLUMNS])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+EXPORT_FORMATS = {
+    'yaml': (export_yaml, 'application/x-yaml'),
+    'jsonl': (export_jsonl, 'application/x-ndjson'),
+    'csv': (export_csv, 'text/csv'),
+}
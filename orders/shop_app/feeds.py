@@ -0,0 +1,144 @@
+"""
+Чтение прайс-листов поставщиков в формате data/shop1.yaml.
+
+Кроме полного разбора документа есть потоковый режим: YAML читается по
+событиям, а позиции раздела goods отдаются по одной, так что в памяти
+одновременно находится только текущая пачка товаров. Если PyYAML собран
+с LibYAML, используется C-парсер.
+"""
+import yaml
+from yaml.events import (AliasEvent, MappingEndEvent, MappingStartEvent, ScalarEvent,
+                         SequenceEndEvent, SequenceStartEvent)
+from yaml.nodes import ScalarNode
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+
+class PriceListError(ValueError):
+    """
+    Прайс-лист не соответствует ожидаемому формату.
+    """
+
+
+def load_price_list(stream):
+    """
+    Разбирает YAML-документ прайс-листа целиком.
+    """
+    try:
+        data = yaml.load(stream, Loader=SafeLoader)
+    except yaml.YAMLError as e:
+        raise PriceListError(f'Ошибка разбора YAML: {e}')
+    if not isinstance(data, dict) or not {'shop', 'goods'}.issubset(data):
+        raise PriceListError('Прайс-лист должен содержать разделы shop и goods')
+    return data
+
+
+class _EventReader:
+    """
+    Собирает python-объекты из событий парсера без построения дерева узлов.
+    """
+
+    def __init__(self, stream):
+        self.loader = SafeLoader(stream)
+
+    def close(self):
+        self.loader.dispose()
+
+    def next_event(self, *expected):
+        event = self.loader.get_event()
+        if expected and not isinstance(event, expected):
+            raise PriceListError(f'Неожиданный элемент YAML: {event}')
+        return event
+
+    def peek(self, event_class):
+        return self.loader.check_event(event_class)
+
+    def read_value(self):
+        event = self.next_event()
+        if isinstance(event, ScalarEvent):
+            tag = event.tag
+            if tag is None or tag == '!':
+                tag = self.loader.resolve(ScalarNode, event.value, event.implicit)
+            node = ScalarNode(tag, event.value, style=event.style)
+            constructor = self.loader.yaml_constructors.get(tag, self.loader.yaml_constructors[None])
+            try:
+                return constructor(self.loader, node)
+            except yaml.YAMLError as e:
+                raise PriceListError(f'Ошибка разбора YAML: {e}')
+        if isinstance(event, MappingStartEvent):
+            mapping = {}
+            while not self.peek(MappingEndEvent):
+                key = self.read_value()
+                mapping[key] = self.read_value()
+            self.next_event()
+            return mapping
+        if isinstance(event, SequenceStartEvent):
+            sequence = []
+            while not self.peek(SequenceEndEvent):
+                sequence.append(self.read_value())
+            self.next_event()
+            return sequence
+        if isinstance(event, AliasEvent):
+            raise PriceListError('Ссылки (алиасы) YAML в прайс-листе не поддерживаются')
+        raise PriceListError(f'Неожиданный элемент YAML: {event}')
+
+
+def stream_price_list(stream):
+    """
+    Потоковое чтение прайс-листа.
+
+    Возвращает словарь с разделами shop и categories, прочитанными сразу,
+    и генератором позиций goods. Разделы shop и categories должны идти
+    в документе до goods.
+    """
+    reader = _EventReader(stream)
+    try:
+        reader.next_event(yaml.StreamStartEvent)
+        reader.next_event(yaml.DocumentStartEvent)
+        reader.next_event(MappingStartEvent)
+        header = {}
+        while not reader.peek(MappingEndEvent):
+            key = reader.read_value()
+            if key == 'goods':
+                break
+            header[key] = reader.read_value()
+        else:
+            raise PriceListError('Прайс-лист должен содержать раздел goods')
+    except PriceListError:
+        reader.close()
+        raise
+    except yaml.YAMLError as e:
+        reader.close()
+        raise PriceListError(f'Ошибка разбора YAML: {e}')
+    if 'shop' not in header:
+        reader.close()
+        raise PriceListError('Раздел shop должен предшествовать разделу goods')
+    header['goods'] = _iter_goods(reader)
+    return header
+
+
+def _iter_goods(reader):
+    try:
+        event = reader.next_event()
+        if not (isinstance(event, ScalarEvent) and event.value in ('', '~', 'null')):
+            if not isinstance(event, SequenceStartEvent):
+                raise PriceListError('Раздел goods должен быть списком')
+            while not reader.peek(SequenceEndEvent):
+                item = reader.read_value()
+                if not isinstance(item, dict):
+                    raise PriceListError('Позиция goods должна быть словарем')
+                yield item
+            reader.next_event()
+        # Разделы после goods уже не могут быть учтены
+        while not reader.peek(MappingEndEvent):
+            key = reader.read_value()
+            if key in ('shop', 'categories'):
+                raise PriceListError(f'Раздел {key} должен предшествовать разделу goods')
+            reader.read_value()
+    except yaml.YAMLError as e:
+        raise PriceListError(f'Ошибка разбора YAML: {e}')
+    finally:
+        reader.close()
@@ -0,0 +1,105 @@
+"""
+Идемпотентные запросы с заголовком Idempotency-Key.
+
+Первый запрос с ключом занимает строку IdempotencyKey (уникальность по
+пользователю и ключу), выполняется и сохраняет ответ. Повтор с тем же
+ключом получает сохраненный ответ без повторного выполнения; повтор, пока
+первый запрос еще выполняется, - 409. Одновременные дубликаты отсекает
+уникальное ограничение. Ответы с ошибкой сервера не сохраняются, такой
+запрос можно повторить. Если процесс упал, не сохранив ответ, повтор
+через IDEMPOTENCY_KEY_LOCK_TIMEOUT секунд выполняет запрос заново.
+"""
+import hashlib
+import json
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from drf_spectacular.utils import OpenApiParameter
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+
+IDEMPOTENCY_KEY_PARAMETER = OpenApiParameter(HEADER, str, OpenApiParameter.HEADER,
+                                             description='Ключ для безопасного повтора запроса')
+
+
+def request_fingerprint(request):
+    body = json.dumps(request.data, sort_keys=True, default=str)
+    return hashlib.sha256(f'{request.method} {request.path}\n{body}'.encode('utf-8')).hexdigest()
+
+
+def claim_key(user, key, fingerprint):
+    """
+    Занимает ключ. Возвращает (запись, True) для нового ключа и
+    (существующая запись, False) для повтора. Просроченный ключ и ключ
+    прерванного запроса занимаются заново.
+    """
+    now = timezone.now()
+    locked_until = now + timedelta(seconds=settings.IDEMPOTENCY_KEY_LOCK_TIMEOUT)
+    record = IdempotencyKey.objects.filter(user=user, key=key).first()
+    if record is not None:
+        if record.expires_at > now:
+            if record.status_code is None and record.fingerprint == fingerprint and record.locked_until <= now \
+                    and IdempotencyKey.objects.filter(id=record.id, status_code__isnull=True,
+                                                      locked_until__lte=now).update(locked_until=locked_until):
+                record.locked_until = locked_until
+                return record, True
+            return record, False
+        IdempotencyKey.objects.filter(id=record.id, expires_at__lte=now).delete()
+    try:
+        with transaction.atomic():
+            return IdempotencyKey.objects.create(
+                user=user, key=key, fingerprint=fingerprint, locked_until=locked_until,
+                expires_at=now + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)), True
+    except IntegrityError:
+        # Тот же ключ только что занял параллельный запрос
+        return IdempotencyKey.objects.get(user=user, key=key), False
+
+
+def idempotent(method):
+    """
+    Декоратор метода APIView: запрос без заголовка выполняется как обычно.
+    """
+    @wraps(method)
+    def wrapper(view, request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key:
+            return method(view, request, *args, **kwargs)
+        if len(key) > IdempotencyKey._meta.get_field('key').max_length:
+            return Response({"error": f"{HEADER} is too long"}, status=status.HTTP_400_BAD_REQUEST)
+
+        fingerprint = request_fingerprint(request)
+        record, created = claim_key(request.user, key, fingerprint)
+        if not created:
+            if record.fingerprint != fingerprint:
+                return Response({"error": f"{HEADER} was used with another request"},
+                                status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+            if record.status_code is None:
+                return Response({"error": "Request with this key is in progress"}, status=status.HTTP_409_CONFLICT)
+            return Response(record.response, status=record.status_code, headers={'Idempotent-Replayed': 'true'})
+
+        try:
+            response = method(view, request, *args, **kwargs)
+        except Exception:
+            record.delete()
+            raise
+        if response.status_code >= 500:
+            record.delete()
+        else:
+            IdempotencyKey.objects.filter(id=record.id).update(status_code=response.status_code,
+                                                               response=response.data)
+        return response
+    return wrapper
+
+
+def purge_expired_keys():
+    """
+    Удаляет просроченные ключи, возвращает их число.
+    """
+    return IdempotencyKey.objects.filter(expires_at__lte=timezone.now()).delete()[0]
@@ -0,0 +1,528 @@
+"""
+Импорт прайс-листов поставщиков в формате data/shop1.yaml.
+
+Товары обрабатываются пачками: для каждой пачки справочники (товары,
+параметры) разрешаются несколькими запросами с IN, а ProductInfo и
+ProductParameter записываются через bulk_create с upsert по ограничениям
+unique_product_info и unique_product_parameter. Весь импорт выполняется в
+одной транзакции.
+"""
+import csv
+import io
+import time
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from . import search
+from .feeds import PriceListError, load_price_list, stream_price_list
+from .models import Shop, Category, Product, ProductInfo, Parameter, ProductParameter
+
+REQUIRED_ITEM_FIELDS = {'id', 'category', 'name', 'price', 'price_rrc', 'quantity'}
+
+
+def chunked(iterable, size):
+    """
+    Разбивает итерируемый объект на списки длиной не больше size.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+@dataclass
+class ImportStats:
+    shop_id: int = None
+    items: int = 0
+    created: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    deleted: int = 0
+    duration: float = 0.0
+    skipped: bool = False
+
+    def as_dict(self):
+        return {
+            'shop_id': self.shop_id,
+            'items': self.items,
+            'created': self.created,
+            'updated': self.updated,
+            'unchanged': self.unchanged,
+            'deleted': self.deleted,
+            'duration': round(self.duration, 3),
+            'skipped': self.skipped,
+        }
+
+
+class PriceListImporter:
+    """
+    Пакетный импорт прайс-листа.
+
+    Позиции магазина, которых нет в новом прайс-листе, удаляются.
+    Строка магазина блокируется до конца транзакции, поэтому импорты
+    одного магазина выполняются последовательно.
+    progress - необязательная функция, вызывается со статистикой после
+    каждой пачки.
+    """
+
+    def __init__(self, user=None, batch_size=None, progress=None):
+        self.user = user
+        self.batch_size = batch_size or settings.IMPORT_BATCH_SIZE
+        self.progress = progress
+        self.category_ids = set()
+
+    def run(self, price_list):
+        started = time.monotonic()
+        self.stats = ImportStats()
+        with transaction.atomic():
+            shop = self.get_shop(price_list['shop'])
+            self.shop = Shop.objects.select_for_update().get(id=shop.id)
+            self.stats.shop_id = self.shop.id
+            self.import_categories(price_list.get('categories') or [])
+            self.existing_ids = set(ProductInfo.objects.filter(shop=self.shop).values_list('id', flat=True))
+            self.seen_ids = set()
+            for batch in chunked(price_list['goods'] or [], self.batch_size):
+                self.product_ids = set()
+                self.import_goods(batch)
+                search.index_products(self.product_ids)
+                if self.progress is not None:
+                    self.stats.duration = time.monotonic() - started
+                    self.progress(self.stats)
+            self.delete_missing()
+        self.stats.duration = time.monotonic() - started
+        return self.stats
+
+    def get_shop(self, name):
+        """
+        У пользователя один магазин (Shop.user - OneToOne): он ищется по
+        пользователю, а название обновляется из прайс-листа.
+        """
+        if self.user is None:
+            shop, _ = Shop.objects.get_or_create(name=name)
+            return shop
+        shop, created = Shop.objects.get_or_create(user=self.user, defaults={'name': name})
+        if not created and shop.name != name:
+            shop.name = name
+            shop.save(update_fields=['name'])
+        return shop
+
+    def import_categories(self, categories):
+        """
+        Категории прайс-листа сохраняются с id из файла.
+        """
+        names = {category['id']: str(category['name']) for category in categories}
+        self.category_ids.update(names)
+        existing = Category.objects.in_bulk(list(names))
+        changed = []
+        for category_id, category in existing.items():
+            if category.name != names[category_id]:
+                category.name = names[category_id]
+                changed.append(category)
+        Category.objects.bulk_create([Category(id=category_id, name=name)
+                                      for category_id, name in names.items() if category_id not in existing],
+                                     ignore_conflicts=True)
+        if changed:
+            Category.objects.bulk_update(changed, ['name'])
+            search.index_products(Product.objects.filter(category__in=changed).values_list('id', flat=True))
+        self.shop.categories.add(*names)
+
+    def resolve_products(self, keys):
+        """
+        Возвращает словарь (name, category_id) -> id, создавая недостающие товары.
+
+        Товары, созданные параллельным импортом, пропускаются уникальным
+        ограничением и читаются повторно.
+        """
+        names = {name for name, _ in keys}
+        products = {(name, category_id): product_id for product_id, name, category_id in
+                    Product.objects.filter(name__in=names).values_list('id', 'name', 'category_id')}
+        missing = sorted(key for key in keys if key not in products)
+        if missing:
+            Product.objects.bulk_create([Product(name=name, category_id=category_id) for name, category_id in missing],
+                                        batch_size=self.batch_size, ignore_conflicts=True)
+            products.update({(name, category_id): product_id for product_id, name, category_id in
+                             Product.objects.filter(name__in={name for name, _ in missing})
+                             .values_list('id', 'name', 'category_id')})
+        return products
+
+    def resolve_parameters(self, names):
+        """
+        Возвращает словарь name -> id, создавая недостающие параметры.
+        """
+        parameters = dict(Parameter.objects.filter(name__in=names).values_list('name', 'id'))
+        missing = sorted(name for name in names if name not in parameters)
+        if missing:
+            Parameter.objects.bulk_create([Parameter(name=name) for name in missing],
+                                          batch_size=self.batch_size, ignore_conflicts=True)
+            parameters.update(Parameter.objects.filter(name__in=missing).values_list('name', 'id'))
+        return parameters
+
+    def clean_goods(self, goods):
+        for item in goods:
+            missing_fields = REQUIRED_ITEM_FIELDS - set(item)
+            if missing_fields:
+                raise PriceListError(f'Позиция {item.get("id")}: нет полей {", ".join(sorted(missing_fields))}')
+        # Категория позиции должна быть в прайс-листе или уже в БД
+        unknown = {item['category'] for item in goods} - self.category_ids
+        if unknown:
+            self.category_ids.update(Category.objects.filter(id__in=unknown).values_list('id', flat=True))
+            for item in goods:
+                if item['category'] not in self.category_ids:
+                    raise PriceListError(f'Позиция {item["id"]}: неизвестная категория {item["category"]}')
+        # Повторы внутри одной пачки сломают upsert, последняя запись побеждает
+        return list({self.item_key(item): item for item in goods}.values())
+
+    def item_key(self, item):
+        return str(item['name']), item['category'], item['id']
+
+    def import_goods(self, goods):
+        goods = self.clean_goods(goods)
+        products = self.resolve_products({(str(item['name']), item['category']) for item in goods})
+        parameters = self.resolve_parameters({str(name) for item in goods
+                                              for name in (item.get('parameters') or {})})
+
+        infos = [ProductInfo(product_id=products[(str(item['name']), item['category'])],
+                             shop_id=self.shop.id,
+                             external_id=item['id'],
+                             model=item.get('model', ''),
+                             price=item['price'],
+                             price_rrc=item['price_rrc'],
+                             quantity=item['quantity']) for item in goods]
+        ProductInfo.objects.bulk_create(
+            infos, batch_size=self.batch_size,
+            update_conflicts=True,
+            unique_fields=['product', 'shop', 'external_id'],
+            update_fields=['model', 'price', 'price_rrc', 'quantity'],
+        )
+        info_ids = {(product_id, external_id): info_id for info_id, product_id, external_id in
+                    ProductInfo.objects.filter(shop=self.shop, external_id__in=[item['id'] for item in goods])
+                    .values_list('id', 'product_id', 'external_id')}
+
+        existing_parameters = {}
+        for product_parameter_id, info_id, parameter_id in ProductParameter.objects.filter(
+                product_info_id__in=info_ids.values()).values_list('id', 'product_info_id', 'parameter_id'):
+            existing_parameters[(info_id, parameter_id)] = product_parameter_id
+
+        product_parameters = []
+        for item, info in zip(goods, infos):
+            info_id = info_ids[(info.product_id, info.external_id)]
+            for name, value in (item.get('parameters') or {}).items():
+                product_parameters.append(ProductParameter(product_info_id=info_id,
+                                                           parameter_id=parameters[str(name)],
+                                                           value=str(value)))
+            self.seen_ids.add(info_id)
+            self.product_ids.add(info.product_id)
+            if info_id in self.existing_ids:
+                self.stats.updated += 1
+            else:
+                self.stats.created += 1
+        ProductParameter.objects.bulk_create(
+            product_parameters, batch_size=self.batch_size,
+            update_conflicts=True,
+            unique_fields=['product_info', 'parameter'],
+            update_fields=['value'],
+        )
+        # Параметры, которые пропали из описания позиции
+        stale = set(existing_parameters) - {(parameter.product_info_id, parameter.parameter_id)
+                                            for parameter in product_parameters}
+        if stale:
+            ProductParameter.objects.filter(id__in=[existing_parameters[key] for key in stale]).delete()
+        self.stats.items += len(goods)
+
+    def delete_missing(self):
+        """
+        Удаляет позиции магазина, отсутствующие в прайс-листе.
+        """
+        missing = self.existing_ids - self.seen_ids
+        for batch in chunked(missing, self.batch_size):
+            ProductInfo.objects.filter(id__in=batch).delete()
+        self.stats.deleted = len(missing)
+
+
+class DiffPriceListImporter(PriceListImporter):
+    """
+    Дифференциальный импорт: прайс-лист сравнивается с текущими позициями
+    магазина по external_id, записываются только новые, измененные и
+    пропавшие позиции. Неизмененные позиции не затрагиваются, поэтому
+    связанные с ними OrderItem сохраняются.
+    """
+    info_fields = ['product_id', 'model', 'price', 'price_rrc', 'quantity']
+
+    def item_key(self, item):
+        return item['id']
+
+    def import_goods(self, goods):
+        goods = self.clean_goods(goods)
+        existing = {row['external_id']: row for row in ProductInfo.objects.filter(
+            shop=self.shop, external_id__in=[item['id'] for item in goods]).values('id', 'external_id',
+                                                                                  *self.info_fields)}
+        existing_parameters = {}
+        for product_parameter_id, info_id, parameter_id, value in ProductParameter.objects.filter(
+                product_info_id__in=[row['id'] for row in existing.values()]) \
+                .values_list('id', 'product_info_id', 'parameter_id', 'value'):
+            existing_parameters.setdefault(info_id, {})[parameter_id] = (product_parameter_id, value)
+
+        products = self.resolve_products({(str(item['name']), item['category']) for item in goods})
+        parameters = self.resolve_parameters({str(name) for item in goods
+                                              for name in (item.get('parameters') or {})})
+
+        new_infos, new_items, changed_infos = [], [], []
+        new_parameters, changed_parameters, stale_parameters = [], [], []
+        for item in goods:
+            values = {
+                'product_id': products[(str(item['name']), item['category'])],
+                'model': item.get('model', ''),
+                'price': item['price'],
+                'price_rrc': item['price_rrc'],
+                'quantity': item['quantity'],
+            }
+            wanted = {parameters[str(name)]: str(value) for name, value in (item.get('parameters') or {}).items()}
+            row = existing.get(item['id'])
+            if row is None:
+                new_infos.append(ProductInfo(shop_id=self.shop.id, external_id=item['id'], **values))
+                new_items.append(wanted)
+                self.product_ids.add(values['product_id'])
+                continue
+
+            self.seen_ids.add(row['id'])
+            info_changed = any(row[name] != values[name] for name in self.info_fields)
+            if info_changed:
+                changed_infos.append(ProductInfo(id=row['id'], **values))
+                if row['product_id'] != values['product_id'] or row['model'] != values['model']:
+                    self.product_ids.update((row['product_id'], values['product_id']))
+
+            current = existing_parameters.get(row['id'], {})
+            parameters_changed = False
+            for parameter_id, value in wanted.items():
+                if parameter_id not in current:
+                    new_parameters.append(ProductParameter(product_info_id=row['id'], parameter_id=parameter_id,
+                                                           value=value))
+                    parameters_changed = True
+                elif current[parameter_id][1] != value:
+                    changed_parameters.append(ProductParameter(id=current[parameter_id][0], value=value))
+                    parameters_changed = True
+            for parameter_id in current.keys() - wanted.keys():
+                stale_parameters.append(current[parameter_id][0])
+                parameters_changed = True
+
+            if info_changed or parameters_changed:
+                self.stats.updated += 1
+            else:
+                self.stats.unchanged += 1
+
+        if new_infos:
+            ProductInfo.objects.bulk_create(new_infos, batch_size=self.batch_size)
+            if any(info.id is None for info in new_infos):
+                info_ids = dict(ProductInfo.objects.filter(
+                    shop=self.shop, external_id__in=[info.external_id for info in new_infos])
+                    .values_list('external_id', 'id'))
+                for info in new_infos:
+                    info.id = info_ids[info.external_id]
+            for info, wanted in zip(new_infos, new_items):
+                self.seen_ids.add(info.id)
+                new_parameters.extend(ProductParameter(product_info_id=info.id, parameter_id=parameter_id,
+                                                       value=value) for parameter_id, value in wanted.items())
+            self.stats.created += len(new_infos)
+        if changed_infos:
+            ProductInfo.objects.bulk_update(changed_infos, self.info_fields, batch_size=self.batch_size)
+        if new_parameters:
+            ProductParameter.objects.bulk_create(new_parameters, batch_size=self.batch_size)
+        if changed_parameters:
+            ProductParameter.objects.bulk_update(changed_parameters, ['value'], batch_size=self.batch_size)
+        if stale_parameters:
+            ProductParameter.objects.filter(id__in=stale_parameters).delete()
+        self.stats.items += len(goods)
+
+
+class CopyPriceListImporter(PriceListImporter):
+    """
+    Загрузка для PostgreSQL: позиции пачками загружаются командой COPY во
+    временные таблицы (они не пишутся в WAL), после чего товары, параметры,
+    ProductInfo и ProductParameter сливаются в рабочие таблицы несколькими
+    множественными запросами INSERT ... ON CONFLICT и DELETE ... WHERE NOT EXISTS.
+    Для других СУБД используется обычный пакетный импорт через ORM.
+    """
+
+    def run(self, price_list):
+        if connection.vendor != 'postgresql':
+            return super().run(price_list)
+        started = time.monotonic()
+        self.stats = ImportStats()
+        with transaction.atomic(), connection.cursor() as cursor:
+            shop = self.get_shop(price_list['shop'])
+            self.shop = Shop.objects.select_for_update().get(id=shop.id)
+            self.stats.shop_id = self.shop.id
+            self.import_categories(price_list.get('categories') or [])
+            self.create_staging_tables(cursor)
+            for batch in chunked(price_list['goods'] or [], self.batch_size):
+                self.copy_goods(cursor, batch)
+                if self.progress is not None:
+                    self.stats.duration = time.monotonic() - started
+                    self.progress(self.stats)
+            self.merge(cursor)
+        self.stats.duration = time.monotonic() - started
+        return self.stats
+
+    def create_staging_tables(self, cursor):
+        cursor.execute("""
+            CREATE TEMPORARY TABLE import_goods (
+                seq bigint PRIMARY KEY, external_id bigint NOT NULL, category_id bigint NOT NULL,
+                name text NOT NULL, model text NOT NULL,
+                price integer NOT NULL, price_rrc integer NOT NULL, quantity integer NOT NULL
+            ) ON COMMIT DROP
+        """)
+        cursor.execute("""
+            CREATE TEMPORARY TABLE import_parameters (
+                seq bigint NOT NULL, name text NOT NULL, value text NOT NULL
+            ) ON COMMIT DROP
+        """)
+
+    def copy_goods(self, cursor, goods):
+        goods = self.clean_goods(goods)
+        goods_rows, parameter_rows = io.StringIO(), io.StringIO()
+        goods_writer, parameter_writer = csv.writer(goods_rows), csv.writer(parameter_rows)
+        for item in goods:
+            seq = self.stats.items
+            self.stats.items += 1
+            goods_writer.writerow([seq, item['id'], item['category'], item['name'], item.get('model', ''),
+                                   item['price'], item['price_rrc'], item['quantity']])
+            for name, value in (item.get('parameters') or {}).items():
+                parameter_writer.writerow([seq, name, value])
+        self.copy(cursor, 'import_goods', goods_rows, ['name', 'model'])
+        self.copy(cursor, 'import_parameters', parameter_rows, ['name', 'value'])
+
+    def copy(self, cursor, table, rows, text_columns):
+        rows.seek(0)
+        # csv.writer пишет пустую строку без кавычек, а COPY читает ее как NULL
+        sql = f'COPY {table} FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL ({", ".join(text_columns)}))'
+        if hasattr(cursor, 'copy_expert'):
+            cursor.copy_expert(sql, rows)
+        else:
+            # psycopg 3
+            with cursor.copy(sql) as copy:
+                copy.write(rows.getvalue())
+
+    def merge(self, cursor):
+        shop_id = self.shop.id
+        cursor.execute('ANALYZE import_goods')
+        cursor.execute('ANALYZE import_parameters')
+
+        # Недостающие товары и имена параметров
+        # Уже созданные параллельным импортом строки пропускаются
+        cursor.execute("""
+            INSERT INTO shop_app_product (name, category_id)
+            SELECT DISTINCT g.name, g.category_id FROM import_goods g
+            ORDER BY g.name, g.category_id
+            ON CONFLICT (name, category_id) DO NOTHING
+        """)
+        cursor.execute("""
+            INSERT INTO shop_app_parameter (name)
+            SELECT DISTINCT ip.name FROM import_parameters ip
+            ORDER BY ip.name
+            ON CONFLICT (name) DO NOTHING
+        """)
+
+        # Позиции: последняя запись с тем же ключом побеждает
+        cursor.execute("""
+            CREATE TEMPORARY TABLE import_resolved ON COMMIT DROP AS
+            SELECT DISTINCT ON (p.id, g.external_id) g.seq, g.external_id, p.id AS product_id,
+                   g.model, g.price, g.price_rrc, g.quantity
+            FROM import_goods g
+            JOIN shop_app_product p ON p.name = g.name AND p.category_id = g.category_id
+            ORDER BY p.id, g.external_id, g.seq DESC
+        """)
+        cursor.execute("""
+            WITH upserted AS (
+                INSERT INTO shop_app_productinfo (model, external_id, product_id, shop_id, quantity, price, price_rrc)
+                SELECT r.model, r.external_id, r.product_id, %s, r.quantity, r.price, r.price_rrc
+                FROM import_resolved r
+                ON CONFLICT (product_id, shop_id, external_id) DO UPDATE SET
+                    model = EXCLUDED.model, quantity = EXCLUDED.quantity,
+                    price = EXCLUDED.price, price_rrc = EXCLUDED.price_rrc
+                WHERE (shop_app_productinfo.model, shop_app_productinfo.quantity,
+                       shop_app_productinfo.price, shop_app_productinfo.price_rrc)
+                      IS DISTINCT FROM (EXCLUDED.model, EXCLUDED.quantity, EXCLUDED.price, EXCLUDED.price_rrc)
+                RETURNING xmax = 0 AS inserted
+            )
+            SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM upserted
+        """, [shop_id])
+        self.stats.created, self.stats.updated = cursor.fetchone()
+
+        cursor.execute("""
+            CREATE TEMPORARY TABLE import_info ON COMMIT DROP AS
+            SELECT r.seq, pi.id AS info_id
+            FROM import_resolved r
+            JOIN shop_app_productinfo pi
+              ON pi.shop_id = %s AND pi.product_id = r.product_id AND pi.external_id = r.external_id
+        """, [shop_id])
+        cursor.execute('CREATE INDEX ON import_info (info_id)')
+
+        # Позиции, которых нет в прайс-листе, вместе с зависимыми строками
+        cursor.execute("""
+            CREATE TEMPORARY TABLE import_deleted ON COMMIT DROP AS
+            SELECT pi.id, pi.product_id FROM shop_app_productinfo pi
+            WHERE pi.shop_id = %s AND NOT EXISTS (SELECT 1 FROM import_info i WHERE i.info_id = pi.id)
+        """, [shop_id])
+        cursor.execute('DELETE FROM shop_app_productparameter WHERE product_info_id IN (SELECT id FROM import_deleted)')
+        cursor.execute('DELETE FROM shop_app_orderitem WHERE product_info_id IN (SELECT id FROM import_deleted) '
+                       'RETURNING order_id')
+        changed_orders = {order_id for order_id, in cursor.fetchall()}
+        cursor.execute('DELETE FROM shop_app_productinfo WHERE id IN (SELECT id FROM import_deleted)')
+        self.stats.deleted = cursor.rowcount
+        if changed_orders:
+            # Удаление в обход ORM не вызывает сигналы, итоги заказов пересчитываются здесь
+            from .totals import recalculate_totals
+
+            recalculate_totals(sorted(changed_orders))
+        self.stats.unchanged = self.stats.items - self.stats.created - self.stats.updated
+
+        # Параметры позиций
+        cursor.execute("""
+            CREATE TEMPORARY TABLE import_product_parameters ON COMMIT DROP AS
+            SELECT DISTINCT ON (i.info_id, par.id) i.info_id, par.id AS parameter_id, ip.value
+            FROM import_parameters ip
+            JOIN import_info i ON i.seq = ip.seq
+            JOIN shop_app_parameter par ON par.name = ip.name
+            ORDER BY i.info_id, par.id, ip.seq DESC
+        """)
+        cursor.execute("""
+            INSERT INTO shop_app_productparameter (product_info_id, parameter_id, value)
+            SELECT info_id, parameter_id, value FROM import_product_parameters
+            ON CONFLICT (product_info_id, parameter_id) DO UPDATE SET value = EXCLUDED.value
+            WHERE shop_app_productparameter.value IS DISTINCT FROM EXCLUDED.value
+        """)
+        cursor.execute("""
+            DELETE FROM shop_app_productparameter pp
+            USING import_info i
+            WHERE pp.product_info_id = i.info_id
+              AND NOT EXISTS (SELECT 1 FROM import_product_parameters ipp
+                              WHERE ipp.info_id = pp.product_info_id AND ipp.parameter_id = pp.parameter_id)
+        """)
+
+        search_backend = search.get_search_backend()
+        if isinstance(search_backend, search.PostgresSearchBackend):
+            search_backend.index_from_query('SELECT product_id FROM import_resolved '
+                                            'UNION SELECT product_id FROM import_deleted')
+
+
+IMPORTERS = {
+    'full': PriceListImporter,
+    'diff': DiffPriceListImporter,
+    'copy': CopyPriceListImporter,
+}
+
+
+def import_price_list(stream, user=None, mode='full', progress=None):
+    """
+    Импортирует прайс-лист из YAML-потока и возвращает статистику.
+    Файл читается потоково, пачками по IMPORT_BATCH_SIZE позиций.
+    """
+    if mode not in IMPORTERS:
+        raise PriceListError(f'Неизвестный режим импорта: {mode}')
+    return IMPORTERS[mode](user=user, progress=progress).run(stream_price_list(stream))
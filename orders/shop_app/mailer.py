@@ -0,0 +1,205 @@
+"""
+Пакетная отправка писем.
+
+Письма складываются в очередь (список mail:outbox в Redis), а задача
+deliver_mail забирает их пачками по MAIL_BATCH_SIZE и отправляет через
+одно SMTP-соединение на процесс воркера: рукопожатие SMTP/TLS происходит
+один раз, а не на каждое письмо. Оборванное соединение открывается заново,
+и отправка продолжается с письма, которое сервер не подтвердил (оно может
+прийти дважды, но не теряется). Письма, отклоненные сервером (адрес
+получателя или отправителя, содержимое), не повторяются: из очереди они
+переносятся в mail:dead. Без MAIL_REDIS_URL каждое письмо отправляется
+отдельной задачей send_email, но тоже через постоянное соединение воркера.
+"""
+import json
+import smtplib
+import threading
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import EmailMultiAlternatives, get_connection
+
+OUTBOX_KEY = 'mail:outbox'
+DEAD_KEY = 'mail:dead'
+SCHEDULED_KEY = 'mail:deliver-scheduled'
+
+# Сервер отклонил само письмо: повтор не поможет, соединение остается рабочим
+REJECTED_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+
+
+class DeliveryInterrupted(smtplib.SMTPException):
+    """
+    Соединение с почтовым сервером не удалось восстановить;
+    unsent - письма, которые сервер не подтвердил.
+    """
+
+    def __init__(self, unsent):
+        super().__init__('Mail delivery interrupted')
+        self.unsent = unsent
+
+
+class Mailer:
+    """
+    Постоянное соединение с почтовым сервером и отправка пачками.
+    """
+
+    def __init__(self, batch_size, retries, connection_factory=get_connection):
+        self.batch_size = batch_size
+        self.retries = retries
+        self.connection_factory = connection_factory
+        self.connection = None
+        self.connections_opened = 0
+        self.lock = threading.Lock()
+
+    def open(self):
+        if self.connection is None:
+            connection = self.connection_factory(fail_silently=False)
+            connection.open()
+            self.connection = connection
+            self.connections_opened += 1
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.connection = None
+
+    def send(self, messages, rejected=None):
+        """
+        Отправляет письма через одно соединение, возвращает число
+        отправленных. Отклоненные сервером письма пропускаются и
+        добавляются в список rejected.
+        """
+        messages = list(messages)
+        sent = index = failures = 0
+        with self.lock:
+            while index < len(messages):
+                try:
+                    sent += self.open().send_messages([messages[index]]) or 0
+                except REJECTED_ERRORS:
+                    if rejected is not None:
+                        rejected.append(messages[index])
+                except (smtplib.SMTPException, OSError) as error:
+                    self.close()
+                    failures += 1
+                    if failures > self.retries:
+                        raise DeliveryInterrupted(messages[index:]) from error
+                    continue
+                index += 1
+                failures = 0
+        return sent
+
+
+@lru_cache(maxsize=None)
+def get_mailer():
+    return Mailer(settings.MAIL_BATCH_SIZE, settings.MAIL_RETRIES)
+
+
+def build_message(subject, message, from_email, to_email):
+    return EmailMultiAlternatives(subject, message, from_email, [to_email])
+
+
+class MemoryMailQueue:
+    """
+    Очередь писем в памяти процесса: для тестов.
+    """
+
+    def __init__(self):
+        self.items = []
+        self.dead = []
+        self.lock = threading.Lock()
+
+    def push(self, items):
+        with self.lock:
+            self.items.extend(items)
+
+    def push_front(self, items):
+        with self.lock:
+            self.items[:0] = items
+
+    def push_dead(self, items):
+        with self.lock:
+            self.dead.extend(items)
+
+    def pop(self, count):
+        with self.lock:
+            items, self.items = self.items[:count], self.items[count:]
+            return items
+
+
+class RedisMailQueue:
+    def __init__(self, url):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+
+    def push(self, items):
+        self.client.rpush(OUTBOX_KEY, *[json.dumps(item) for item in items])
+
+    def push_front(self, items):
+        if items:
+            self.client.lpush(OUTBOX_KEY, *[json.dumps(item) for item in reversed(items)])
+
+    def push_dead(self, items):
+        if items:
+            self.client.rpush(DEAD_KEY, *[json.dumps(item) for item in items])
+
+    def pop(self, count):
+        return [json.loads(item) for item in self.client.lpop(OUTBOX_KEY, count) or []]
+
+
+@lru_cache(maxsize=None)
+def get_mail_queue():
+    if settings.MAIL_REDIS_URL:
+        return RedisMailQueue(settings.MAIL_REDIS_URL)
+    return None
+
+
+def queue_email(subject, message, from_email, to_email):
+    """
+    Ставит письмо в очередь на отправку.
+    """
+    from .tasks import deliver_mail, send_email
+
+    queue = get_mail_queue()
+    if queue is None:
+        send_email.delay(subject, message, from_email, to_email)
+        return
+    queue.push([{'subject': subject, 'message': message, 'from_email': from_email, 'to_email': to_email}])
+    # Одна задача на все письма, поставленные за MAIL_DELIVER_DELAY секунд. Флаг живет
+    # дольше задержки, чтобы при потерянной задаче следующее письмо запланировало новую
+    if cache.add(SCHEDULED_KEY, True, timeout=settings.MAIL_DELIVER_DELAY * 10):
+        deliver_mail.apply_async(countdown=settings.MAIL_DELIVER_DELAY)
+
+
+def deliver_queued(queue=None, mailer=None):
+    """
+    Отправляет все письма из очереди пачками. Письма, которые не удалось
+    отправить из-за соединения, возвращаются в начало очереди, отклоненные
+    сервером - переносятся в очередь недоставленных.
+    """
+    queue = get_mail_queue() if queue is None else queue
+    mailer = get_mailer() if mailer is None else mailer
+    if queue is None:
+        return 0
+    # Письма, поставленные после этого момента, запланируют новую отправку
+    cache.delete(SCHEDULED_KEY)
+    sent = 0
+    while True:
+        items = queue.pop(mailer.batch_size)
+        if not items:
+            return sent
+        messages = [build_message(**item) for item in items]
+        rejected = []
+        try:
+            sent += mailer.send(messages, rejected)
+        except DeliveryInterrupted as error:
+            queue.push_front(items[len(items) - len(error.unsent):])
+            raise
+        finally:
+            rejected_ids = {id(message) for message in rejected}
+            queue.push_dead([item for item, message in zip(items, messages) if id(message) in rejected_ids])
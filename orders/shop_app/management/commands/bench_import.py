@@ -0,0 +1,87 @@
+import time
+
+from django.db import connection, transaction
+from django.core.management.base import BaseCommand
+
+from shop_app.importer import PriceListImporter
+from shop_app.models import Shop, Category, Product, ProductInfo, Parameter, ProductParameter
+
+PARAMETERS = ['Диагональ (дюйм)', 'Разрешение (пикс)', 'Встроенная память (Гб)', 'Цвет']
+
+
+def synthetic_price_list(items, categories=20):
+    """
+    Генерирует прайс-лист в формате data/shop1.yaml.
+    """
+    return {
+        'shop': 'Benchmark shop',
+        'categories': [{'id': 900000 + i, 'name': f'Категория {i}'} for i in range(categories)],
+        'goods': [{
+            'id': i,
+            'category': 900000 + i % categories,
+            'model': f'vendor/model-{i % 1000}',
+            'name': f'Товар {i}',
+            'price': 1000 + i % 500,
+            'price_rrc': 1200 + i % 500,
+            'quantity': i % 50,
+            'parameters': {name: f'{name} {i % 7}' for name in PARAMETERS},
+        } for i in range(items)],
+    }
+
+
+def naive_import(price_list):
+    """
+    Построчный импорт в стиле reference PartnerUpdate для сравнения.
+    """
+    shop, _ = Shop.objects.get_or_create(name=price_list['shop'])
+    for category in price_list['categories']:
+        category_object, _ = Category.objects.get_or_create(id=category['id'], name=category['name'])
+        category_object.shops.add(shop.id)
+    ProductInfo.objects.filter(shop_id=shop.id).delete()
+    for item in price_list['goods']:
+        product, _ = Product.objects.get_or_create(name=item['name'], category_id=item['category'])
+        product_info = ProductInfo.objects.create(product_id=product.id, external_id=item['id'],
+                                                  model=item['model'], price=item['price'],
+                                                  price_rrc=item['price_rrc'], quantity=item['quantity'],
+                                                  shop_id=shop.id)
+        for name, value in item['parameters'].items():
+            parameter, _ = Parameter.objects.get_or_create(name=name)
+            ProductParameter.objects.create(product_info_id=product_info.id, parameter_id=parameter.id,
+                                            value=value)
+
+
+class Command(BaseCommand):
+    help = 'Замеряет число запросов и время импорта синтетического прайс-листа (изменения откатываются)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=100000)
+        parser.add_argument('--naive-items', type=int, default=0,
+                            help='Размер прайс-листа для построчного импорта (0 - не запускать)')
+
+    def measure(self, label, items, func):
+        queries = 0
+
+        def count_queries(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_queries):
+            started = time.monotonic()
+            func()
+            elapsed = time.monotonic() - started
+        self.stdout.write(f'{label}: items={items} queries={queries} '
+                          f'time={elapsed:.2f}s rate={items / elapsed:.0f} items/s')
+
+    def handle(self, *args, **options):
+        items = options['items']
+        price_list = synthetic_price_list(items)
+        with transaction.atomic():
+            self.measure('bulk import', items, lambda: PriceListImporter().run(price_list))
+            self.measure('bulk re-import', items, lambda: PriceListImporter().run(price_list))
+            transaction.set_rollback(True)
+        if options['naive_items']:
+            naive = synthetic_price_list(options['naive_items'])
+            with transaction.atomic():
+                self.measure('naive import', options['naive_items'], lambda: naive_import(naive))
+                transaction.set_rollback(True)
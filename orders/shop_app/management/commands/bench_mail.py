@@ -0,0 +1,116 @@
+import socketserver
+import threading
+import time
+
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+
+from shop_app.mailer import Mailer, build_message
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Минимальный SMTP-сервер: принимает письма и считает их. Задержка
+    handshake_delay имитирует установку TLS-соединения, max_messages -
+    обрыв соединения сервером после указанного числа писем, rejected -
+    адреса получателей, которые сервер отклоняет.
+    """
+
+    def reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode('ascii'))
+
+    def handle(self):
+        time.sleep(self.server.handshake_delay)
+        self.server.connections += 1
+        received = 0
+        self.reply('220 localhost ESMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in (b'EHLO', b'HELO'):
+                self.reply('250 localhost')
+            elif command == b'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                self.server.messages += 1
+                received += 1
+                self.reply('250 OK')
+                if self.server.max_messages and received >= self.server.max_messages:
+                    return
+            elif command == b'RCPT' and any(f'<{address}>'.encode('ascii') in line
+                                            for address in self.server.rejected):
+                self.reply('550 No such user')
+            elif command == b'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+
+class LocalSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handshake_delay=0, max_messages=0, rejected=()):
+        super().__init__(('127.0.0.1', 0), SMTPHandler)
+        self.handshake_delay = handshake_delay
+        self.max_messages = max_messages
+        self.rejected = rejected
+        self.connections = 0
+        self.messages = 0
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+    def connection_factory(self):
+        host, port = self.server_address
+
+        def factory(**kwargs):
+            return get_connection('django.core.mail.backends.smtp.EmailBackend', host=host, port=port,
+                                  username='', password='', use_tls=False, use_ssl=False, timeout=10, **kwargs)
+        return factory
+
+
+class Command(BaseCommand):
+    help = 'Замеряет скорость отправки писем на локальный SMTP-сервер: по соединению на письмо и пачками'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000)
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--handshake-ms', type=float, default=20,
+                            help='Задержка установки соединения на сервере (TLS), мс')
+
+    def measure(self, label, messages, server, func):
+        connections, received = server.connections, server.messages
+        started = time.monotonic()
+        func()
+        elapsed = time.monotonic() - started
+        self.stdout.write(f'{label}: messages={messages} connections={server.connections - connections} '
+                          f'received={server.messages - received} time={elapsed:.2f}s '
+                          f'rate={messages / elapsed:.0f} msg/s')
+
+    def handle(self, *args, **options):
+        count = options['messages']
+        messages = [build_message('Обновление статуса заказа', f'Заказ №{i}', 'shop@example.com',
+                                  f'buyer{i}@example.com') for i in range(count)]
+        with LocalSMTPServer(handshake_delay=options['handshake_ms'] / 1000) as server:
+            factory = server.connection_factory()
+
+            def per_message():
+                for message in messages:
+                    message.connection = factory()
+                    message.send()
+                    message.connection = None
+
+            mailer = Mailer(options['batch_size'], retries=2, connection_factory=factory)
+            self.measure('connection per message', count, server, per_message)
+            self.measure('batched mailer', count, server, lambda: mailer.send(messages))
+            mailer.close()
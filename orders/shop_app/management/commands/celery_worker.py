@@ -0,0 +1,14 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from orders.celery import app, worker_argv
+
+
+class Command(BaseCommand):
+    help = 'Запускает воркер Celery для одной очереди с параметрами из CELERY_QUEUE_WORKERS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('queue', choices=list(settings.CELERY_QUEUE_WORKERS))
+
+    def handle(self, *args, **options):
+        app.worker_main(worker_argv(options['queue']))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from shop_app.exporter import EXPORT_FORMATS
+from shop_app.models import Shop
+
+
+class Command(BaseCommand):
+    help = 'Выгружает каталог магазина в YAML, JSON Lines или CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('shop_id', type=int)
+        parser.add_argument('--type', choices=sorted(EXPORT_FORMATS), default='yaml')
+        parser.add_argument('--output', help='Путь к файлу (по умолчанию stdout)')
+
+    def handle(self, *args, **options):
+        shop = Shop.objects.filter(id=options['shop_id']).first()
+        if shop is None:
+            raise CommandError(f'Магазин {options["shop_id"]} не найден')
+        export, _ = EXPORT_FORMATS[options['type']]
+        if not options['output']:
+            for chunk in export(shop):
+                self.stdout.write(chunk, ending='')
+            return
+        with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+            for chunk in export(shop):
+                output.write(chunk)
@@ -0,0 +1,26 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shop_app.importer import IMPORTERS
+from shop_app.orchestrator import collect_sources, run_imports
+
+
+class Command(BaseCommand):
+    help = 'Параллельно импортирует прайс-листы нескольких магазинов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', nargs='?', help='Каталог с файлами shop*.yaml')
+        parser.add_argument('--pattern', default='shop*.yaml')
+        parser.add_argument('--shops', action='store_true', help='Импортировать загруженные файлы магазинов')
+        parser.add_argument('--workers', type=int, default=1, help='Число локальных процессов')
+        parser.add_argument('--celery', action='store_true', help='Выполнить импорты группой задач Celery')
+        parser.add_argument('--mode', choices=sorted(IMPORTERS), default='full')
+
+    def handle(self, *args, **options):
+        sources = collect_sources(options['directory'], options['pattern'], options['shops'])
+        if not sources:
+            raise CommandError('Не найдено ни одного прайс-листа')
+        summary = run_imports(sources, workers=options['workers'], mode=options['mode'],
+                              use_celery=options['celery'])
+        self.stdout.write(json.dumps(summary, ensure_ascii=False, indent=2))
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from shop_app.importer import PriceListError, IMPORTERS
+from shop_app.models import User, Shop
+from shop_app.sources import import_path, import_shop_file
+
+
+class Command(BaseCommand):
+    help = 'Импортирует прайс-лист поставщика из YAML-файла или из загруженного файла магазина'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', help='Путь к YAML-файлу')
+        parser.add_argument('--user', help='Email пользователя-владельца магазина')
+        parser.add_argument('--shop', type=int, help='Id магазина, прайс-лист берется из Shop.filename')
+        parser.add_argument('--force', action='store_true',
+                            help='Импортировать файл магазина, даже если он не изменился')
+        parser.add_argument('--mode', choices=sorted(IMPORTERS), default='full',
+                            help='diff - применить только изменения относительно текущего каталога, '
+                                 'copy - загрузка через COPY (только PostgreSQL)')
+
+    def handle(self, *args, **options):
+        if bool(options['path']) == bool(options['shop']):
+            raise CommandError('Укажите путь к файлу или --shop')
+        try:
+            if options['shop']:
+                shop = Shop.objects.select_related('user').filter(id=options['shop']).exclude(filename='').first()
+                if shop is None:
+                    raise CommandError(f'Магазин {options["shop"]} с загруженным прайс-листом не найден')
+                stats = import_shop_file(shop, mode=options['mode'], force=options['force'])
+            else:
+                user = None
+                if options['user']:
+                    user = User.objects.filter(email=options['user']).first()
+                    if user is None:
+                        raise CommandError(f'Пользователь {options["user"]} не найден')
+                stats = import_path(options['path'], user=user, mode=options['mode'])
+        except (OSError, PriceListError) as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(str(stats.as_dict())))
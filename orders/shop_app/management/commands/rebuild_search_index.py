@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from shop_app.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Пересоздает поисковый индекс товаров'
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        backend.ensure_index()
+        count = backend.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Проиндексировано товаров: {count}'))
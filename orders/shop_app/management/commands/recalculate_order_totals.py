@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from shop_app.totals import recalculate_totals
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает итоги заказов (сумма, количество товаров, итоги по магазинам)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--order', type=int, nargs='+', dest='orders', help='Id заказов, по умолчанию все')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Число заказов в одной пачке')
+
+    def handle(self, *args, **options):
+        count = recalculate_totals(options['orders'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Пересчитаны итоги заказов: {count}'))
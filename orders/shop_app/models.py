@@ -1,6 +1,7 @@
 from django.contrib.auth.base_user import BaseUserManager
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth.validators import UnicodeUsernameValidator
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 from django.utils.translation import gettext_lazy as _
 from django_rest_passwordreset.tokens import get_token_generator
@@ -15,12 +16,30 @@ STATE_CHOICES = (
     ('canceled', 'Отменен'),
 )
 
+IMPORT_STATE_CHOICES = (
+    ('pending', 'В очереди'),
+    ('running', 'Выполняется'),
+    ('done', 'Завершен'),
+    ('failed', 'Ошибка'),
+)
+
+IMPORT_MODE_CHOICES = (
+    ('full', 'Полный'),
+    ('diff', 'Только изменения'),
+    ('copy', 'COPY через временные таблицы (PostgreSQL)'),
+)
+
 USER_TYPE_CHOICES = (
     ('shop', 'Магазин'),
     ('buyer', 'Покупатель'),
 
 )
 
+NOTIFICATION_CHOICES = (
+    ('instant', 'Письмо на каждое изменение'),
+    ('digest', 'Сводка изменений'),
+)
+
 
 class UserManager(BaseUserManager):
     """
@@ -85,6 +104,8 @@ class User(AbstractUser):
         ),
     )
     type = models.CharField(verbose_name='Тип пользователя', choices=USER_TYPE_CHOICES, max_length=5, default='buyer')
+    notifications = models.CharField(verbose_name='Уведомления о заказах', choices=NOTIFICATION_CHOICES,
+                                     max_length=10, default='instant')
 
     def __str__(self):
         return f'{self.first_name} {self.last_name}'
@@ -103,6 +124,12 @@ class Shop(models.Model):
     state = models.BooleanField(verbose_name='статус получения заказов', default=True)
 
     filename = models.FileField()
+    feed_etag = models.CharField(max_length=255, verbose_name='ETag прайс-листа', blank=True)
+    feed_last_modified = models.CharField(max_length=64, verbose_name='Last-Modified прайс-листа', blank=True)
+    feed_hash = models.CharField(max_length=64, verbose_name='Хэш прайс-листа', blank=True)
+    delivery_cost = models.PositiveIntegerField(verbose_name='Стоимость доставки', default=0)
+    free_delivery_from = models.PositiveIntegerField(verbose_name='Бесплатная доставка от суммы',
+                                                     null=True, blank=True)
 
     class Meta:
         verbose_name = 'Магазин'
@@ -112,6 +139,14 @@ class Shop(models.Model):
     def __str__(self):
         return self.name
 
+    def get_delivery_cost(self, total_sum):
+        """
+        Стоимость доставки части заказа на сумму total_sum.
+        """
+        if self.free_delivery_from is not None and total_sum >= self.free_delivery_from:
+            return 0
+        return self.delivery_cost
+
 
 class Category(models.Model):
     name = models.CharField(max_length=40, verbose_name='Название')
@@ -135,6 +170,12 @@ class Product(models.Model):
         verbose_name = 'Продукт'
         verbose_name_plural = "Список продуктов"
         ordering = ('-name',)
+        indexes = [
+            models.Index(fields=['name', 'id'], name='product_name_id'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['name', 'category'], name='unique_product_name_category'),
+        ]
 
     def __str__(self):
         return self.name
@@ -166,6 +207,9 @@ class Parameter(models.Model):
         verbose_name = 'Имя параметра'
         verbose_name_plural = "Список имен параметров"
         ordering = ('-name',)
+        constraints = [
+            models.UniqueConstraint(fields=['name'], name='unique_parameter_name'),
+        ]
 
     def __str__(self):
         return self.name
@@ -217,18 +261,49 @@ class Order(models.Model):
     contact = models.ForeignKey(Contact, verbose_name='Контакт',
                                 blank=True, null=True,
                                 on_delete=models.CASCADE)
+    # Итоги хранятся в заказе и обновляются при изменении позиций (shop_app.totals)
+    total_sum = models.PositiveIntegerField(verbose_name='Сумма', default=0)
+    items_count = models.PositiveIntegerField(verbose_name='Количество товаров', default=0)
+    delivery_cost = models.PositiveIntegerField(verbose_name='Стоимость доставки', default=0)
 
     class Meta:
         verbose_name = 'Заказ'
         verbose_name_plural = "Список заказ"
         ordering = ('-dt',)
+        indexes = [
+            models.Index(fields=['user', '-dt', '-id'], name='order_user_dt'),
+            models.Index(fields=['user', 'state', '-dt', '-id'], name='order_user_state_dt'),
+        ]
 
     def __str__(self):
         return str(self.dt)
 
-    # @property
-    # def sum(self):
-    #     return self.ordered_items.aggregate(total=Sum("quantity"))["total"]
+
+class ShopOrder(models.Model):
+    """
+    Часть заказа, относящаяся к одному магазину (поставщику): промежуточные
+    итоги, стоимость доставки и статус. Статус дублирует статус заказа,
+    чтобы список заказов поставщика выбирался по индексу без соединения
+    с Order.
+    """
+    order = models.ForeignKey(Order, verbose_name='Заказ', related_name='shop_orders',
+                              on_delete=models.CASCADE)
+    shop = models.ForeignKey(Shop, verbose_name='Магазин', related_name='shop_orders',
+                             on_delete=models.CASCADE)
+    state = models.CharField(verbose_name='Статус', choices=STATE_CHOICES, max_length=15, default='basket')
+    total_sum = models.PositiveIntegerField(verbose_name='Сумма', default=0)
+    items_count = models.PositiveIntegerField(verbose_name='Количество товаров', default=0)
+    delivery_cost = models.PositiveIntegerField(verbose_name='Стоимость доставки', default=0)
+
+    class Meta:
+        verbose_name = 'Заказ магазина'
+        verbose_name_plural = "Список заказов магазинов"
+        constraints = [
+            models.UniqueConstraint(fields=['order', 'shop'], name='unique_shop_order'),
+        ]
+        indexes = [
+            models.Index(fields=['shop', 'state', '-order'], name='shop_order_shop_state'),
+        ]
 
 
 class OrderItem(models.Model):
@@ -239,6 +314,8 @@ class OrderItem(models.Model):
                                      blank=True,
                                      on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(verbose_name='Количество')
+    # Цена за единицу на момент добавления позиции: по ней считаются итоги заказа
+    price = models.PositiveIntegerField(verbose_name='Цена')
 
     class Meta:
         verbose_name = 'Заказанная позиция'
@@ -247,6 +324,11 @@ class OrderItem(models.Model):
             models.UniqueConstraint(fields=['order_id', 'product_info'], name='unique_order_item'),
         ]
 
+    def save(self, *args, **kwargs):
+        if self.price is None:
+            self.price = ProductInfo.objects.values_list('price', flat=True).get(id=self.product_info_id)
+        super().save(*args, **kwargs)
+
 
 class ConfirmEmailToken(models.Model):
     class Meta:
@@ -284,4 +366,106 @@ class ConfirmEmailToken(models.Model):
         return super(ConfirmEmailToken, self).save(*args, **kwargs)
 
     def __str__(self):
-        return "Password reset token for user {user}".format(user=self.user)
\ No newline at end of file
+        return "Password reset token for user {user}".format(user=self.user)
+
+
+class ImportJob(models.Model):
+    """
+    Фоновый импорт прайс-листа поставщика
+    """
+    user = models.ForeignKey(User, verbose_name='Пользователь', related_name='import_jobs',
+                             on_delete=models.CASCADE)
+    shop = models.ForeignKey(Shop, verbose_name='Магазин', related_name='import_jobs', blank=True, null=True,
+                             on_delete=models.SET_NULL)
+    url = models.URLField(verbose_name='Ссылка на прайс-лист')
+    mode = models.CharField(verbose_name='Режим', choices=IMPORT_MODE_CHOICES, max_length=10, default='full')
+    state = models.CharField(verbose_name='Статус', choices=IMPORT_STATE_CHOICES, max_length=10, default='pending')
+    items = models.PositiveIntegerField(verbose_name='Обработано позиций', default=0)
+    stats = models.JSONField(verbose_name='Статистика', default=dict, blank=True)
+    errors = models.JSONField(verbose_name='Ошибки', default=list, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        verbose_name = 'Импорт прайс-листа'
+        verbose_name_plural = 'Список импортов прайс-листов'
+        ordering = ('-created_at',)
+
+    def __str__(self):
+        return f'{self.url} ({self.state})'
+
+    @property
+    def progress_key(self):
+        return f'import-job:{self.id}'
+
+
+class OrderStateChange(models.Model):
+    """
+    Журнал смены статусов заказов: одна запись на массовую операцию.
+    """
+    user = models.ForeignKey(User, verbose_name='Пользователь', related_name='order_state_changes',
+                             blank=True, null=True, on_delete=models.SET_NULL)
+    shop = models.ForeignKey(Shop, verbose_name='Магазин', related_name='order_state_changes',
+                             blank=True, null=True, on_delete=models.SET_NULL)
+    state = models.CharField(verbose_name='Статус', choices=STATE_CHOICES, max_length=15)
+    # Заказы, статус которых изменился: о них уведомляются покупатели
+    orders = models.JSONField(verbose_name='Измененные заказы', default=list, blank=True)
+    shop_orders = models.JSONField(verbose_name='Измененные части заказов', default=list, blank=True)
+    requested = models.PositiveIntegerField(verbose_name='Запрошено заказов', default=0)
+    dt = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Смена статуса заказов'
+        verbose_name_plural = 'Журнал смены статусов заказов'
+        ordering = ('-dt',)
+
+    def __str__(self):
+        return f'{self.state}: {len(self.orders)}'
+
+
+class IdempotencyKey(models.Model):
+    """
+    Ответ на запрос с заголовком Idempotency-Key. Повторы запроса с тем же
+    ключом получают сохраненный ответ; пока ответа нет (status_code пуст),
+    запрос с этим ключом выполняется.
+    """
+    user = models.ForeignKey(User, verbose_name='Пользователь', related_name='idempotency_keys',
+                             on_delete=models.CASCADE)
+    key = models.CharField(verbose_name='Ключ', max_length=255)
+    fingerprint = models.CharField(verbose_name='Отпечаток запроса', max_length=64)
+    status_code = models.PositiveSmallIntegerField(verbose_name='Код ответа', blank=True, null=True)
+    response = models.JSONField(verbose_name='Ответ', encoder=DjangoJSONEncoder, blank=True, null=True)
+    expires_at = models.DateTimeField(verbose_name='Хранится до', db_index=True)
+    # Если ответа нет и к этому времени, выполнявший запрос процесс считается
+    # упавшим, и повтор может выполнить запрос заново
+    locked_until = models.DateTimeField(verbose_name='Выполняется до')
+
+    class Meta:
+        verbose_name = 'Ключ идемпотентности'
+        verbose_name_plural = 'Список ключей идемпотентности'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='unique_idempotency_key'),
+        ]
+
+    def __str__(self):
+        return self.key
+
+
+class OrderStatusEvent(models.Model):
+    """
+    Смена статуса заказа, ожидающая отправки в сводке покупателю
+    (notifications = digest).
+    """
+    user = models.ForeignKey(User, verbose_name='Пользователь', related_name='order_status_events',
+                             on_delete=models.CASCADE)
+    order = models.ForeignKey(Order, verbose_name='Заказ', related_name='status_events', on_delete=models.CASCADE)
+    state = models.CharField(verbose_name='Статус', choices=STATE_CHOICES, max_length=15)
+    dt = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Событие заказа для сводки'
+        verbose_name_plural = 'Список событий заказов для сводки'
+
+    def __str__(self):
+        return f'{self.order_id}: {self.state}'
@@ -0,0 +1,70 @@
+"""
+Уведомления покупателей о смене статуса заказов.
+
+Покупателю с notifications = instant письмо уходит при каждом изменении
+(при массовой смене статуса - одно письмо на всю операцию). Для
+notifications = digest изменения копятся в OrderStatusEvent, и
+периодическая задача send_digests раз в NOTIFICATION_DIGEST_INTERVAL
+секунд отправляет каждому такому покупателю одно письмо со всеми
+изменениями за это время.
+"""
+from django.conf import settings
+
+from .mailer import build_message, get_mailer
+from .models import Order, OrderStatusEvent, STATE_CHOICES
+
+SUBJECT = "Обновление статуса заказа"
+DIGEST_SUBJECT = "Обновление статуса заказов"
+
+
+def state_message(order_ids, state):
+    return f"Статус заказов {', '.join(f'№{order_id}' for order_id in order_ids)}: {dict(STATE_CHOICES)[state]}"
+
+
+def digest_message(order_states):
+    """
+    Текст сводки по {id заказа: последний статус}.
+    """
+    lines = [f'Заказ №{order_id}: {dict(STATE_CHOICES)[state]}' for order_id, state in order_states.items()]
+    return 'Изменения статусов заказов:\n' + '\n'.join(lines)
+
+
+def notify_orders(order_ids, state):
+    """
+    Уведомляет покупателей о переходе заказов в статус state. Возвращает
+    число отправленных писем; изменения для сводок только записываются.
+    """
+    instant, events = {}, []
+    for order_id, user_id, email, mode in Order.objects.filter(id__in=list(order_ids)).order_by('id').values_list(
+            'id', 'user_id', 'user__email', 'user__notifications'):
+        if mode == 'digest':
+            events.append(OrderStatusEvent(user_id=user_id, order_id=order_id, state=state))
+        else:
+            instant.setdefault(email, []).append(order_id)
+    OrderStatusEvent.objects.bulk_create(events, batch_size=settings.NOTIFICATION_DIGEST_BATCH_SIZE)
+    return get_mailer().send([build_message(SUBJECT, state_message(ids, state), settings.EMAIL_HOST_USER, email)
+                              for email, ids in instant.items()])
+
+
+def send_digests():
+    """
+    Отправляет сводки по накопленным изменениям и удаляет отправленные
+    изменения. Возвращает число отправленных писем.
+    """
+    batch_size = settings.NOTIFICATION_DIGEST_BATCH_SIZE
+    sent = 0
+    while True:
+        events = list(OrderStatusEvent.objects.order_by('id').values_list('id', 'user__email', 'order_id', 'state')
+                      [:batch_size])
+        if not events:
+            return sent
+        digests = {}
+        for _, email, order_id, state in events:
+            digests.setdefault(email, {})[order_id] = state
+        sent += get_mailer().send([build_message(DIGEST_SUBJECT, digest_message(order_states),
+                                                 settings.EMAIL_HOST_USER, email)
+                                   for email, order_states in digests.items()])
+        # Удаляем по id: изменения, записанные во время отправки, попадут в следующую сводку
+        OrderStatusEvent.objects.filter(id__in=[event_id for event_id, *_ in events]).delete()
+        if len(events) < batch_size:
+            return sent
@@ -0,0 +1,120 @@
+"""
+Параллельный импорт прайс-листов нескольких магазинов.
+
+Категории всех прайс-листов создаются один раз до запуска импортов: они
+читаются из заголовков файлов, позиции при этом не разбираются. Затем
+каждый прайс-лист импортируется отдельно: в группе задач Celery или в
+пуле локальных процессов. Товары и параметры создают сами импорты,
+совпадения с параллельными импортами разрешают уникальные ограничения.
+"""
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from django.db import DatabaseError, connections, transaction
+
+from .feeds import PriceListError, stream_price_list
+from .models import Shop, Category
+from .sources import import_path, import_shop_file, open_path, open_shop_file
+
+
+def collect_sources(directory=None, pattern='shop*.yaml', shops=False):
+    """
+    Источники прайс-листов: файлы каталога и/или загруженные файлы магазинов (Shop.filename).
+    """
+    sources = []
+    if directory:
+        sources.extend({'path': str(path)} for path in sorted(Path(directory).glob(pattern)))
+    if shops:
+        sources.extend({'shop_id': shop_id} for shop_id in
+                       Shop.objects.exclude(filename='').order_by('id').values_list('id', flat=True))
+    return sources
+
+
+def open_source(source):
+    """
+    Возвращает файл прайс-листа (контекстный менеджер) и владельца магазина.
+    """
+    if 'shop_id' in source:
+        shop = Shop.objects.select_related('user').get(id=source['shop_id'])
+        return open_shop_file(shop), shop.user
+    return open_path(source['path']), None
+
+
+def source_label(source):
+    return source.get('path') or f'shop:{source["shop_id"]}'
+
+
+def prepare_dimensions(sources, batch_size=1000):
+    """
+    Создает недостающие категории всех прайс-листов одним проходом.
+    """
+    categories = {}
+    for source in sources:
+        try:
+            source_file, _ = open_source(source)
+            with source_file as stream:
+                for category in stream_price_list(stream).get('categories') or []:
+                    categories[category['id']] = str(category['name'])
+        except (OSError, PriceListError, Shop.DoesNotExist):
+            # Ошибка попадет в сводку при импорте этого источника
+            continue
+
+    Category.objects.bulk_create([Category(id=category_id, name=name) for category_id, name in categories.items()],
+                                 batch_size=batch_size, ignore_conflicts=True)
+    return {'categories': len(categories)}
+
+
+def import_source(source, mode='full'):
+    """
+    Импорт одного прайс-листа, возвращает сводку для отчета.
+    """
+    started = time.monotonic()
+    summary = {'source': source_label(source), 'shop_id': None, 'items': 0, 'duration': None, 'error': None}
+    try:
+        # Ошибка БД откатывает только этот источник, остальные импортируются дальше
+        with transaction.atomic():
+            if 'shop_id' in source:
+                stats = import_shop_file(Shop.objects.select_related('user').get(id=source['shop_id']), mode=mode)
+            else:
+                stats = import_path(source['path'], mode=mode)
+    except (OSError, PriceListError, Shop.DoesNotExist, DatabaseError) as e:
+        summary['error'] = str(e)
+    else:
+        summary.update(shop_id=stats.shop_id, items=stats.items, created=stats.created, updated=stats.updated,
+                       deleted=stats.deleted, skipped=stats.skipped)
+    summary['duration'] = round(time.monotonic() - started, 3)
+    return summary
+
+
+def run_imports(sources, workers=1, mode='full', use_celery=False):
+    """
+    Импортирует прайс-листы параллельно и возвращает общую сводку с временем по каждому магазину.
+    """
+    started = time.monotonic()
+    dimensions = prepare_dimensions(sources)
+
+    if use_celery:
+        from celery import group
+        from .tasks import import_feed
+
+        results = group(import_feed.s(source, mode) for source in sources).apply_async().get()
+    elif workers > 1:
+        # Дочерние процессы не должны наследовать открытые соединения с БД
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(import_source, sources, [mode] * len(sources)))
+    else:
+        results = [import_source(source, mode) for source in sources]
+
+    duration = time.monotonic() - started
+    items = sum(result['items'] for result in results)
+    return {
+        'feeds': len(sources),
+        'workers': workers,
+        'items': items,
+        'duration': round(duration, 3),
+        'rows_per_sec': round(items / duration, 1) if duration else None,
+        'dimensions': dimensions,
+        'shops': sorted(results, key=lambda result: result['source']),
+    }
@@ -0,0 +1,141 @@
+"""
+Курсорная (keyset) пагинация списков.
+
+Курсор хранит значения ключа сортировки последней записи страницы, и
+следующая страница выбирается условием "после этого ключа" вместо OFFSET,
+поэтому глубокие страницы стоят столько же, сколько первая. Последнее
+поле сортировки должно быть уникальным (обычно id), а вся сортировка -
+покрыта индексом.
+"""
+import base64
+import json
+from functools import reduce
+from operator import or_
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+from .search import search_products
+
+
+class KeysetPagination(BasePagination):
+    ordering = ('id',)
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        queryset = queryset.order_by(*self.ordering)
+        position = self.decode_cursor(request, queryset.model)
+        if position is not None:
+            queryset = queryset.filter(self.after(position))
+        page = list(queryset[:page_size + 1])
+        self.next_position = None
+        if len(page) > page_size:
+            page = page[:page_size]
+            self.next_position = [getattr(page[-1], field.lstrip('-')) for field in self.ordering]
+        return page
+
+    def after(self, position):
+        """
+        Условие "ключ сортировки после position" для составного ключа.
+        """
+        conditions = []
+        for index, field in enumerate(self.ordering):
+            name = field.lstrip('-')
+            lookup = f'{name}__lt' if field.startswith('-') else f'{name}__gt'
+            equal = {ordering.lstrip('-'): position[number] for number, ordering in enumerate(self.ordering[:index])}
+            conditions.append(Q(**equal, **{lookup: position[index]}))
+        return reduce(or_, conditions)
+
+    def encode_cursor(self, position):
+        data = json.dumps([value.isoformat() if hasattr(value, 'isoformat') else value for value in position])
+        return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, request, model):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+            if len(values) != len(self.ordering):
+                raise ValueError
+            return [self.to_python(model, field.lstrip('-'), value) for field, value in zip(self.ordering, values)]
+        except (TypeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def to_python(self, model, field, value):
+        return model._meta.get_field(field).to_python(value)
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param,
+                                   self.encode_cursor(self.next_position))
+
+    def get_paginated_response(self, data):
+        return Response({'next': self.get_next_link(), 'results': data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+class ProductPagination(KeysetPagination):
+    ordering = ('name', 'id')
+
+
+class OrderPagination(KeysetPagination):
+    ordering = ('-dt', '-id')
+
+
+class ShopOrderPagination(KeysetPagination):
+    ordering = ('-order_id',)
+
+
+class ContactPagination(KeysetPagination):
+    ordering = ('id',)
+
+
+class SearchPagination(KeysetPagination):
+    """
+    Результаты полнотекстового поиска: ключ - релевантность и id товара.
+    """
+    ordering = ('-search_rank', 'id')
+
+    def paginate_search(self, query, request):
+        self.request = request
+        page_size = self.get_page_size(request)
+        page = search_products(query, limit=page_size + 1, after=self.decode_cursor(request, None))
+        self.next_position = None
+        if len(page) > page_size:
+            page = page[:page_size]
+            self.next_position = [page[-1].search_rank, page[-1].id]
+        return page
+
+    def to_python(self, model, field, value):
+        if field == 'search_rank':
+            return float(value)
+        return int(value)
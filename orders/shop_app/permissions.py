@@ -5,4 +5,11 @@ class IsShop(permissions.BasePermission):
     Пользовательское разрешение, чтобы проверить, является ли пользователь магазином
     """
     def has_permission(self, request, view):
-        return request.user.type == 'shop'
\ No newline at end of file
+        return request.user.type == 'shop'
+
+class IsStaffOrShop(permissions.BasePermission):
+    """
+    Разрешение для администраторов и магазинов
+    """
+    def has_permission(self, request, view):
+        return request.user.is_staff or request.user.type == 'shop'
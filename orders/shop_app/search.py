@@ -0,0 +1,254 @@
+"""
+Полнотекстовый поиск товаров.
+
+Индекс хранится в отдельной денормализованной таблице: по одной строке на
+товар с названием товара, моделями из всех его ProductInfo и названием
+категории. Для PostgreSQL используются tsvector с GIN-индексом и триграммы
+(pg_trgm), для SQLite - виртуальная таблица FTS5, для остальных СУБД -
+поиск через icontains без ранжирования.
+"""
+import re
+
+from django.conf import settings
+from django.db import connection
+
+from .models import Product, ProductInfo
+
+INDEX_TABLE = 'shop_app_product_search'
+INDEX_CHUNK_SIZE = 1000
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _collect_documents(product_ids):
+    """
+    Собирает документы индекса (id, название, модели, категория) для товаров.
+    """
+    products = Product.objects.filter(id__in=product_ids).values_list('id', 'name', 'category__name')
+    models = {}
+    for product_id, model in ProductInfo.objects.filter(product_id__in=product_ids) \
+            .exclude(model='').values_list('product_id', 'model').distinct():
+        models.setdefault(product_id, []).append(model)
+    return [(product_id, name, ' '.join(models.get(product_id, [])), category_name or '')
+            for product_id, name, category_name in products]
+
+
+class BaseSearchBackend:
+    """
+    Базовый движок: поиск по названию товара без индекса и ранжирования.
+    """
+    vendor = None
+
+    def ensure_index(self):
+        pass
+
+    def index_products(self, product_ids):
+        pass
+
+    def remove_products(self, product_ids):
+        pass
+
+    def rebuild(self):
+        ids = list(Product.objects.values_list('id', flat=True))
+        for chunk in _chunks(ids, INDEX_CHUNK_SIZE):
+            self.index_products(chunk)
+        return len(ids)
+
+    def search(self, query, limit, after=None):
+        """
+        Возвращает список пар (id товара, релевантность) в порядке убывания
+        релевантности, при равной релевантности - по id. after - пара
+        (релевантность, id) последнего товара предыдущей страницы.
+        """
+        products = Product.objects.filter(name__icontains=query).order_by('id')
+        if after is not None:
+            products = products.filter(id__gt=after[1])
+        return [(product_id, 0.0) for product_id in products.values_list('id', flat=True)[:limit]]
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """
+    tsvector с весами (название > модель > категория) и триграммы для
+    нечеткого совпадения. Оба условия обслуживаются GIN-индексами.
+    """
+    vendor = 'postgresql'
+
+    @property
+    def config(self):
+        return settings.SEARCH_TS_CONFIG
+
+    def ensure_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {INDEX_TABLE} (
+                    product_id bigint PRIMARY KEY,
+                    name text NOT NULL,
+                    models text NOT NULL,
+                    category text NOT NULL,
+                    document tsvector GENERATED ALWAYS AS (
+                        setweight(to_tsvector('{self.config}', name), 'A') ||
+                        setweight(to_tsvector('{self.config}', models), 'B') ||
+                        setweight(to_tsvector('{self.config}', category), 'C')
+                    ) STORED
+                )
+            """)
+            # Внешний ключ на shop_app_product не дает выполнить TRUNCATE таблицы
+            # товаров (manage.py flush); строки индекса удаляются сигналами
+            cursor.execute(f'ALTER TABLE {INDEX_TABLE} DROP CONSTRAINT IF EXISTS {INDEX_TABLE}_product_id_fkey')
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {INDEX_TABLE}_document '
+                           f'ON {INDEX_TABLE} USING gin (document)')
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {INDEX_TABLE}_name_trgm '
+                           f'ON {INDEX_TABLE} USING gin (name gin_trgm_ops)')
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {INDEX_TABLE}_models_trgm '
+                           f'ON {INDEX_TABLE} USING gin (models gin_trgm_ops)')
+
+    def index_products(self, product_ids):
+        rows = _collect_documents(product_ids)
+        if not rows:
+            return
+        placeholders = ', '.join(['(%s, %s, %s, %s)'] * len(rows))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {INDEX_TABLE} (product_id, name, models, category) VALUES {placeholders} '
+                f'ON CONFLICT (product_id) DO UPDATE SET '
+                f'name = EXCLUDED.name, models = EXCLUDED.models, category = EXCLUDED.category',
+                [value for row in rows for value in row],
+            )
+
+    def remove_products(self, product_ids):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {INDEX_TABLE} WHERE product_id = ANY(%s)', [list(product_ids)])
+
+    def index_from_query(self, product_ids_sql, params=()):
+        """
+        Переиндексация одним запросом товаров, id которых возвращает подзапрос.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {INDEX_TABLE} (product_id, name, models, category)
+                SELECT p.id, p.name,
+                       coalesce(string_agg(DISTINCT pi.model, ' ') FILTER (WHERE pi.model <> ''), ''),
+                       coalesce(c.name, '')
+                FROM shop_app_product p
+                LEFT JOIN shop_app_category c ON c.id = p.category_id
+                LEFT JOIN shop_app_productinfo pi ON pi.product_id = p.id
+                WHERE p.id IN ({product_ids_sql})
+                GROUP BY p.id, c.name
+                ON CONFLICT (product_id) DO UPDATE SET
+                    name = EXCLUDED.name, models = EXCLUDED.models, category = EXCLUDED.category
+                """,
+                params,
+            )
+
+    def search(self, query, limit, after=None):
+        rank, last_id = after if after is not None else (None, None)
+        # Ранг приводится к float8: значение из курсора должно совпадать с ним без потери точности
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT product_id, rank FROM (
+                    SELECT product_id,
+                           (ts_rank(document, q) +
+                            greatest(similarity(name, %s), similarity(models, %s)))::float8 AS rank
+                    FROM {INDEX_TABLE}, websearch_to_tsquery(%s, %s) AS q
+                    WHERE document @@ q OR name %% %s OR models %% %s
+                ) found
+                WHERE %s::float8 IS NULL OR rank < %s::float8 OR (rank = %s::float8 AND product_id > %s)
+                ORDER BY rank DESC, product_id
+                LIMIT %s
+                """,
+                [query, query, self.config, query, query, query, rank, rank, rank, last_id, limit],
+            )
+            return cursor.fetchall()
+
+
+class SQLiteSearchBackend(BaseSearchBackend):
+    """
+    Виртуальная таблица FTS5, rowid совпадает с id товара.
+    Ранжирование - bm25 с весами колонок.
+    """
+    vendor = 'sqlite'
+
+    def ensure_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS {INDEX_TABLE} '
+                           f'USING fts5(name, models, category)')
+
+    def index_products(self, product_ids):
+        rows = _collect_documents(product_ids)
+        with connection.cursor() as cursor:
+            self._delete(cursor, product_ids)
+            if rows:
+                cursor.executemany(f'INSERT INTO {INDEX_TABLE} (rowid, name, models, category) '
+                                   f'VALUES (%s, %s, %s, %s)', rows)
+
+    def remove_products(self, product_ids):
+        with connection.cursor() as cursor:
+            self._delete(cursor, product_ids)
+
+    def _delete(self, cursor, product_ids):
+        product_ids = list(product_ids)
+        if product_ids:
+            placeholders = ', '.join(['%s'] * len(product_ids))
+            cursor.execute(f'DELETE FROM {INDEX_TABLE} WHERE rowid IN ({placeholders})', product_ids)
+
+    def search(self, query, limit, after=None):
+        # Каждое слово запроса ищется как префикс, спецсимволы FTS5 отбрасываются
+        words = _WORD_RE.findall(query)
+        if not words:
+            return []
+        match = ' '.join(f'"{word}"*' for word in words)
+        rank, last_id = after if after is not None else (None, None)
+        # bm25 тем меньше, чем релевантнее строка: релевантность - его значение с обратным знаком
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT rowid, rank FROM ('
+                f'SELECT rowid, -bm25({INDEX_TABLE}, 10.0, 5.0, 2.0) AS rank '
+                f'FROM {INDEX_TABLE} WHERE {INDEX_TABLE} MATCH %s) '
+                f'WHERE %s IS NULL OR rank < %s OR (rank = %s AND rowid > %s) '
+                f'ORDER BY rank DESC, rowid LIMIT %s',
+                [match, rank, rank, rank, last_id, limit],
+            )
+            return cursor.fetchall()
+
+
+BACKENDS = {backend.vendor: backend for backend in (PostgresSearchBackend, SQLiteSearchBackend)}
+
+
+def get_search_backend():
+    return BACKENDS.get(connection.vendor, BaseSearchBackend)()
+
+
+def search_products(query, limit=None, after=None):
+    """
+    Возвращает товары, найденные по запросу, в порядке релевантности.
+    Релевантность товара сохраняется в атрибуте search_rank; пара
+    (search_rank, id) последнего товара передается в after для получения
+    следующей страницы.
+    """
+    limit = limit or settings.SEARCH_RESULTS_LIMIT
+    found = get_search_backend().search(query, limit, after)
+    products = Product.objects.in_bulk([product_id for product_id, _ in found])
+    results = []
+    for product_id, rank in found:
+        if product_id in products:
+            products[product_id].search_rank = rank
+            results.append(products[product_id])
+    return results
+
+
+def index_products(product_ids):
+    backend = get_search_backend()
+    for chunk in _chunks(list(product_ids), INDEX_CHUNK_SIZE):
+        backend.index_products(chunk)
+
+
+def remove_products(product_ids):
+    get_search_backend().remove_products(product_ids)
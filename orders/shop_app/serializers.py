@@ -1,10 +1,15 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
 from rest_framework import serializers
-from .models import Shop, Category, Product, ProductInfo, Parameter, ProductParameter, Contact, Order, OrderItem, User
+from .models import Shop, Category, Product, ProductInfo, Parameter, ProductParameter, Contact, Order, OrderItem, User, \
+    ImportJob, ShopOrder, STATE_CHOICES
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
-        fields = ['email', 'username', 'password', 'type']
+        fields = ['email', 'username', 'password', 'type', 'notifications']
+        extra_kwargs = {'password': {'write_only': True}}
 
 class ShopSerializer(serializers.ModelSerializer):
     class Meta:
@@ -26,6 +31,16 @@ class ProductInfoSerializer(serializers.ModelSerializer):
         model = ProductInfo
         fields = ['model', 'external_id', 'product', 'shop', 'quantity', 'price', 'price_rrc']
 
+class ProductInfoPriceSerializer(serializers.Serializer):
+    """
+    Позиция пакетного обновления цен: id и изменяемые поля.
+    """
+    id = serializers.IntegerField()
+    # Верхняя граница - максимум PositiveIntegerField в PostgreSQL
+    price = serializers.IntegerField(min_value=0, max_value=2147483647, required=False)
+    price_rrc = serializers.IntegerField(min_value=0, max_value=2147483647, required=False)
+    quantity = serializers.IntegerField(min_value=0, max_value=2147483647, required=False)
+
 class ParameterSerializer(serializers.ModelSerializer):
     class Meta:
         model = Parameter
@@ -44,9 +59,106 @@ class ContactSerializer(serializers.ModelSerializer):
 class OrderSerializer(serializers.ModelSerializer):
     class Meta:
         model = Order
-        fields = ['user', 'dt', 'state', 'contact']
+        fields = ['id', 'user', 'dt', 'state', 'contact', 'total_sum', 'items_count', 'delivery_cost']
+        # Статус меняется только оформлением корзины и сменой статуса (shop_app.states)
+        read_only_fields = ['state', 'total_sum', 'items_count', 'delivery_cost']
+
+class OrderLineSerializer(serializers.ModelSerializer):
+    product = serializers.CharField(source='product_info.product.name')
+    shop = serializers.SerializerMethodField()
+    sum = serializers.SerializerMethodField()
+
+    class Meta:
+        model = OrderItem
+        fields = ['product_info', 'product', 'shop', 'price', 'quantity', 'sum']
+
+    def get_shop(self, obj):
+        return {'id': obj.product_info.shop_id, 'name': obj.product_info.shop.name}
+
+    def get_sum(self, obj):
+        return obj.price * obj.quantity
+
+class OrderHistorySerializer(OrderSerializer):
+    """
+    Заказ покупателя с позициями. Позиции должны быть предзагружены в item_list.
+    """
+    items = OrderLineSerializer(source='item_list', many=True, read_only=True)
+
+    class Meta(OrderSerializer.Meta):
+        fields = OrderSerializer.Meta.fields + ['items']
+
+class OrderFilterSerializer(serializers.Serializer):
+    state = serializers.ChoiceField(choices=STATE_CHOICES, required=False)
+    date_from = serializers.DateTimeField(required=False)
+    date_to = serializers.DateTimeField(required=False)
+
+class OrderTransitionSerializer(serializers.Serializer):
+    order_ids = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False,
+                                      max_length=settings.ORDER_TRANSITION_MAX_ORDERS)
+    state = serializers.ChoiceField(choices=STATE_CHOICES)
+
+class ShopOrderItemSerializer(serializers.ModelSerializer):
+    product = serializers.CharField(source='product_info.product.name')
+    model = serializers.CharField(source='product_info.model')
+    external_id = serializers.IntegerField(source='product_info.external_id')
+    parameters = serializers.SerializerMethodField()
+
+    class Meta:
+        model = OrderItem
+        fields = ['product_info', 'product', 'model', 'external_id', 'price', 'quantity', 'parameters']
+
+    def get_parameters(self, obj):
+        # Параметры предзагружены во view в product_info.parameter_list
+        return {parameter.parameter.name: parameter.value for parameter in obj.product_info.parameter_list}
+
+class ShopOrderSerializer(serializers.ModelSerializer):
+    """
+    Часть заказа для поставщика. Позиции магазина и контакт должны быть
+    предзагружены: order.shop_lines (Prefetch с to_attr) и order.contact.
+    """
+    dt = serializers.DateTimeField(source='order.dt', read_only=True)
+    contact = ContactSerializer(source='order.contact', read_only=True)
+    items = ShopOrderItemSerializer(source='order.shop_lines', many=True, read_only=True)
+
+    class Meta:
+        model = ShopOrder
+        fields = ['id', 'order', 'dt', 'state', 'total_sum', 'items_count', 'delivery_cost', 'contact', 'items']
 
 class OrderItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = OrderItem
-        fields = ['order', 'product_info', 'quantity']
\ No newline at end of file
+        fields = ['order', 'product_info', 'quantity']
+
+class CartItemSerializer(serializers.Serializer):
+    product_info_id = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=1, default=1)
+
+class CartItemsDeleteSerializer(serializers.Serializer):
+    items = serializers.ListField(child=serializers.IntegerField(), allow_empty=False)
+
+class ImportJobSerializer(serializers.ModelSerializer):
+    items = serializers.SerializerMethodField()
+    duration = serializers.SerializerMethodField()
+    rows_per_sec = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ImportJob
+        fields = ['id', 'url', 'mode', 'state', 'shop', 'items', 'duration', 'rows_per_sec', 'stats', 'errors',
+                  'created_at', 'started_at', 'finished_at']
+        read_only_fields = ['state', 'shop', 'stats', 'errors', 'created_at', 'started_at', 'finished_at']
+
+    def get_items(self, obj):
+        if obj.state == 'running':
+            return cache.get(obj.progress_key, obj.items)
+        return obj.items
+
+    def get_duration(self, obj):
+        if obj.started_at is None:
+            return None
+        return round(((obj.finished_at or timezone.now()) - obj.started_at).total_seconds(), 3)
+
+    def get_rows_per_sec(self, obj):
+        duration = self.get_duration(obj)
+        if not duration:
+            return None
+        return round(self.get_items(obj) / duration, 1)
@@ -1,10 +1,14 @@
 import json
 
 from django.conf import settings
+from django.db.models import QuerySet
+from django.db.models.signals import post_save, post_delete, pre_save
 from django.dispatch import receiver, Signal
 from django_rest_passwordreset.signals import reset_password_token_created
+from rest_framework.authtoken.models import Token
 import os
-from .models import ConfirmEmailToken, User
+from .models import ConfirmEmailToken, User, Product, ProductInfo, Category, OrderItem, OrderStatusEvent
+from . import authentication, search, totals
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -12,7 +16,7 @@ new_user_registered = Signal('user_id')
 
 new_order = Signal('user_id')
 
-from .tasks import send_email
+from .mailer import queue_email
 
 @receiver(reset_password_token_created)
 def password_reset_token_created(sender, instance, reset_password_token, **kwargs):
@@ -23,7 +27,22 @@ def password_reset_token_created(sender, instance, reset_password_token, **kwarg
     message = reset_password_token.key
     from_email = settings.EMAIL_HOST_USER
     to_email = reset_password_token.user.email
-    send_email.delay(subject, message, from_email, to_email)
+    queue_email(subject, message, from_email, to_email)
+
+@receiver(post_delete, sender=Token)
+def token_deleted_signal(instance, **kwargs):
+    """
+    Выход или смена токена: токен удаляется из кэша аутентификации.
+    """
+    authentication.invalidate_tokens([instance.key])
+
+@receiver(post_save, sender=User)
+def user_saved_signal(instance, created, **kwargs):
+    """
+    Смена пароля, is_active и других полей: пользователь удаляется из кэша аутентификации.
+    """
+    if not created:
+        authentication.invalidate_user(instance.id)
 
 @receiver(new_user_registered)
 def new_user_registered_signal(user_id, **kwargs):
@@ -32,21 +51,99 @@ def new_user_registered_signal(user_id, **kwargs):
     """
     token, _ = ConfirmEmailToken.objects.get_or_create(user_id=user_id)
 
-    subject = f"Токен подтверждения Email для {token.user.email}"
-    message = token.key
+    subject = "Подтверждение электронной почты"
+    message = f"Ваш ключ подтверждения: {token.key}"
     from_email = settings.EMAIL_HOST_USER
     to_email = token.user.email
-    send_email.delay(subject, message, from_email, to_email)
+    queue_email(subject, message, from_email, to_email)
 
 @receiver(new_order)
-def new_order_signal(user_id, **kwargs):
+def new_order_signal(user_id, order_id=None, **kwargs):
     """
     Celery-задача для асинхронной отправки письма об изменении статуса заказа.
+    Покупателю со сводкой изменение записывается в сводку (см. notifications).
     """
     user = User.objects.get(id=user_id)
+    if order_id is not None and user.notifications == 'digest':
+        OrderStatusEvent.objects.create(user=user, order_id=order_id, state='new')
+        return
 
     subject = "Обновление статуса заказа"
     message = "Заказ сформирован"
     from_email = settings.EMAIL_HOST_USER
     to_email = user.email
-    send_email.delay(subject, message, from_email, to_email)
+    queue_email(subject, message, from_email, to_email)
+
+
+def create_search_index(**kwargs):
+    """
+    Создание таблицы и индексов полнотекстового поиска.
+    """
+    search.get_search_backend().ensure_index()
+
+@receiver(post_save, sender=Product)
+def product_saved_signal(instance, **kwargs):
+    """
+    Обновление поискового индекса при изменении товара.
+    """
+    search.index_products([instance.id])
+
+@receiver(post_delete, sender=Product)
+def product_deleted_signal(instance, **kwargs):
+    """
+    Удаление товара из поискового индекса.
+    """
+    search.remove_products([instance.id])
+
+@receiver(post_save, sender=ProductInfo)
+@receiver(post_delete, sender=ProductInfo)
+def product_info_changed_signal(instance, **kwargs):
+    """
+    Модели из ProductInfo входят в документ товара, поэтому переиндексируем товар.
+    """
+    search.index_products([instance.product_id])
+
+@receiver(post_save, sender=Category)
+def category_saved_signal(instance, created, **kwargs):
+    """
+    Переиндексация товаров категории после переименования.
+    """
+    if not created:
+        search.index_products(instance.products.values_list('id', flat=True))
+
+@receiver(pre_save, sender=OrderItem)
+def order_item_pre_save_signal(instance, **kwargs):
+    """
+    Запоминаем прежнюю позицию заказа для пересчета итогов.
+    """
+    instance._previous = None
+    if instance.pk is not None:
+        instance._previous = OrderItem.objects.filter(pk=instance.pk).values(
+            'order_id', 'product_info_id', 'quantity', 'price').first()
+
+@receiver(post_save, sender=OrderItem)
+def order_item_saved_signal(instance, **kwargs):
+    """
+    Обновление итогов заказа при добавлении или изменении позиции.
+    """
+    previous = getattr(instance, '_previous', None)
+    old_lines = {}
+    if previous is not None:
+        old_lines = {previous['product_info_id']: (previous['quantity'], previous['price'])}
+        if previous['order_id'] != instance.order_id:
+            totals.apply_changes(previous['order_id'], totals.line_changes(old_lines, {}))
+            old_lines = {}
+    totals.apply_changes(instance.order_id, totals.line_changes(
+        old_lines, {instance.product_info_id: (instance.quantity, instance.price)}))
+
+@receiver(post_delete, sender=OrderItem)
+def order_item_deleted_signal(instance, origin=None, **kwargs):
+    """
+    Обновление итогов заказа при удалении позиции. При удалении набора
+    позиций (QuerySet.delete) итоги обновляет вызывающий код, как и при
+    bulk_create/update.
+    """
+    if isinstance(origin, QuerySet) and origin.model is OrderItem:
+        return
+    totals.apply_changes(instance.order_id,
+                         totals.line_changes({instance.product_info_id: (instance.quantity, instance.price)}, {}))
@@ -0,0 +1,132 @@
+"""
+Источники прайс-листов: файл магазина (Shop.filename), файл на сервере и URL.
+
+Локальные файлы отображаются в память (mmap), поэтому парсер читает их
+без копирования в память процесса. Если отобразить файл нельзя, он
+читается кусками. URL скачиваются условным запросом (If-None-Match /
+If-Modified-Since) во временный файл с подсчетом хэша содержимого: при
+ответе 304 или совпадении хэша с сохраненным у магазина импорт
+пропускается без разбора YAML.
+"""
+import hashlib
+import mmap
+import tempfile
+from contextlib import contextmanager
+
+import requests
+
+from .importer import ImportStats, import_price_list
+from .models import Shop
+
+CHUNK_SIZE = 64 * 1024
+FETCH_TIMEOUT = 30
+
+
+@contextmanager
+def open_path(path):
+    """
+    Открывает файл прайс-листа на сервере для чтения через mmap.
+    """
+    with open(path, 'rb') as file:
+        with _map_file(file) as stream:
+            yield stream
+
+
+@contextmanager
+def _map_file(file):
+    try:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        # Пустой файл или файловая система без mmap - читаем кусками
+        file.seek(0)
+        yield file
+    else:
+        with mapped:
+            yield mapped
+
+
+@contextmanager
+def open_shop_file(shop):
+    """
+    Открывает загруженный прайс-лист магазина. Если хранилище не дает
+    локального пути, файл читается кусками через API хранилища.
+    """
+    try:
+        path = shop.filename.path
+    except NotImplementedError:
+        with shop.filename.open('rb') as file:
+            yield file
+    else:
+        with open_path(path) as stream:
+            yield stream
+
+
+def content_hash(stream):
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def import_path(path, user=None, mode='full', progress=None):
+    """
+    Импорт прайс-листа из файла на сервере.
+    """
+    with open_path(path) as stream:
+        return import_price_list(stream, user=user, mode=mode, progress=progress)
+
+
+def import_shop_file(shop, mode='full', progress=None, force=False):
+    """
+    Импорт загруженного прайс-листа магазина. Файл с тем же хэшем,
+    что и при прошлом импорте, не разбирается.
+    """
+    with open_shop_file(shop) as stream:
+        feed_hash = content_hash(stream)
+        if not force and feed_hash == shop.feed_hash:
+            return ImportStats(shop_id=shop.id, skipped=True)
+        stats = import_price_list(stream, user=shop.user, mode=mode, progress=progress)
+    Shop.objects.filter(id=stats.shop_id).update(feed_hash=feed_hash)
+    return stats
+
+
+def import_url(url, user=None, mode='full', progress=None, force=False):
+    """
+    Условная загрузка и импорт прайс-листа по ссылке.
+    ETag, Last-Modified и хэш содержимого сохраняются у магазина после
+    успешного импорта; force - импортировать без проверки изменений.
+    """
+    shop = Shop.objects.filter(user=user).first() if user is not None else Shop.objects.filter(url=url).first()
+    headers = {}
+    if shop is not None and not force and shop.url == url:
+        if shop.feed_etag:
+            headers['If-None-Match'] = shop.feed_etag
+        if shop.feed_last_modified:
+            headers['If-Modified-Since'] = shop.feed_last_modified
+
+    with requests.get(url, headers=headers, stream=True, timeout=FETCH_TIMEOUT) as response:
+        if response.status_code == 304 and headers:
+            return ImportStats(shop_id=shop.id, skipped=True)
+        response.raise_for_status()
+        validators = {
+            'url': url,
+            'feed_etag': response.headers.get('ETag', ''),
+            'feed_last_modified': response.headers.get('Last-Modified', ''),
+        }
+        with tempfile.TemporaryFile() as file:
+            digest = hashlib.sha256()
+            for chunk in response.iter_content(CHUNK_SIZE):
+                digest.update(chunk)
+                file.write(chunk)
+            file.flush()
+            validators['feed_hash'] = digest.hexdigest()
+
+            if shop is not None and not force and shop.url == url and shop.feed_hash == validators['feed_hash']:
+                Shop.objects.filter(id=shop.id).update(**validators)
+                return ImportStats(shop_id=shop.id, skipped=True)
+            with _map_file(file) as stream:
+                stats = import_price_list(stream, user=user, mode=mode, progress=progress)
+
+    Shop.objects.filter(id=stats.shop_id).update(**validators)
+    return stats
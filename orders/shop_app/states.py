@@ -0,0 +1,89 @@
+"""
+Статусы заказов и допустимые переходы между ними.
+
+Массовая смена статуса - один UPDATE с условием на текущий статус:
+заказы, статус которых не допускает перехода, не меняются. Операция
+записывается в журнал (OrderStateChange), а покупатели уведомляются
+одной задачей Celery на всю операцию, а не письмом на каждый заказ.
+
+Администратор меняет статус заказов целиком; заказ, часть которого уже
+не допускает перехода (например, отправлена при отмене), пропускается.
+Поставщик меняет статус своих частей заказов (ShopOrder); заказ переходит
+в новый статус, когда в него перешли все его части. Покупатели
+уведомляются только об изменении статуса самого заказа.
+"""
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from .models import Order, OrderStateChange, ShopOrder
+from .tasks import notify_state_change
+
+TRANSITIONS = {
+    'basket': ('new',),
+    'new': ('confirmed', 'canceled'),
+    'confirmed': ('assembled', 'canceled'),
+    'assembled': ('sent', 'canceled'),
+    'sent': ('delivered',),
+    'delivered': (),
+    'canceled': (),
+}
+
+
+class TransitionError(Exception):
+    """
+    Переход в статус недопустим.
+    """
+
+
+def can_transition(current, state):
+    return state in TRANSITIONS.get(current, ())
+
+
+def source_states(state):
+    """
+    Статусы, из которых допустим переход в state.
+    """
+    return [current for current, targets in TRANSITIONS.items() if state in targets]
+
+
+def transition_orders(order_ids, state, user=None, shop=None):
+    """
+    Переводит заказы order_ids в статус state. Если указан shop, меняются
+    только части заказов этого магазина. Заказы в статусе, из которого
+    переход недопустим, пропускаются. Возвращает запись журнала:
+    orders - id заказов, статус которых изменился, shop_orders - id
+    измененных частей заказов.
+    """
+    # В статус new заказ переводит только оформление корзины (shop_app.checkout)
+    sources = [current for current in source_states(state) if current != 'basket']
+    if not sources:
+        raise TransitionError(f'Transition to {state} is not allowed')
+    order_ids = sorted(set(order_ids))
+
+    with transaction.atomic():
+        # Заказы блокируются первыми в обоих случаях: параллельные операции
+        # администратора и поставщиков над одними заказами выполняются по очереди
+        if shop is None:
+            changed = list(Order.objects.select_for_update().filter(id__in=order_ids, state__in=sources).filter(
+                ~Exists(ShopOrder.objects.filter(order=OuterRef('pk')).exclude(state__in=sources + [state])))
+                .order_by('id').values_list('id', flat=True))
+            shop_orders = list(ShopOrder.objects.filter(order_id__in=changed, state__in=sources)
+                               .order_by('id').values_list('id', flat=True))
+            Order.objects.filter(id__in=changed).update(state=state)
+            ShopOrder.objects.filter(id__in=shop_orders).update(state=state)
+        else:
+            list(Order.objects.select_for_update().filter(id__in=order_ids).order_by('id').values_list('id', flat=True))
+            shop_orders = list(ShopOrder.objects.select_for_update().filter(
+                shop=shop, order_id__in=order_ids, state__in=sources).order_by('id').values_list('id', flat=True))
+            ShopOrder.objects.filter(id__in=shop_orders).update(state=state)
+            changed = list(Order.objects.filter(
+                shop_orders__id__in=shop_orders, state__in=sources).filter(
+                ~Exists(ShopOrder.objects.filter(order=OuterRef('pk')).exclude(state=state)))
+                .order_by('id').values_list('id', flat=True))
+            Order.objects.filter(id__in=changed).update(state=state)
+
+        change = OrderStateChange.objects.create(user=user, shop=shop, state=state, orders=changed,
+                                                 shop_orders=shop_orders, requested=len(order_ids))
+        if changed:
+            transaction.on_commit(lambda: notify_state_change.delay(change.id))
+    return change
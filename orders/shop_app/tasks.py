@@ -1,10 +1,95 @@
+import requests
 from celery import shared_task
-from django.core.mail import EmailMultiAlternatives
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.utils import timezone
+
+from .cart import flush_dirty_carts
+from .idempotency import purge_expired_keys
+from .importer import PriceListError
+from .mailer import build_message, deliver_queued, get_mailer
+from .models import ImportJob, OrderStateChange
+from .notifications import notify_orders, send_digests
+from .orchestrator import import_source
+from .sources import import_url
 
 @shared_task
 def send_email(subject, message, from_email, to_email):
     """
-    Celery-задача для отправки письма асинхронно.
+    Celery-задача для отправки письма асинхронно через постоянное соединение воркера.
+    """
+    return get_mailer().send([build_message(subject, message, from_email, to_email)])
+
+@shared_task
+def deliver_mail():
+    """
+    Celery-задача для отправки писем из очереди пачками (см. mailer.queue_email).
+    """
+    return deliver_queued()
+
+@shared_task
+def notify_state_change(change_id):
+    """
+    Celery-задача для уведомления покупателей о смене статуса заказов
+    (см. states.transition_orders): одно письмо на покупателя со всеми его
+    заказами или запись изменений в сводку (см. notifications).
+    """
+    change = OrderStateChange.objects.get(id=change_id)
+    return notify_orders(change.orders, change.state)
+
+@shared_task
+def send_order_digests():
+    """
+    Периодическая задача: отправка сводок изменений статусов заказов.
+    """
+    return send_digests()
+
+@shared_task(acks_late=True)
+def run_import_job(job_id):
+    """
+    Celery-задача для импорта прайс-листа в фоне.
+    Ход выполнения (число обработанных позиций) публикуется в кэше,
+    так как сам импорт идет в одной транзакции и в БД не виден до конца.
+    Неизменившийся прайс-лист не импортируется (stats.skipped).
+    """
+    job = ImportJob.objects.select_related('user').get(id=job_id)
+    ImportJob.objects.filter(id=job.id).update(state='running', started_at=timezone.now())
+
+    def progress(stats):
+        cache.set(job.progress_key, stats.items, timeout=24 * 60 * 60)
+
+    try:
+        stats = import_url(job.url, user=job.user, mode=job.mode, progress=progress)
+    except (requests.RequestException, PriceListError, DatabaseError) as e:
+        ImportJob.objects.filter(id=job.id).update(state='failed', errors=[str(e)],
+                                                   items=cache.get(job.progress_key, 0),
+                                                   finished_at=timezone.now())
+    except Exception as e:
+        ImportJob.objects.filter(id=job.id).update(state='failed', errors=[repr(e)], finished_at=timezone.now())
+        raise
+    else:
+        ImportJob.objects.filter(id=job.id).update(state='done', shop_id=stats.shop_id, items=stats.items,
+                                                   stats=stats.as_dict(), finished_at=timezone.now())
+    finally:
+        cache.delete(job.progress_key)
+
+@shared_task
+def flush_carts():
+    """
+    Периодическая задача: перенос измененных корзин из Redis в БД.
+    """
+    return flush_dirty_carts()
+
+@shared_task
+def purge_idempotency_keys():
+    """
+    Периодическая задача: удаление просроченных ключей идемпотентности.
+    """
+    return purge_expired_keys()
+
+@shared_task(ignore_result=False, acks_late=True)
+def import_feed(source, mode='full'):
+    """
+    Celery-задача для импорта одного прайс-листа из группы (см. orchestrator.run_imports).
     """
-    msg = EmailMultiAlternatives(subject, message, from_email, [to_email])
-    msg.send()
\ No newline at end of file
+    return import_source(source, mode)
@@ -1,13 +1,88 @@
-from django.test import TestCase, Client
+from django.test import TestCase, TransactionTestCase, Client
 from rest_framework import status
 from rest_framework.test import APIClient
 from django.urls import reverse
 from django.contrib.auth import get_user_model
 from rest_framework.authtoken.models import Token
-from .models import Product, Order, Shop
+from .models import Product, Order, Shop, Category, ProductInfo, ProductParameter, Parameter
+from .search import search_products, index_products
+from .importer import PriceListImporter, DiffPriceListImporter, CopyPriceListImporter, ImportStats, \
+    load_price_list, import_price_list
+from .feeds import stream_price_list, PriceListError
+from .models import ImportJob
+from .tasks import run_import_job, notify_state_change, send_order_digests, send_email, deliver_mail, \
+    import_feed, flush_carts
+from orders.celery import app as celery_app, worker_argv
+from .orchestrator import collect_sources, run_imports
+from .sources import import_path, import_shop_file, import_url
+from .cart import get_cart_storage, flush_cart, flush_dirty_carts
+from .checkout import checkout, split_by_shop, InsufficientStock
+from .states import transition_orders, TransitionError
+from .idempotency import claim_key, purge_expired_keys
+from .authentication import LocalCache, cache_key, get_cached_user, local_cache
+from .mailer import Mailer, MemoryMailQueue, build_message, deliver_queued
+from .management.commands.bench_mail import LocalSMTPServer
+from unittest import skipUnless
+from django.db import connections
+from .models import OrderItem, ShopOrder, Contact, OrderStateChange, IdempotencyKey, ConfirmEmailToken, \
+    OrderStatusEvent
+from datetime import timedelta
+from django.utils import timezone
+from django.core.management import call_command
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from unittest import mock
+import csv
+import io
+import json
+import tracemalloc
+import yaml
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 
 User = get_user_model()
 
+
+class FeedHandler(BaseHTTPRequestHandler):
+    """
+    Локальный HTTP-сервер прайс-листа с поддержкой ETag.
+    """
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        if self.server.etag and self.headers.get('If-None-Match') == self.server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        if self.server.etag:
+            self.send_header('ETag', self.server.etag)
+        self.send_header('Content-Length', str(len(self.server.body)))
+        self.end_headers()
+        self.wfile.write(self.server.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FeedServerMixin:
+    def start_feed_server(self, body, etag=None):
+        server = HTTPServer(('127.0.0.1', 0), FeedHandler)
+        server.body, server.etag, server.requests = body, etag, []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server, f'http://127.0.0.1:{server.server_port}/shop1.yaml'
+
+
 class RegisterBuyerViewTest(TestCase):
     def setUp(self):
         self.client = APIClient()
@@ -23,6 +98,25 @@ class RegisterBuyerViewTest(TestCase):
         response = self.client.post(url, data, format='json')
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
 
+    @override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend')
+    def test_register_without_smtp(self):
+        # Медленный почтовый сервер: каждое соединение занимает секунду
+        with mock.patch('smtplib.SMTP', side_effect=lambda *args, **kwargs: time.sleep(1)) as smtp, \
+                mock.patch('shop_app.tasks.send_email.delay') as delay, \
+                self.captureOnCommitCallbacks(execute=True):
+            started = time.monotonic()
+            response = self.client.post(reverse('register'), {'email': 'buyer@example.com', 'username': 'buyer',
+                                                              'password': 'password123'}, format='json')
+            elapsed = time.monotonic() - started
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertLess(elapsed, 1)
+        smtp.assert_not_called()
+
+        user = User.objects.get(email='buyer@example.com')
+        subject, message, _, to_email = delay.call_args.args
+        self.assertEqual(to_email, 'buyer@example.com')
+        self.assertIn(ConfirmEmailToken.objects.get(user=user).key, message)
+
 
 class ConfirmEmailViewTest(TestCase):
     def setUp(self):
@@ -198,4 +292,1510 @@ class UserOrdersViewTest(TestCase):
     def test_get_user_orders(self):
         url = reverse('user-orders')
         response = self.client.get(url)
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
\ No newline at end of file
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class ProductSearchEngineTest(TestCase):
+    def setUp(self):
+        self.shop = Shop.objects.create(name='Shop 1')
+        self.phones = Category.objects.create(name='Смартфоны')
+        self.accessories = Category.objects.create(name='Аксессуары для iPhone')
+        self.iphone = Product.objects.create(name='Смартфон Apple iPhone XR', category=self.phones)
+        self.case = Product.objects.create(name='Чехол силиконовый', category=self.accessories)
+        self.galaxy = Product.objects.create(name='Смартфон Samsung Galaxy', category=self.phones)
+        ProductInfo.objects.create(product=self.galaxy, shop=self.shop, external_id=1, model='samsung/galaxy/s10',
+                                   quantity=1, price=100, price_rrc=110)
+
+    def test_ranked_by_field_weight(self):
+        self.assertEqual(search_products('iphone'), [self.iphone, self.case])
+
+    def test_search_by_model(self):
+        self.assertEqual(search_products('s10'), [self.galaxy])
+
+    def test_index_follows_changes(self):
+        self.phones.name = 'Телефоны'
+        self.phones.save()
+        self.assertEqual(set(search_products('телефоны')), {self.iphone, self.galaxy})
+        self.iphone.delete()
+        self.assertEqual(search_products('xr'), [])
+
+    def test_search_view(self):
+        user = User.objects.create_user(email='buyer@example.com', username='buyer', password='password123',
+                                        is_active=True)
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+        response = self.client.get(reverse('search'), {'query': 'смартфон apple'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([item['name'] for item in response.data['results']], [self.iphone.name])
+
+    def test_search_view_pages(self):
+        Product.objects.bulk_create([Product(name=f'Смартфон модель {i}', category=self.phones) for i in range(5)])
+        index_products(Product.objects.values_list('id', flat=True))
+        expected = [product.name for product in search_products('смартфон')]
+        self.assertEqual(len(expected), 7)
+
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user(email='buyer@example.com', username='buyer',
+                                                                password='password123', is_active=True))
+        response = self.client.get(reverse('search'), {'query': 'смартфон', 'page_size': 3})
+        pages = [response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            pages.append(response.data['results'])
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertEqual([item['name'] for page in pages for item in page], expected)
+
+
+class PriceListImporterTest(TestCase):
+    def setUp(self):
+        with open(settings.BASE_DIR.parent / 'data' / 'shop1.yaml', 'rb') as stream:
+            self.price_list = load_price_list(stream)
+
+    def test_import(self):
+        stats = PriceListImporter().run(self.price_list)
+        goods = self.price_list['goods']
+        self.assertEqual(stats.created, len(goods))
+        self.assertEqual(ProductInfo.objects.filter(shop_id=stats.shop_id).count(), len(goods))
+        self.assertEqual(ProductParameter.objects.count(), sum(len(item['parameters']) for item in goods))
+        self.assertEqual(Category.objects.get(id=224).shops.get().name, 'Связной')
+
+    def test_reimport_updates_in_place(self):
+        PriceListImporter().run(self.price_list)
+        first, removed = self.price_list['goods'][0], self.price_list['goods'].pop()
+        first['price'] = 1
+        first['parameters'] = {'Цвет': 'белый'}
+        stats = PriceListImporter().run(self.price_list)
+        self.assertEqual((stats.created, stats.deleted), (0, 1))
+        info = ProductInfo.objects.get(external_id=first['id'])
+        self.assertEqual(info.price, 1)
+        self.assertEqual(list(info.product_parameters.values_list('parameter__name', 'value')), [('Цвет', 'белый')])
+        self.assertFalse(ProductInfo.objects.filter(external_id=removed['id']).exists())
+
+    def test_query_count_does_not_depend_on_size(self):
+        def count_queries(count, batch_size):
+            goods = self.price_list['goods']
+            # По одному параметру: строк параметров в пачке не больше, чем позиций
+            goods = [dict(goods[i % len(goods)], id=i, name=f"{goods[i % len(goods)]['name']} {i}",
+                          parameters={'Цвет': i}) for i in range(count)]
+            with transaction.atomic(), CaptureQueriesContext(connection) as queries:
+                PriceListImporter(batch_size=batch_size).run(dict(self.price_list, goods=goods))
+                transaction.set_rollback(True)
+            return len(queries)
+
+        # Число запросов зависит только от числа пачек
+        self.assertEqual(count_queries(45, 20), count_queries(60, 20))
+        per_batch = count_queries(80, 20) - count_queries(60, 20)
+        self.assertEqual(count_queries(100, 20) - count_queries(80, 20), per_batch)
+
+    def test_user_shop_renamed(self):
+        user = User.objects.create_user(email='shop@example.com', username='shop', password='password123',
+                                        type='shop')
+        shop = Shop.objects.create(name='Старое название', user=user)
+        stats = PriceListImporter(user=user).run(self.price_list)
+        self.assertEqual(stats.shop_id, shop.id)
+        shop.refresh_from_db()
+        self.assertEqual(shop.name, 'Связной')
+
+
+class DiffPriceListImporterTest(TestCase):
+    def setUp(self):
+        with open(settings.BASE_DIR.parent / 'data' / 'shop1.yaml', 'rb') as stream:
+            self.price_list = load_price_list(stream)
+        PriceListImporter().run(self.price_list)
+        self.user = User.objects.create_user(email='buyer@example.com', username='buyer', password='password123')
+
+    def test_unchanged_feed_writes_nothing(self):
+        ids = set(ProductInfo.objects.values_list('id', flat=True))
+        with CaptureQueriesContext(connection) as queries:
+            stats = DiffPriceListImporter().run(self.price_list)
+        self.assertEqual(stats.unchanged, len(self.price_list['goods']))
+        self.assertEqual((stats.created, stats.updated, stats.deleted), (0, 0, 0))
+        self.assertEqual(set(ProductInfo.objects.values_list('id', flat=True)), ids)
+        writes = [query['sql'] for query in queries if query['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))]
+        self.assertFalse([sql for sql in writes if 'shop_app_product' in sql])
+
+    def test_applies_changes_only(self):
+        goods = self.price_list['goods']
+        kept = ProductInfo.objects.get(external_id=goods[1]['id'])
+        order = Order.objects.create(user=self.user, state='basket')
+        order.ordered_items.create(product_info=kept, quantity=1)
+        goods[0]['price'] = 1
+        goods[0]['parameters']['Цвет'] = 'белый'
+        removed = goods.pop()
+        goods.append(dict(removed, id=1, name='Новый товар'))
+
+        stats = DiffPriceListImporter().run(self.price_list)
+        self.assertEqual((stats.created, stats.updated, stats.deleted), (1, 1, 1))
+        self.assertEqual(stats.unchanged, len(goods) - 2)
+        changed = ProductInfo.objects.get(external_id=goods[0]['id'])
+        self.assertEqual(changed.price, 1)
+        self.assertEqual(changed.product_parameters.get(parameter__name='Цвет').value, 'белый')
+        self.assertFalse(ProductInfo.objects.filter(external_id=removed['id']).exists())
+        self.assertEqual(ProductInfo.objects.get(external_id=1).product_parameters.count(),
+                         len(removed['parameters']))
+        self.assertTrue(order.ordered_items.filter(product_info=kept).exists())
+
+
+class StreamPriceListTest(TestCase):
+    def setUp(self):
+        with open(settings.BASE_DIR.parent / 'data' / 'shop1.yaml', 'rb') as stream:
+            self.data = stream.read()
+
+    def feed(self, items):
+        return yaml.safe_dump({'shop': 'Shop', 'categories': [{'id': 1, 'name': 'Категория'}],
+                               'goods': [{'id': i, 'category': 1, 'name': f'Товар {i}', 'price': 10,
+                                          'price_rrc': 12, 'quantity': 1, 'parameters': {'Цвет': i}}
+                                         for i in range(items)]},
+                              sort_keys=False, allow_unicode=True).encode()
+
+    def test_same_result_as_full_load(self):
+        price_list = stream_price_list(io.BytesIO(self.data))
+        expected = load_price_list(self.data)
+        self.assertEqual((price_list['shop'], price_list['categories']), (expected['shop'], expected['categories']))
+        self.assertEqual(list(price_list['goods']), expected['goods'])
+
+    def test_goods_must_follow_shop(self):
+        with self.assertRaises(PriceListError):
+            stream_price_list(io.BytesIO(b'goods: []\nshop: Shop\n'))
+
+    def test_categories_must_precede_goods(self):
+        price_list = stream_price_list(io.BytesIO(b'shop: Shop\ngoods: []\ncategories: [{id: 1, name: C}]\n'))
+        with self.assertRaises(PriceListError):
+            list(price_list['goods'])
+
+    def test_memory_does_not_grow_with_file_size(self):
+        def peak(items):
+            stream = io.BytesIO(self.feed(items))
+            tracemalloc.start()
+            for _ in stream_price_list(stream)['goods']:
+                pass
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return peak
+
+        self.assertLess(peak(5000), peak(500) * 2)
+
+    def test_import_from_stream(self):
+        stats = import_price_list(io.BytesIO(self.feed(25)))
+        self.assertEqual(stats.created, 25)
+        self.assertEqual(ProductInfo.objects.filter(shop_id=stats.shop_id).count(), 25)
+
+
+class ImportJobTest(FeedServerMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='shop@example.com', username='shop', password='password123',
+                                             type='shop', is_active=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        with open(settings.BASE_DIR.parent / 'data' / 'shop1.yaml', 'rb') as stream:
+            self.data = stream.read()
+
+    def test_submit_and_poll(self):
+        _, url = self.start_feed_server(self.data)
+        with mock.patch('shop_app.views.run_import_job.delay') as delay, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('import-jobs'), {'url': url})
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['state'], 'pending')
+        delay.assert_called_once_with(response.data['id'])
+
+        run_import_job(response.data['id'])
+        response = self.client.get(reverse('import-job', args=[response.data['id']]))
+        self.assertEqual(response.data['state'], 'done')
+        self.assertEqual(response.data['items'], 4)
+        self.assertEqual(response.data['stats']['created'], 4)
+        self.assertIsNotNone(response.data['rows_per_sec'])
+        self.assertEqual(response.data['errors'], [])
+
+    def test_failed_import(self):
+        _, url = self.start_feed_server(b'shop: [unclosed')
+        job = ImportJob.objects.create(user=self.user, url=url)
+        run_import_job(job.id)
+        job.refresh_from_db()
+        self.assertEqual(job.state, 'failed')
+        self.assertTrue(job.errors)
+        self.assertIsNotNone(job.finished_at)
+
+    def test_other_users_job_is_hidden(self):
+        other = User.objects.create_user(email='other@example.com', username='other', password='password123')
+        job = ImportJob.objects.create(user=other, url='http://example.com/shop1.yaml')
+        response = self.client.get(reverse('import-job', args=[job.id]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class BatchUpdatePriceViewTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='shop@example.com', username='shop', password='password123',
+                                             type='shop', is_active=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.shop = Shop.objects.create(name='Shop 1', user=self.user)
+        category = Category.objects.create(name='Категория')
+        self.infos = [ProductInfo.objects.create(product=Product.objects.create(name=f'Товар {i}', category=category),
+                                                 shop=self.shop, external_id=i, quantity=1, price=100, price_rrc=110)
+                      for i in range(20)]
+        other_shop = Shop.objects.create(name='Shop 2')
+        self.foreign = ProductInfo.objects.create(product=self.infos[0].product, shop=other_shop, external_id=1,
+                                                  quantity=1, price=100, price_rrc=110)
+
+    def put(self, product_infos):
+        return self.client.put(reverse('update-price'), {'shop_id': self.shop.id, 'product_infos': product_infos})
+
+    def test_batch_update(self):
+        response = self.put([{'id': info.id, 'price': 200 + info.external_id, 'quantity': 5} for info in self.infos])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['updated'], len(self.infos))
+        for info in self.infos:
+            info.refresh_from_db()
+            self.assertEqual((info.price, info.quantity, info.price_rrc), (200 + info.external_id, 5, 110))
+
+    def test_query_count_does_not_depend_on_size(self):
+        def count_queries(infos):
+            with CaptureQueriesContext(connection) as queries:
+                self.put([{'id': info.id, 'price': 300} for info in infos])
+            return len(queries)
+
+        self.assertEqual(count_queries(self.infos[:2]), count_queries(self.infos[2:]))
+
+    def test_only_changed_fields_are_written(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.put([{'id': self.infos[0].id, 'price': 300},
+                                 {'id': self.infos[1].id, 'price': 100, 'quantity': 7}])
+        self.assertEqual(response.data['updated'], 2)
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(sorted(('"price" =' in sql, '"quantity" =' in sql) for sql in updates),
+                         [(False, True), (True, False)])
+
+    def test_nothing_applied_on_error(self):
+        response = self.put([{'id': self.infos[0].id, 'price': 1}, {'id': self.infos[1].id, 'price': -1}])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.put([{'id': self.infos[0].id, 'price': 1}, {'id': self.foreign.id, 'price': 1}])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['ids'], [self.foreign.id])
+        self.infos[0].refresh_from_db()
+        self.foreign.refresh_from_db()
+        self.assertEqual((self.infos[0].price, self.foreign.price), (100, 100))
+
+    def test_out_of_range_value(self):
+        response = self.put([{'id': self.infos[0].id, 'price': 2 ** 31}])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.infos[0].refresh_from_db()
+        self.assertEqual(self.infos[0].price, 100)
+
+
+class PartnerExportViewTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='shop@example.com', username='shop', password='password123',
+                                             type='shop', is_active=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        with open(settings.BASE_DIR.parent / 'data' / 'shop1.yaml', 'rb') as stream:
+            self.price_list = load_price_list(stream)
+        PriceListImporter(user=self.user).run(self.price_list)
+
+    def export(self, export_type):
+        response = self.client.get(reverse('partner-export'), {'type': export_type})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def expected_goods(self):
+        return sorted([dict(item, parameters={name: str(value) for name, value in item['parameters'].items()})
+                       for item in self.price_list['goods']], key=lambda item: item['id'])
+
+    def test_yaml_round_trip(self):
+        exported = load_price_list(self.export('yaml'))
+        self.assertEqual(exported['shop'], self.price_list['shop'])
+        self.assertEqual(sorted(exported['categories'], key=lambda category: category['id']),
+                         sorted(self.price_list['categories'], key=lambda category: category['id']))
+        self.assertEqual(sorted(exported['goods'], key=lambda item: item['id']), self.expected_goods())
+
+    def test_jsonl(self):
+        goods = [json.loads(line) for line in self.export('jsonl').splitlines()]
+        self.assertEqual(sorted(goods, key=lambda item: item['id']), self.expected_goods())
+
+    def test_csv(self):
+        rows = list(csv.DictReader(io.StringIO(self.export('csv'))))
+        self.assertEqual(len(rows), len(self.price_list['goods']))
+        self.assertEqual(json.loads(rows[0]['parameters'])['Цвет'], 'золотистый')
+
+    def test_unknown_type(self):
+        response = self.client.get(reverse('partner-export'), {'type': 'xml'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class CopyPriceListImporterTest(TestCase):
+    def setUp(self):
+        with open(settings.BASE_DIR.parent / 'data' / 'shop1.yaml', 'rb') as stream:
+            self.price_list = load_price_list(stream)
+        self.category_ids = {category['id'] for category in self.price_list['categories']}
+
+    def test_falls_back_to_orm_import(self):
+        stats = CopyPriceListImporter().run(self.price_list)
+        self.assertEqual(stats.created, len(self.price_list['goods']))
+        self.assertEqual(ProductInfo.objects.filter(shop_id=stats.shop_id).count(), len(self.price_list['goods']))
+
+    def test_copy_rows(self):
+        copied = {}
+
+        class Cursor:
+            def copy_expert(self, sql, rows):
+                copied[sql.split()[1]] = list(csv.reader(io.StringIO(rows.read())))
+
+        importer = CopyPriceListImporter()
+        importer.stats = ImportStats()
+        importer.category_ids.update(self.category_ids)
+        importer.copy_goods(Cursor(), self.price_list['goods'][:2])
+        first = self.price_list['goods'][0]
+        self.assertEqual(copied['import_goods'][0], ['0', str(first['id']), str(first['category']), first['name'],
+                                                     first['model'], str(first['price']), str(first['price_rrc']),
+                                                     str(first['quantity'])])
+        self.assertEqual(len(copied['import_parameters']),
+                         sum(len(item['parameters']) for item in self.price_list['goods'][:2]))
+        self.assertEqual(importer.stats.items, 2)
+
+    def test_copy_keeps_empty_strings(self):
+        copied = {}
+
+        class Cursor:
+            def copy_expert(self, sql, rows):
+                copied[sql.split()[1]] = (sql, rows.read())
+
+        importer = CopyPriceListImporter()
+        importer.stats = ImportStats()
+        importer.category_ids.update(self.category_ids)
+        item = dict(self.price_list['goods'][0], parameters={'Цвет': ''})
+        del item['model']
+        importer.copy_goods(Cursor(), [item])
+        sql, rows = copied['import_goods']
+        self.assertIn('FORCE_NOT_NULL (name, model)', sql)
+        self.assertEqual(next(csv.reader(io.StringIO(rows)))[4], '')
+        sql, rows = copied['import_parameters']
+        self.assertIn('FORCE_NOT_NULL (name, value)', sql)
+        self.assertEqual(rows, '0,Цвет,\r\n')
+
+
+@skipUnless(connection.vendor == 'postgresql', 'COPY есть только в PostgreSQL')
+class CopyImportTotalsTest(TransactionTestCase):
+    """
+    Временные таблицы импорта удаляются при фиксации, поэтому импорты
+    выполняются в отдельных транзакциях.
+    """
+
+    def setUp(self):
+        with open(settings.BASE_DIR.parent / 'data' / 'shop1.yaml', 'rb') as stream:
+            self.price_list = load_price_list(stream)
+
+    def test_removed_items_update_order_totals(self):
+        stats = CopyPriceListImporter().run(self.price_list)
+        first, second = ProductInfo.objects.filter(shop_id=stats.shop_id).order_by('id')[:2]
+        user = User.objects.create_user(email='buyer@example.com', username='buyer', password='password123')
+        order = Order.objects.create(user=user, state='basket')
+        OrderItem.objects.create(order=order, product_info=first, quantity=1)
+        OrderItem.objects.create(order=order, product_info=second, quantity=2)
+
+        goods = [dict(item, model='') for item in self.price_list['goods'] if item['id'] != first.external_id]
+        CopyPriceListImporter().run(dict(self.price_list, goods=goods))
+        order.refresh_from_db()
+        self.assertEqual((order.total_sum, order.items_count), (second.price * 2, 2))
+        self.assertEqual(ProductInfo.objects.get(id=second.id).model, '')
+
+    def test_removed_items_update_delivery_cost(self):
+        stats = CopyPriceListImporter().run(self.price_list)
+        first, second = ProductInfo.objects.filter(shop_id=stats.shop_id).order_by('id')[:2]
+        Shop.objects.filter(id=stats.shop_id).update(delivery_cost=300, free_delivery_from=first.price + second.price)
+        user = User.objects.create_user(email='buyer@example.com', username='buyer', password='password123')
+        order = Order.objects.create(user=user, state='basket')
+        OrderItem.objects.create(order=order, product_info=first, quantity=1)
+        OrderItem.objects.create(order=order, product_info=second, quantity=1)
+        order.delivery_cost = split_by_shop(order)
+        order.state = 'new'
+        order.save(update_fields=['state', 'delivery_cost'])
+        self.assertEqual(order.delivery_cost, 0)
+
+        goods = [item for item in self.price_list['goods'] if item['id'] != first.external_id]
+        CopyPriceListImporter().run(dict(self.price_list, goods=goods))
+        order.refresh_from_db()
+        self.assertEqual(order.delivery_cost, 300)
+        self.assertEqual(order.shop_orders.get().delivery_cost, order.delivery_cost)
+
+
+class MultiShopImportTest(TestCase):
+    def setUp(self):
+        with open(settings.BASE_DIR.parent / 'data' / 'shop1.yaml', 'rb') as stream:
+            price_list = load_price_list(stream)
+        self.directory = tempfile.TemporaryDirectory()
+        for number in (1, 2):
+            price_list = dict(price_list, shop=f'Магазин {number}')
+            price_list['goods'] = [dict(item, parameters=dict(item['parameters'], **{f'Параметр {number}': 1}))
+                                   for item in price_list['goods']]
+            Path(self.directory.name, f'shop{number}.yaml').write_text(
+                yaml.safe_dump(price_list, sort_keys=False, allow_unicode=True), encoding='utf-8')
+        Path(self.directory.name, 'broken.yaml').write_text('shop: [', encoding='utf-8')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_run_imports(self):
+        sources = collect_sources(self.directory.name)
+        self.assertEqual(len(sources), 2)
+        summary = run_imports(sources)
+        self.assertEqual(summary['items'], 8)
+        self.assertEqual(summary['dimensions'], {'categories': 3})
+        self.assertEqual([shop['items'] for shop in summary['shops']], [4, 4])
+        self.assertEqual(Shop.objects.count(), 2)
+        self.assertEqual(Parameter.objects.count(), 6)
+        self.assertEqual(Product.objects.count(), 4)
+
+    def test_failed_feed_is_reported(self):
+        summary = run_imports([{'path': str(Path(self.directory.name, 'shop1.yaml'))},
+                               {'path': str(Path(self.directory.name, 'missing.yaml'))}])
+        errors = {Path(shop['source']).name: shop['error'] for shop in summary['shops']}
+        self.assertIsNone(errors['shop1.yaml'])
+        self.assertIsNotNone(errors['missing.yaml'])
+        self.assertEqual(summary['items'], 4)
+
+    def test_database_error_is_reported(self):
+        price_list = yaml.safe_load(Path(self.directory.name, 'shop2.yaml').read_text(encoding='utf-8'))
+        price_list['goods'][0]['price'] = -1
+        Path(self.directory.name, 'shop0.yaml').write_text(
+            yaml.safe_dump(price_list, sort_keys=False, allow_unicode=True), encoding='utf-8')
+        summary = run_imports([{'path': str(Path(self.directory.name, name))} for name in ('shop0.yaml', 'shop1.yaml')])
+        errors = {Path(shop['source']).name: shop['error'] for shop in summary['shops']}
+        self.assertIsNotNone(errors['shop0.yaml'])
+        self.assertIsNone(errors['shop1.yaml'])
+        self.assertEqual(list(Shop.objects.values_list('name', flat=True)), ['Магазин 1'])
+
+
+class FeedSourceTest(FeedServerMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='shop@example.com', username='shop', password='password123',
+                                             type='shop', is_active=True)
+        self.path = settings.BASE_DIR.parent / 'data' / 'shop1.yaml'
+        self.data = self.path.read_bytes()
+
+    def test_unchanged_feed_is_skipped_by_etag(self):
+        server, url = self.start_feed_server(self.data, etag='"v1"')
+        stats = import_url(url, user=self.user)
+        self.assertFalse(stats.skipped)
+        self.assertEqual(stats.created, 4)
+        self.assertEqual(Shop.objects.get(id=stats.shop_id).feed_etag, '"v1"')
+
+        with mock.patch('shop_app.sources.import_price_list') as import_mock:
+            stats = import_url(url, user=self.user)
+        self.assertTrue(stats.skipped)
+        import_mock.assert_not_called()
+        self.assertEqual(server.requests[-1]['If-None-Match'], '"v1"')
+
+    def test_unchanged_feed_is_skipped_by_hash(self):
+        server, url = self.start_feed_server(self.data)
+        self.assertFalse(import_url(url, user=self.user).skipped)
+        with mock.patch('shop_app.sources.import_price_list') as import_mock:
+            self.assertTrue(import_url(url, user=self.user).skipped)
+        import_mock.assert_not_called()
+
+        server.body = self.data.replace(b'price: 110000', b'price: 100000')
+        stats = import_url(url, user=self.user)
+        self.assertFalse(stats.skipped)
+        self.assertTrue(ProductInfo.objects.filter(shop_id=stats.shop_id, price=100000).exists())
+        self.assertFalse(import_url(url, user=self.user, force=True).skipped)
+
+    def test_import_path(self):
+        stats = import_path(self.path, user=self.user)
+        self.assertEqual(stats.items, 4)
+        with tempfile.NamedTemporaryFile(suffix='.yaml') as empty:
+            with self.assertRaises(PriceListError):
+                import_path(empty.name)
+
+    def test_import_shop_file(self):
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            shop = Shop.objects.create(name='Связной', user=self.user)
+            shop.filename.save('shop1.yaml', ContentFile(self.data))
+            client = APIClient()
+            client.force_authenticate(self.user)
+            response = client.post(reverse('partner-update'), {})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data['items'], 4)
+            self.assertFalse(response.data['skipped'])
+
+            shop.refresh_from_db()
+            self.assertTrue(import_shop_file(shop).skipped)
+            self.assertEqual(import_shop_file(shop, force=True).items, 4)
+
+    def test_unknown_category_is_bad_request(self):
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            shop = Shop.objects.create(name='Связной', user=self.user)
+            shop.filename.save('shop1.yaml', ContentFile(self.data.replace(b'category: 224', b'category: 999', 1)))
+            client = APIClient()
+            client.force_authenticate(self.user)
+            response = client.post(reverse('partner-update'), {})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn('4216292', response.data['error'])
+            self.assertFalse(ProductInfo.objects.exists())
+
+
+class CartStorageTest(TestCase):
+    def setUp(self):
+        get_cart_storage.cache_clear()
+        self.user = User.objects.create_user(email='buyer@example.com', username='buyer', password='password123',
+                                             is_active=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        shop = Shop.objects.create(name='Shop 1')
+        category = Category.objects.create(name='Категория')
+        self.infos = [ProductInfo.objects.create(product=Product.objects.create(name=f'Товар {i}', category=category),
+                                                 shop=shop, external_id=i, quantity=10, price=100 * (i + 1),
+                                                 price_rrc=110)
+                      for i in range(3)]
+
+    def add(self, product_info, quantity):
+        return self.client.post(reverse('cart'), {'product_info_id': product_info.id, 'quantity': quantity})
+
+    def test_add_only_checks_product(self):
+        with self.assertNumQueries(1):
+            response = self.add(self.infos[0], 2)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.add(self.infos[1], 1)
+
+        response = self.client.get(reverse('cart'))
+        self.assertEqual([item['quantity'] for item in response.data['items']], [2, 1])
+        self.assertEqual(response.data['total'], 400)
+        self.assertFalse(Order.objects.exists())
+
+    def test_write_behind_flush(self):
+        self.add(self.infos[0], 2)
+        self.add(self.infos[1], 1)
+        get_cart_storage().set(self.user.id, 10 ** 6, 1)
+        self.assertEqual(flush_dirty_carts(), 1)
+        order = Order.objects.get(user=self.user, state='basket')
+        self.assertEqual(dict(order.ordered_items.values_list('product_info_id', 'quantity')),
+                         {self.infos[0].id: 2, self.infos[1].id: 1})
+        self.assertEqual(flush_dirty_carts(), 0)
+
+        self.add(self.infos[0], 5)
+        self.client.delete(reverse('cart'), {'product_info_id': self.infos[1].id})
+        flush_dirty_carts()
+        self.assertEqual(dict(order.ordered_items.values_list('product_info_id', 'quantity')), {self.infos[0].id: 5})
+
+        get_cart_storage().clear(self.user.id)
+        flush_dirty_carts()
+        self.assertFalse(Order.objects.filter(user=self.user).exists())
+
+    def test_add_missing_product(self):
+        response = self.client.post(reverse('cart'), {'product_info_id': 10 ** 6, 'quantity': 1})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['error'], 'Product not found')
+        self.assertEqual(get_cart_storage().get(self.user.id), {})
+
+    def test_remove_missing_item(self):
+        response = self.client.delete(reverse('cart'), {'product_info_id': self.infos[0].id})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(CART_REDIS_URL=None, DEBUG=False, TESTING=False)
+    def test_memory_storage_only_for_development(self):
+        get_cart_storage.cache_clear()
+        self.addCleanup(get_cart_storage.cache_clear)
+        with self.assertRaises(ImproperlyConfigured):
+            get_cart_storage()
+
+    def test_batch_add_increments_existing_lines(self):
+        self.add(self.infos[0], 2)
+        items = [{'product_info_id': self.infos[0].id, 'quantity': 3},
+                 {'product_info_id': self.infos[1].id, 'quantity': 1},
+                 {'product_info_id': self.infos[1].id, 'quantity': 4}]
+        with self.assertNumQueries(1):
+            response = self.client.post(reverse('cart-items'), {'items': items}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(get_cart_storage().get(self.user.id), {self.infos[0].id: 5, self.infos[1].id: 5})
+
+        flush_dirty_carts()
+        self.client.post(reverse('cart-items'), {'items': items[:1]}, format='json')
+        flush_dirty_carts()
+        self.assertEqual(OrderItem.objects.get(product_info=self.infos[0]).quantity, 8)
+        self.assertEqual(OrderItem.objects.count(), 2)
+
+    def test_batch_add_unknown_offer(self):
+        items = [{'product_info_id': self.infos[0].id, 'quantity': 1}, {'product_info_id': 10 ** 6, 'quantity': 1}]
+        response = self.client.post(reverse('cart-items'), {'items': items}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['ids'], [10 ** 6])
+        self.assertEqual(get_cart_storage().get(self.user.id), {})
+
+    def test_batch_delete(self):
+        for info in self.infos:
+            self.add(info, 1)
+        response = self.client.delete(reverse('cart-items'),
+                                      {'items': [self.infos[0].id, self.infos[1].id, 10 ** 6]}, format='json')
+        self.assertEqual(response.data['deleted'], 2)
+        self.assertEqual(get_cart_storage().get(self.user.id), {self.infos[2].id: 1})
+
+
+class CheckoutTest(TestCase):
+    def setUp(self):
+        get_cart_storage.cache_clear()
+        self.user = User.objects.create_user(email='buyer@example.com', username='buyer', password='password123',
+                                             is_active=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        shop = Shop.objects.create(name='Shop 1')
+        category = Category.objects.create(name='Категория')
+        self.infos = [ProductInfo.objects.create(product=Product.objects.create(name=f'Товар {i}', category=category),
+                                                 shop=shop, external_id=i, quantity=5, price=100, price_rrc=110)
+                      for i in range(2)]
+
+    def test_checkout(self):
+        storage = get_cart_storage()
+        storage.set(self.user.id, self.infos[0].id, 2)
+        storage.set(self.user.id, self.infos[1].id, 5)
+        with mock.patch('shop_app.tasks.send_email.delay') as delay, self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('checkout'), {})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        order = Order.objects.get(id=response.data['order_id'])
+        self.assertEqual(order.state, 'new')
+        self.assertEqual(order.ordered_items.count(), 2)
+        self.assertEqual([info.quantity for info in ProductInfo.objects.order_by('id')], [3, 0])
+        self.assertEqual(storage.get(self.user.id), {})
+        delay.assert_called_once()
+
+    def test_insufficient_stock(self):
+        get_cart_storage().set(self.user.id, self.infos[0].id, 2)
+        get_cart_storage().set(self.user.id, self.infos[1].id, 6)
+        response = self.client.post(reverse('checkout'), {})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['items'], [{'product_info_id': self.infos[1].id, 'requested': 6, 'available': 5}])
+        self.assertEqual([info.quantity for info in ProductInfo.objects.order_by('id')], [5, 5])
+        self.assertFalse(Order.objects.filter(state='new').exists())
+
+    def test_empty_cart(self):
+        response = self.client.post(reverse('checkout'), {})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@skipUnless(connection.features.has_select_for_update, 'нужна СУБД с блокировкой строк (PostgreSQL)')
+class CheckoutConcurrencyTest(TransactionTestCase):
+    """
+    Параллельные оформления не продают больше, чем есть на складе, и не
+    взаимоблокируются при пересекающихся корзинах.
+    """
+    buyers = 40
+    stock = 50
+
+    def setUp(self):
+        get_cart_storage.cache_clear()
+        shop = Shop.objects.create(name='Shop 1')
+        category = Category.objects.create(name='Категория')
+        self.infos = [ProductInfo.objects.create(product=Product.objects.create(name=f'Товар {i}', category=category),
+                                                 shop=shop, external_id=i, quantity=self.stock, price=100,
+                                                 price_rrc=110)
+                      for i in range(2)]
+        self.users = User.objects.bulk_create([User(email=f'buyer{i}@example.com', username=f'buyer{i}', is_active=True)
+                                               for i in range(self.buyers)])
+        storage = get_cart_storage()
+        for number, user in enumerate(self.users):
+            # Половина корзин добавляет товары в обратном порядке
+            lines = [(self.infos[0].id, 3), (self.infos[1].id, 2)]
+            for product_info_id, quantity in (lines if number % 2 else lines[::-1]):
+                storage.set(user.id, product_info_id, quantity)
+
+    def test_no_overselling(self):
+        barrier = threading.Barrier(self.buyers)
+        results = []
+
+        def buy(user):
+            try:
+                barrier.wait()
+                checkout(user)
+                results.append('ok')
+            except InsufficientStock:
+                results.append('short')
+            except Exception as e:
+                results.append(repr(e))
+            finally:
+                connections.close_all()
+
+        with mock.patch('shop_app.tasks.send_email.delay'):
+            threads = [threading.Thread(target=buy, args=(user,)) for user in self.users]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        sold = results.count('ok')
+        self.assertEqual(sold + results.count('short'), self.buyers, results)
+        self.assertEqual(sold, self.stock // 3)
+        self.assertEqual([info.quantity for info in ProductInfo.objects.order_by('id')],
+                         [self.stock - 3 * sold, self.stock - 2 * sold])
+        self.assertEqual(Order.objects.filter(state='new').count(), sold)
+
+
+class OrderTotalsTest(TestCase):
+    def setUp(self):
+        get_cart_storage.cache_clear()
+        self.user = User.objects.create_user(email='buyer@example.com', username='buyer', password='password123',
+                                             is_active=True)
+        category = Category.objects.create(name='Категория')
+        self.shops = [Shop.objects.create(name=f'Shop {i}') for i in range(2)]
+        self.infos = [ProductInfo.objects.create(product=Product.objects.create(name=f'Товар {i}', category=category),
+                                                 shop=self.shops[i % 2], external_id=i, quantity=10,
+                                                 price=100 * (i + 1), price_rrc=110)
+                      for i in range(3)]
+        self.order = Order.objects.create(user=self.user, state='new')
+
+    def assertTotals(self, total_sum, items_count, shops):
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.total_sum, self.order.items_count), (total_sum, items_count))
+        self.assertEqual({shop_order.shop_id: (shop_order.total_sum, shop_order.items_count)
+                          for shop_order in self.order.shop_orders.all()}, shops)
+
+    def test_item_changes(self):
+        item = OrderItem.objects.create(order=self.order, product_info=self.infos[0], quantity=2)
+        OrderItem.objects.create(order=self.order, product_info=self.infos[1], quantity=1)
+        self.assertTotals(400, 3, {self.shops[0].id: (200, 2), self.shops[1].id: (200, 1)})
+
+        item.quantity = 5
+        item.save()
+        self.assertTotals(700, 6, {self.shops[0].id: (500, 5), self.shops[1].id: (200, 1)})
+
+        item.delete()
+        self.assertTotals(200, 1, {self.shops[1].id: (200, 1)})
+
+        self.infos[1].delete()
+        self.assertTotals(0, 0, {})
+
+    def test_price_change_then_reduce_or_delete(self):
+        item = OrderItem.objects.create(order=self.order, product_info=self.infos[0], quantity=2)
+        ProductInfo.objects.filter(id=self.infos[0].id).update(price=300)
+        item.quantity = 1
+        item.save()
+        self.assertTotals(100, 1, {self.shops[0].id: (100, 1)})
+        item.delete()
+        self.assertTotals(0, 0, {})
+
+        storage = get_cart_storage()
+        storage.set(self.user.id, self.infos[1].id, 2)
+        basket = flush_cart(self.user.id)
+        ProductInfo.objects.filter(id=self.infos[1].id).update(price=50)
+        storage.set(self.user.id, self.infos[1].id, 1)
+        flush_cart(self.user.id)
+        basket.refresh_from_db()
+        self.assertEqual((basket.total_sum, basket.items_count), (200, 1))
+        storage.remove(self.user.id, [self.infos[1].id])
+        storage.set(self.user.id, self.infos[2].id, 1)
+        flush_cart(self.user.id)
+        basket.refresh_from_db()
+        self.assertEqual((basket.total_sum, basket.items_count), (300, 1))
+
+        storage.set(self.user.id, self.infos[1].id, 1)
+        flush_cart(self.user.id)
+        ProductInfo.objects.filter(id=self.infos[2].id).update(price=10)
+        with mock.patch('shop_app.tasks.send_email.delay'):
+            order = checkout(self.user)
+        order.refresh_from_db()
+        self.assertEqual((order.total_sum, order.items_count), (60, 2))
+        self.assertEqual(dict(order.shop_orders.values_list('shop_id', 'total_sum')),
+                         {self.shops[0].id: 10, self.shops[1].id: 50})
+
+    def test_cart_flush_and_checkout(self):
+        storage = get_cart_storage()
+        storage.set(self.user.id, self.infos[0].id, 1)
+        storage.set(self.user.id, self.infos[2].id, 2)
+        basket = flush_cart(self.user.id)
+        basket.refresh_from_db()
+        self.assertEqual((basket.total_sum, basket.items_count), (700, 3))
+
+        storage.remove(self.user.id, [self.infos[2].id])
+        storage.set(self.user.id, self.infos[1].id, 1)
+        with mock.patch('shop_app.tasks.send_email.delay'):
+            order = checkout(self.user)
+        order.refresh_from_db()
+        self.assertEqual((order.total_sum, order.items_count), (300, 2))
+        self.assertEqual(dict(order.shop_orders.values_list('shop_id', 'total_sum')),
+                         {self.shops[0].id: 100, self.shops[1].id: 200})
+
+    def test_recalculate(self):
+        OrderItem.objects.create(order=self.order, product_info=self.infos[0], quantity=2)
+        OrderItem.objects.create(order=self.order, product_info=self.infos[1], quantity=1)
+        Order.objects.filter(id=self.order.id).update(total_sum=1, items_count=1)
+        ShopOrder.objects.filter(order=self.order, shop=self.shops[1]).delete()
+        ShopOrder.objects.create(order=self.order, shop=Shop.objects.create(name='Shop 3'), total_sum=5, items_count=5)
+
+        call_command('recalculate_order_totals', stdout=io.StringIO())
+        self.assertTotals(400, 3, {self.shops[0].id: (200, 2), self.shops[1].id: (200, 1)})
+
+    def test_orders_list_without_aggregation(self):
+        OrderItem.objects.create(order=self.order, product_info=self.infos[0], quantity=2)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        # Заказы и их позиции, без агрегации по OrderItem
+        with self.assertNumQueries(2):
+            response = client.get(reverse('user-orders'))
+        self.assertEqual(response.data['results'][0]['total_sum'], 200)
+        self.assertEqual(response.data['results'][0]['items_count'], 2)
+
+
+class ShopOrderSplitTest(TestCase):
+    def setUp(self):
+        get_cart_storage.cache_clear()
+        self.buyer = User.objects.create_user(email='buyer@example.com', username='buyer', password='password123',
+                                              is_active=True)
+        self.supplier = User.objects.create_user(email='shop@example.com', username='shop', password='password123',
+                                                 type='shop', is_active=True)
+        category = Category.objects.create(name='Категория')
+        self.shops = [Shop.objects.create(name='Shop 1', user=self.supplier, delivery_cost=300, free_delivery_from=500),
+                      Shop.objects.create(name='Shop 2', delivery_cost=200)]
+        self.infos = [ProductInfo.objects.create(product=Product.objects.create(name=f'Товар {i}', category=category),
+                                                 shop=shop, external_id=i, quantity=10, price=100, price_rrc=110)
+                      for i, shop in enumerate(self.shops)]
+
+    def test_checkout_splits_order_by_shop(self):
+        storage = get_cart_storage()
+        storage.set(self.buyer.id, self.infos[0].id, 5)
+        storage.set(self.buyer.id, self.infos[1].id, 1)
+        client = APIClient()
+        client.force_authenticate(self.buyer)
+        response = client.get(reverse('cart'))
+        self.assertEqual((response.data['total'], response.data['delivery_cost']), (600, 200))
+
+        with mock.patch('shop_app.tasks.send_email.delay'):
+            order = checkout(self.buyer)
+        order.refresh_from_db()
+        self.assertEqual((order.total_sum, order.delivery_cost), (600, 200))
+        self.assertEqual({shop_order.shop_id: (shop_order.state, shop_order.total_sum, shop_order.delivery_cost)
+                          for shop_order in order.shop_orders.all()},
+                         {self.shops[0].id: ('new', 500, 0), self.shops[1].id: ('new', 100, 200)})
+
+    def test_supplier_sees_only_own_checked_out_parts(self):
+        storage = get_cart_storage()
+        storage.set(self.buyer.id, self.infos[0].id, 1)
+        storage.set(self.buyer.id, self.infos[1].id, 1)
+        with mock.patch('shop_app.tasks.send_email.delay'):
+            order = checkout(self.buyer)
+        storage.set(self.buyer.id, self.infos[0].id, 2)
+        flush_cart(self.buyer.id)
+
+        client = APIClient()
+        client.force_authenticate(self.supplier)
+        response = client.get(reverse('shop-orders'))
+        self.assertEqual([(item['order'], item['total_sum'], item['delivery_cost'])
+                          for item in response.data['results']],
+                         [(order.id, 100, 300)])
+
+
+class ShopOrderFeedTest(TestCase):
+    def setUp(self):
+        self.supplier = User.objects.create_user(email='shop@example.com', username='shop', password='password123',
+                                                 type='shop', is_active=True)
+        self.buyer = User.objects.create_user(email='buyer@example.com', username='buyer', password='password123',
+                                              is_active=True)
+        self.contact = Contact.objects.create(user=self.buyer, city='Москва', street='Тверская', phone='123')
+        self.shop = Shop.objects.create(name='Shop 1', user=self.supplier)
+        other_shop = Shop.objects.create(name='Shop 2')
+        category = Category.objects.create(name='Категория')
+        color = Parameter.objects.create(name='Цвет')
+        self.infos = []
+        for i, shop in enumerate([self.shop, self.shop, other_shop]):
+            info = ProductInfo.objects.create(product=Product.objects.create(name=f'Товар {i}', category=category),
+                                              shop=shop, external_id=i, model=f'M{i}', quantity=100, price=100,
+                                              price_rrc=110)
+            ProductParameter.objects.create(product_info=info, parameter=color, value='черный')
+            self.infos.append(info)
+        self.client = APIClient()
+        self.client.force_authenticate(self.supplier)
+
+    def create_orders(self, count):
+        orders = []
+        for _ in range(count):
+            order = Order.objects.create(user=self.buyer, state='new', contact=self.contact)
+            for info in self.infos:
+                OrderItem.objects.create(order=order, product_info=info, quantity=2)
+            ShopOrder.objects.filter(order=order).update(state='new')
+            orders.append(order)
+        return orders
+
+    def test_query_count_does_not_depend_on_size(self):
+        self.create_orders(2)
+        with self.assertNumQueries(4):
+            self.client.get(reverse('shop-orders'))
+        self.create_orders(10)
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('shop-orders'))
+        self.assertEqual(len(response.data['results']), 12)
+
+        item = response.data['results'][0]
+        self.assertEqual(item['contact']['city'], 'Москва')
+        self.assertEqual([line['product_info'] for line in item['items']], [self.infos[0].id, self.infos[1].id])
+        self.assertEqual(item['items'][0]['parameters'], {'Цвет': 'черный'})
+        self.assertEqual(item['total_sum'], 400)
+
+    def test_keyset_pagination_and_since(self):
+        orders = self.create_orders(5)
+        Order.objects.filter(id__in=[order.id for order in orders[:2]]).update(dt=timezone.now() - timedelta(days=2))
+
+        response = self.client.get(reverse('shop-orders'), {'page_size': 2})
+        seen = [item['order'] for item in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            seen.extend(item['order'] for item in response.data['results'])
+        self.assertEqual(seen, [order.id for order in reversed(orders)])
+
+        since = (timezone.now() - timedelta(days=1)).isoformat()
+        response = self.client.get(reverse('shop-orders'), {'since': since})
+        self.assertEqual([item['order'] for item in response.data['results']],
+                         [order.id for order in reversed(orders[2:])])
+        response = self.client.get(reverse('shop-orders'), {'since': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class KeysetPaginationTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='buyer@example.com', username='buyer', password='password123',
+                                             is_active=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def collect(self, url, params):
+        response = self.client.get(url, params)
+        pages = [response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            pages.append(response.data['results'])
+        return pages
+
+    def test_products_with_duplicate_names(self):
+        categories = Category.objects.bulk_create([Category(name=f'Категория {i}') for i in range(4)])
+        products = Product.objects.bulk_create([Product(name=f'Товар {i % 3}', category=categories[i // 3])
+                                                for i in range(10)])
+        pages = self.collect(reverse('search'), {'page_size': 4})
+        self.assertEqual([len(page) for page in pages], [4, 4, 2])
+        expected = sorted(products, key=lambda product: (product.name, product.id))
+        self.assertEqual([item['name'] for page in pages for item in page], [product.name for product in expected])
+
+    def test_orders_with_equal_dates(self):
+        orders = Order.objects.bulk_create([Order(user=self.user, state='new') for _ in range(5)])
+        Order.objects.update(dt=timezone.now())
+        pages = self.collect(reverse('user-orders'), {'page_size': 2})
+        self.assertEqual([item['id'] for page in pages for item in page],
+                         sorted((order.id for order in orders), reverse=True))
+
+    def test_deep_page_uses_keyset_condition(self):
+        Contact.objects.bulk_create([Contact(user=self.user, city='Москва', street=str(i), phone='1')
+                                     for i in range(5)])
+        response = self.client.get(reverse('contacts'), {'page_size': 2})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(response.data['next'])
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertNotIn('OFFSET', queries[-1]['sql'].upper())
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('contacts'), {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class UserOrderHistoryTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='buyer@example.com', username='buyer', password='password123',
+                                             is_active=True)
+        category = Category.objects.create(name='Категория')
+        self.shops = [Shop.objects.create(name=f'Shop {i}') for i in range(2)]
+        self.infos = [ProductInfo.objects.create(product=Product.objects.create(name=f'Товар {i}', category=category),
+                                                 shop=self.shops[i % 2], external_id=i, quantity=10,
+                                                 price=100 * (i + 1), price_rrc=110)
+                      for i in range(3)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_orders(self, count, state='new'):
+        orders = []
+        for _ in range(count):
+            order = Order.objects.create(user=self.user, state=state)
+            for info in self.infos:
+                OrderItem.objects.create(order=order, product_info=info, quantity=2)
+            orders.append(order)
+        return orders
+
+    def test_query_count_does_not_depend_on_size(self):
+        self.create_orders(2)
+        with self.assertNumQueries(2):
+            self.client.get(reverse('user-orders'))
+        self.create_orders(10)
+        # Позиции показываются по цене на момент заказа
+        ProductInfo.objects.filter(id=self.infos[1].id).update(price=900)
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('user-orders'))
+        self.assertEqual(len(response.data['results']), 12)
+
+        order = response.data['results'][0]
+        self.assertEqual((order['total_sum'], order['items_count']), (1200, 6))
+        self.assertEqual(order['items'][1], {'product_info': self.infos[1].id, 'product': 'Товар 1',
+                                             'shop': {'id': self.shops[1].id, 'name': 'Shop 1'},
+                                             'price': 200, 'quantity': 2, 'sum': 400})
+
+    def test_filters(self):
+        old = self.create_orders(1, state='delivered')[0]
+        Order.objects.filter(id=old.id).update(dt=timezone.now() - timedelta(days=10))
+        delivered, new = self.create_orders(1, state='delivered')[0], self.create_orders(1)[0]
+        self.create_orders(1, state='basket')
+
+        def ids(params):
+            response = self.client.get(reverse('user-orders'), params)
+            return [order['id'] for order in response.data['results']]
+
+        self.assertEqual(ids({}), [new.id, delivered.id, old.id])
+        self.assertEqual(ids({'state': 'delivered'}), [delivered.id, old.id])
+        self.assertEqual(ids({'date_from': (timezone.now() - timedelta(days=1)).isoformat()}), [new.id, delivered.id])
+        self.assertEqual(ids({'date_to': (timezone.now() - timedelta(days=1)).isoformat()}), [old.id])
+
+        response = self.client.get(reverse('user-orders'), {'state': 'unknown', 'date_from': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(set(response.data), {'state', 'date_from'})
+
+
+class OrderStateTransitionTest(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_user(email='admin@example.com', username='admin', password='password123',
+                                              is_active=True, is_staff=True)
+        self.supplier = User.objects.create_user(email='shop@example.com', username='shop', password='password123',
+                                                 type='shop', is_active=True)
+        self.buyers = [User.objects.create_user(email=f'buyer{i}@example.com', username=f'buyer{i}',
+                                                password='password123', is_active=True) for i in range(2)]
+        self.shops = [Shop.objects.create(name='Shop 1', user=self.supplier), Shop.objects.create(name='Shop 2')]
+        self.client = APIClient()
+
+    def create_orders(self, count, state='new', shops=1):
+        orders = Order.objects.bulk_create([Order(user=self.buyers[i % 2], state=state) for i in range(count)])
+        ShopOrder.objects.bulk_create([ShopOrder(order=order, shop=shop, state=state)
+                                       for order in orders for shop in self.shops[:shops]])
+        return orders
+
+    def transition(self, user, order_ids, state):
+        self.client.force_authenticate(user)
+        with mock.patch('shop_app.states.notify_state_change.delay') as delay, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('order-state'), {'order_ids': order_ids, 'state': state},
+                                        format='json')
+        return response, delay
+
+    def test_bulk_transition_is_one_update(self):
+        orders = self.create_orders(50)
+        canceled, basket = self.create_orders(1, state='canceled')[0], self.create_orders(1, state='basket')[0]
+        order_ids = [order.id for order in orders] + [canceled.id, basket.id]
+
+        with CaptureQueriesContext(connection) as queries:
+            response, delay = self.transition(self.admin, order_ids, 'confirmed')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['changed'], response.data['skipped']), (50, [canceled.id, basket.id]))
+        self.assertEqual(len([query for query in queries
+                              if query['sql'].startswith('UPDATE "shop_app_order"')]), 1)
+
+        self.assertEqual(Order.objects.filter(state='confirmed').count(), 50)
+        self.assertEqual(ShopOrder.objects.filter(state='confirmed').count(), 50)
+        self.assertEqual(Order.objects.get(id=canceled.id).state, 'canceled')
+        change = OrderStateChange.objects.get()
+        self.assertEqual((change.user, change.state, change.requested, len(change.orders)),
+                         (self.admin, 'confirmed', 52, 50))
+        delay.assert_called_once_with(change.id)
+
+    def test_shop_changes_its_part(self):
+        order = self.create_orders(1, shops=2)[0]
+        response, _ = self.transition(self.supplier, [order.id], 'confirmed')
+        self.assertEqual(response.data['changed'], 1)
+        self.assertEqual(dict(order.shop_orders.values_list('shop_id', 'state')),
+                         {self.shops[0].id: 'confirmed', self.shops[1].id: 'new'})
+        order.refresh_from_db()
+        self.assertEqual(order.state, 'new')
+
+        transition_orders([order.id], 'confirmed', shop=self.shops[1])
+        order.refresh_from_db()
+        self.assertEqual(order.state, 'confirmed')
+
+    def test_shop_partial_cancel_does_not_notify_buyer(self):
+        order = self.create_orders(1, shops=2)[0]
+        response, delay = self.transition(self.supplier, [order.id], 'canceled')
+        self.assertEqual((response.data['changed'], response.data['skipped']), (1, []))
+        order.refresh_from_db()
+        self.assertEqual(order.state, 'new')
+        change = OrderStateChange.objects.get()
+        self.assertEqual(change.orders, [])
+        self.assertEqual(change.shop_orders, [order.shop_orders.get(shop=self.shops[0]).id])
+        delay.assert_not_called()
+
+        response, delay = self.transition(self.admin, [order.id], 'canceled')
+        order.refresh_from_db()
+        self.assertEqual(order.state, 'canceled')
+        delay.assert_called_once_with(OrderStateChange.objects.latest('id').id)
+
+    def test_admin_skips_order_with_part_without_transition(self):
+        order = self.create_orders(1, state='assembled', shops=2)[0]
+        ShopOrder.objects.filter(order=order, shop=self.shops[0]).update(state='sent')
+        response, delay = self.transition(self.admin, [order.id], 'canceled')
+        self.assertEqual((response.data['changed'], response.data['skipped']), (0, [order.id]))
+        self.assertEqual(dict(order.shop_orders.values_list('shop_id', 'state')),
+                         {self.shops[0].id: 'sent', self.shops[1].id: 'assembled'})
+        order.refresh_from_db()
+        self.assertEqual(order.state, 'assembled')
+        delay.assert_not_called()
+
+    def test_state_not_writable_on_create(self):
+        self.client.force_authenticate(self.buyers[0])
+        response = self.client.post(reverse('user-orders'), {'state': 'delivered'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Order.objects.get(id=response.data['id']).state, 'basket')
+
+    def test_not_allowed(self):
+        order = self.create_orders(1, state='delivered')[0]
+        response, delay = self.transition(self.admin, [order.id], 'sent')
+        self.assertEqual(response.data['skipped'], [order.id])
+        delay.assert_not_called()
+
+        response, _ = self.transition(self.admin, [order.id], 'new')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        with self.assertRaises(TransitionError):
+            transition_orders([order.id], 'basket')
+
+        response, _ = self.transition(self.buyers[0], [order.id], 'canceled')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_notification_per_buyer(self):
+        orders = self.create_orders(5)
+        with self.captureOnCommitCallbacks():
+            change = transition_orders([order.id for order in orders], 'confirmed', user=self.admin)
+        notify_state_change(change.id)
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox),
+                         ['buyer0@example.com', 'buyer1@example.com'])
+        self.assertIn(f'№{orders[0].id}', next(message.body for message in mail.outbox
+                                               if message.to == ['buyer0@example.com']))
+
+
+class IdempotencyKeyTest(TestCase):
+    def setUp(self):
+        get_cart_storage.cache_clear()
+        self.user = User.objects.create_user(email='buyer@example.com', username='buyer', password='password123',
+                                             is_active=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        shop = Shop.objects.create(name='Shop 1')
+        category = Category.objects.create(name='Категория')
+        self.info = ProductInfo.objects.create(product=Product.objects.create(name='Товар', category=category),
+                                               shop=shop, external_id=1, quantity=5, price=100, price_rrc=110)
+
+    def test_checkout_retry_returns_stored_response(self):
+        get_cart_storage().set(self.user.id, self.info.id, 2)
+        with mock.patch('shop_app.tasks.send_email.delay'), self.captureOnCommitCallbacks(execute=True):
+            first = self.client.post(reverse('checkout'), {}, HTTP_IDEMPOTENCY_KEY='checkout-1')
+        # Повтор после оформления: корзина уже пуста, но заказ не создается заново
+        with self.assertNumQueries(1):
+            retry = self.client.post(reverse('checkout'), {}, HTTP_IDEMPOTENCY_KEY='checkout-1')
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual((retry.status_code, retry.data), (first.status_code, first.data))
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(Order.objects.filter(state='new').count(), 1)
+        self.info.refresh_from_db()
+        self.assertEqual(self.info.quantity, 3)
+
+    def test_cart_increment_applied_once(self):
+        for _ in range(3):
+            response = self.client.post(reverse('cart-items'), {'items': [{'product_info_id': self.info.id,
+                                                                           'quantity': 2}]},
+                                        format='json', HTTP_IDEMPOTENCY_KEY='cart-1')
+        self.assertEqual(response.data, {'items': {str(self.info.id): 2}})
+        self.assertEqual(get_cart_storage().get(self.user.id), {self.info.id: 2})
+
+        response = self.client.post(reverse('cart-items'), {'items': [{'product_info_id': self.info.id,
+                                                                       'quantity': 1}]},
+                                    format='json', HTTP_IDEMPOTENCY_KEY='cart-1')
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    def test_in_progress_and_expired(self):
+        record, created = claim_key(self.user, 'orders-1', 'fingerprint')
+        self.assertTrue(created)
+        self.assertEqual(claim_key(self.user, 'orders-1', 'fingerprint'), (record, False))
+        response = self.client.post(reverse('checkout'), {}, HTTP_IDEMPOTENCY_KEY='orders-1')
+        self.assertIn(response.status_code, (status.HTTP_409_CONFLICT, status.HTTP_422_UNPROCESSABLE_ENTITY))
+
+        IdempotencyKey.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertTrue(claim_key(self.user, 'orders-1', 'fingerprint')[1])
+        IdempotencyKey.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(purge_expired_keys(), 1)
+
+    def test_interrupted_request_retried_after_lock_timeout(self):
+        def add():
+            return self.client.post(reverse('cart-items'), {'items': [{'product_info_id': self.info.id,
+                                                                       'quantity': 2}]},
+                                    format='json', HTTP_IDEMPOTENCY_KEY='cart-1')
+
+        add()
+        # Процесс упал после выполнения запроса, не сохранив ответ
+        IdempotencyKey.objects.update(status_code=None, response=None)
+        self.assertEqual(add().status_code, status.HTTP_409_CONFLICT)
+
+        IdempotencyKey.objects.update(locked_until=timezone.now() - timedelta(seconds=1))
+        response = add()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(IdempotencyKey.objects.get().status_code, status.HTTP_200_OK)
+        self.assertEqual(add()['Idempotent-Replayed'], 'true')
+        self.assertEqual(get_cart_storage().get(self.user.id), {self.info.id: 4})
+
+    def test_without_key(self):
+        self.client.post(reverse('cart-items'), {'items': [{'product_info_id': self.info.id, 'quantity': 2}]},
+                         format='json')
+        self.client.post(reverse('cart-items'), {'items': [{'product_info_id': self.info.id, 'quantity': 2}]},
+                         format='json')
+        self.assertEqual(get_cart_storage().get(self.user.id), {self.info.id: 4})
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+
+@skipUnless(connection.features.has_select_for_update, 'нужна СУБД с блокировкой строк (PostgreSQL)')
+class IdempotencyConcurrencyTest(TransactionTestCase):
+    """
+    Одновременные запросы с одним ключом создают один заказ.
+    """
+    requests = 10
+
+    def setUp(self):
+        get_cart_storage.cache_clear()
+        self.user = User.objects.create_user(email='buyer@example.com', username='buyer', password='password123',
+                                             is_active=True)
+        shop = Shop.objects.create(name='Shop 1')
+        category = Category.objects.create(name='Категория')
+        info = ProductInfo.objects.create(product=Product.objects.create(name='Товар', category=category),
+                                          shop=shop, external_id=1, quantity=50, price=100, price_rrc=110)
+        get_cart_storage().set(self.user.id, info.id, 1)
+
+    def test_duplicates_collapsed(self):
+        barrier = threading.Barrier(self.requests)
+        results = []
+
+        def post():
+            client = APIClient()
+            client.force_authenticate(self.user)
+            try:
+                barrier.wait()
+                results.append(client.post(reverse('checkout'), {}, HTTP_IDEMPOTENCY_KEY='checkout-1').status_code)
+            finally:
+                connections.close_all()
+
+        with mock.patch('shop_app.tasks.send_email.delay'):
+            threads = [threading.Thread(target=post) for _ in range(self.requests)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(results), self.requests)
+        self.assertTrue(set(results) <= {status.HTTP_201_CREATED, status.HTTP_409_CONFLICT}, results)
+        self.assertEqual(Order.objects.filter(state='new').count(), 1)
+        self.assertEqual(IdempotencyKey.objects.get().status_code, status.HTTP_201_CREATED)
+
+
+class CachedTokenAuthenticationTest(TestCase):
+    def setUp(self):
+        # Пользователи по токенам кэшируются в общем кэше и в памяти процесса
+        cache.clear()
+        local_cache.clear()
+        self.user = User.objects.create_user(email='buyer@example.com', username='buyer', password='password123',
+                                             is_active=True)
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+
+    def test_cached_user_without_queries(self):
+        self.assertEqual(self.client.get(reverse('profile')).status_code, status.HTTP_200_OK)
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('profile'))
+        self.assertEqual(response.data['email'], 'buyer@example.com')
+        self.assertNotIn('password', response.data)
+
+        # Процесс без записи в локальном кэше берет пользователя из общего
+        local_cache.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(reverse('profile')).status_code, status.HTTP_200_OK)
+
+    def test_password_hash_not_cached(self):
+        self.client.get(reverse('profile'))
+        values = cache.get(cache_key(self.token.key))
+        self.assertEqual(values['email'], 'buyer@example.com')
+        self.assertNotIn('password', values)
+        self.assertNotIn(self.user.password, str(values))
+
+        user = get_cached_user(self.token.key)
+        self.assertEqual((user.id, user.is_active, user.type), (self.user.id, True, 'buyer'))
+        with self.assertNumQueries(1):
+            self.assertTrue(user.check_password('password123'))
+
+    def test_logout_and_rotation(self):
+        self.client.get(reverse('profile'))
+        response = self.client.post(reverse('token-rotate'))
+        new_key = response.data['token']
+        self.assertEqual(self.client.get(reverse('profile')).status_code, status.HTTP_401_UNAUTHORIZED)
+
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + new_key)
+        self.client.get(reverse('profile'))
+        self.client.post(reverse('logout'))
+        self.assertEqual(self.client.get(reverse('profile')).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_user_changes(self):
+        self.client.get(reverse('profile'))
+        self.user.set_password('new-password')
+        self.user.save()
+        self.assertEqual(self.client.get(reverse('profile')).status_code, status.HTTP_200_OK)
+        self.assertTrue(self.client.get(reverse('profile')).wsgi_request.user.check_password('new-password'))
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get(reverse('profile')).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_local_cache(self):
+        local = LocalCache(maxsize=2, ttl=60)
+        for key in 'abc':
+            local.set(key, key)
+        self.assertEqual([local.get(key) for key in 'abc'], [None, 'b', 'c'])
+        expired = LocalCache(maxsize=2, ttl=-1)
+        expired.set('a', 'a')
+        self.assertIsNone(expired.get('a'))
+
+
+class MailerTest(TestCase):
+    def messages(self, count):
+        return [build_message('Тема', f'Письмо {i}', 'shop@example.com', f'buyer{i}@example.com')
+                for i in range(count)]
+
+    def test_one_connection_for_batches(self):
+        with LocalSMTPServer() as server:
+            mailer = Mailer(batch_size=50, retries=2, connection_factory=server.connection_factory())
+            self.assertEqual(mailer.send(self.messages(120)), 120)
+            self.assertEqual(mailer.send(self.messages(10)), 10)
+            mailer.close()
+        self.assertEqual((server.connections, server.messages), (1, 130))
+
+    def test_reconnect_after_disconnect(self):
+        # Сервер закрывает соединение после 60 писем: отправка продолжается с 61-го письма
+        with LocalSMTPServer(max_messages=60) as server:
+            mailer = Mailer(batch_size=50, retries=2, connection_factory=server.connection_factory())
+            self.assertEqual(mailer.send(self.messages(100)), 100)
+            mailer.close()
+        self.assertEqual(mailer.connections_opened, 2)
+        self.assertEqual(server.messages, 100)
+
+    def test_rejected_messages_do_not_block_queue(self):
+        queue = MemoryMailQueue()
+        queue.push([{'subject': 'Тема', 'message': str(i), 'from_email': 'shop@example.com',
+                     'to_email': f'buyer{i}@example.com'} for i in range(5)])
+        with LocalSMTPServer(rejected=['buyer1@example.com', 'buyer3@example.com']) as server:
+            mailer = Mailer(batch_size=2, retries=0, connection_factory=server.connection_factory())
+            self.assertEqual(deliver_queued(queue, mailer), 3)
+            mailer.close()
+        self.assertEqual((server.connections, server.messages), (1, 3))
+        self.assertEqual(queue.pop(10), [])
+        self.assertEqual([item['to_email'] for item in queue.dead], ['buyer1@example.com', 'buyer3@example.com'])
+
+    def test_resend_only_unsent_after_connection_failure(self):
+        queue = MemoryMailQueue()
+        queue.push([{'subject': 'Тема', 'message': str(i), 'from_email': 'shop@example.com',
+                     'to_email': f'buyer{i}@example.com'} for i in range(5)])
+        with LocalSMTPServer(max_messages=3) as server:
+            mailer = Mailer(batch_size=5, retries=0, connection_factory=server.connection_factory())
+            with self.assertRaises(OSError):
+                deliver_queued(queue, mailer)
+        self.assertEqual(server.messages, 3)
+        self.assertEqual([item['to_email'] for item in queue.pop(10)], ['buyer3@example.com', 'buyer4@example.com'])
+
+    def test_deliver_queued(self):
+        queue = MemoryMailQueue()
+        queue.push([{'subject': 'Тема', 'message': str(i), 'from_email': 'shop@example.com',
+                     'to_email': f'buyer{i}@example.com'} for i in range(250)])
+        mailer = Mailer(batch_size=100, retries=0)
+        self.assertEqual(deliver_queued(queue, mailer), 250)
+        self.assertEqual(len(mail.outbox), 250)
+        self.assertEqual(queue.pop(1), [])
+
+        def broken(**kwargs):
+            raise OSError('Connection refused')
+
+        queue.push([{'subject': 'Тема', 'message': '1', 'from_email': 'shop@example.com',
+                     'to_email': 'buyer@example.com'}])
+        with self.assertRaises(OSError):
+            deliver_queued(queue, Mailer(batch_size=100, retries=1, connection_factory=broken))
+        self.assertEqual(len(queue.pop(10)), 1)
+
+    def test_benchmark_command(self):
+        output = io.StringIO()
+        call_command('bench_mail', messages=20, batch_size=10, handshake_ms=0, stdout=output)
+        self.assertIn('batched mailer: messages=20 connections=1 received=20', output.getvalue())
+
+
+class OrderDigestTest(TestCase):
+    def setUp(self):
+        get_cart_storage.cache_clear()
+        self.admin = User.objects.create_user(email='admin@example.com', username='admin', password='password123',
+                                              is_active=True, is_staff=True)
+        self.buyers = [User.objects.create_user(email=f'buyer{i}@example.com', username=f'buyer{i}',
+                                                password='password123', is_active=True,
+                                                notifications='digest' if i < 2 else 'instant') for i in range(3)]
+
+    def test_bulk_updates_in_one_digest(self):
+        orders = Order.objects.bulk_create([Order(user=self.buyers[i % 3], state='new') for i in range(300)])
+        order_ids = [order.id for order in orders]
+        for state in ('confirmed', 'assembled', 'sent'):
+            with self.captureOnCommitCallbacks():
+                change = transition_orders(order_ids, state, user=self.admin)
+            notify_state_change(change.id)
+        # Покупателю со сводкой ничего не отправлено, покупателю без сводки - по письму на операцию
+        self.assertEqual([message.to for message in mail.outbox], [['buyer2@example.com']] * 3)
+        self.assertEqual(OrderStatusEvent.objects.count(), 600)
+
+        mail.outbox = []
+        with self.assertNumQueries(2):
+            self.assertEqual(send_order_digests(), 2)
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox),
+                         ['buyer0@example.com', 'buyer1@example.com'])
+        body = next(message.body for message in mail.outbox if message.to == ['buyer0@example.com'])
+        self.assertEqual(body.count('\n'), 100)
+        self.assertIn(f'Заказ №{order_ids[0]}: Отправлен', body)
+        self.assertFalse(OrderStatusEvent.objects.exists())
+        self.assertEqual(send_order_digests(), 0)
+
+    def test_checkout_recorded_for_digest(self):
+        shop = Shop.objects.create(name='Shop 1')
+        info = ProductInfo.objects.create(product=Product.objects.create(
+            name='Товар', category=Category.objects.create(name='Категория')),
+            shop=shop, external_id=1, quantity=5, price=100, price_rrc=110)
+        get_cart_storage().set(self.buyers[0].id, info.id, 1)
+        with mock.patch('shop_app.tasks.send_email.delay') as delay, self.captureOnCommitCallbacks(execute=True):
+            order = checkout(self.buyers[0])
+        delay.assert_not_called()
+        self.assertEqual(list(OrderStatusEvent.objects.values_list('order_id', 'state')), [(order.id, 'new')])
+
+    def test_configurable_in_profile(self):
+        client = APIClient()
+        client.force_authenticate(self.buyers[0])
+        response = client.put(reverse('profile'), {'email': 'buyer0@example.com', 'username': 'buyer0',
+                                                   'password': 'password123', 'notifications': 'instant'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.buyers[0].refresh_from_db()
+        self.assertEqual(self.buyers[0].notifications, 'instant')
+        # Новые покупатели получают письмо на каждое изменение, сводки включаются в профиле
+        self.assertEqual(User.objects.create_user(email='new@example.com', username='new',
+                                                  password='password123').notifications, 'instant')
+
+
+class CeleryRoutingTest(TestCase):
+    def route(self, task):
+        return celery_app.amqp.router.route({}, task.name)
+
+    def test_queues(self):
+        self.assertEqual({task.name: self.route(task)['queue'].name for task in
+                          (send_email, deliver_mail, run_import_job, import_feed, flush_carts)},
+                         {send_email.name: 'email', deliver_mail.name: 'email', run_import_job.name: 'import',
+                          import_feed.name: 'import', flush_carts.name: 'maintenance'})
+        # Письма сброса пароля и подтверждения идут раньше сводок
+        self.assertLess(self.route(send_email)['priority'], self.route(send_order_digests)['priority'])
+
+    def test_results_only_where_read(self):
+        self.assertTrue(send_email.ignore_result)
+        self.assertTrue(run_import_job.ignore_result)
+        self.assertFalse(import_feed.ignore_result)
+
+    def test_worker_argv(self):
+        argv = worker_argv('import')
+        self.assertEqual(argv[argv.index('--queues') + 1], 'import')
+        self.assertEqual(argv[argv.index('--prefetch-multiplier') + 1], '1')
@@ -0,0 +1,111 @@
+"""
+Итоги заказов: сумма и количество товаров заказа (Order) и каждого
+магазина в заказе (ShopOrder).
+
+Итоги хранятся в самих заказах и при каждом изменении позиций меняются
+на разницу, поэтому списки заказов отдают их без агрегации по OrderItem.
+Сумма считается по цене, сохраненной в позиции заказа (OrderItem.price),
+поэтому изменение цены в каталоге итоги не искажает.
+recalculate_totals пересчитывает итоги заново по текущим позициям, а для
+оформленных заказов - и стоимость доставки.
+"""
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import F, Sum
+
+from .importer import chunked
+from .models import Order, OrderItem, ProductInfo, Shop, ShopOrder
+
+
+def get_offers(product_info_ids):
+    """
+    Магазин и цена позиций: {id позиции: (id магазина, цена)}.
+    """
+    return {product_info_id: (shop_id, price) for product_info_id, shop_id, price in
+            ProductInfo.objects.filter(id__in=list(product_info_ids)).values_list('id', 'shop_id', 'price')}
+
+
+def line_changes(old_lines, new_lines, offers=None):
+    """
+    Изменение итогов по магазинам при замене позиций old_lines на new_lines
+    ({id позиции: (количество, цена)}): {id магазина: (разница суммы, разница количества)}.
+    """
+    if offers is None:
+        offers = get_offers(set(old_lines) | set(new_lines))
+    changes = defaultdict(lambda: [0, 0])
+    for lines, sign in ((old_lines, -1), (new_lines, 1)):
+        for product_info_id, (quantity, price) in lines.items():
+            if product_info_id not in offers:
+                continue
+            shop_id = offers[product_info_id][0]
+            changes[shop_id][0] += sign * price * quantity
+            changes[shop_id][1] += sign * quantity
+    return {shop_id: tuple(change) for shop_id, change in changes.items() if change != [0, 0]}
+
+
+def apply_changes(order_id, changes):
+    """
+    Применяет изменения итогов к заказу и его частям по магазинам.
+    Части заказа без товаров удаляются.
+    """
+    if not changes:
+        return
+    with transaction.atomic():
+        Order.objects.filter(id=order_id).update(
+            total_sum=F('total_sum') + sum(total for total, _ in changes.values()),
+            items_count=F('items_count') + sum(count for _, count in changes.values()),
+        )
+        # Новые части заказа нужны только при добавлении товаров: при удалении
+        # позиций вместе с заказом создавать их нельзя
+        ShopOrder.objects.bulk_create([ShopOrder(order_id=order_id, shop_id=shop_id)
+                                       for shop_id, (_, count) in changes.items() if count > 0],
+                                      ignore_conflicts=True)
+        for shop_id, (total, count) in changes.items():
+            ShopOrder.objects.filter(order_id=order_id, shop_id=shop_id).update(
+                total_sum=F('total_sum') + total, items_count=F('items_count') + count)
+        if any(count < 0 for _, count in changes.values()):
+            ShopOrder.objects.filter(order_id=order_id, items_count=0).delete()
+
+
+def recalculate_totals(order_ids=None, batch_size=1000):
+    """
+    Пересчитывает итоги заказов пачками по batch_size заказов.
+    Стоимость доставки пересчитывается по новым суммам частей заказа,
+    корзины ее не имеют. Возвращает число пересчитанных заказов.
+    """
+    orders = Order.objects.all() if order_ids is None else Order.objects.filter(id__in=order_ids)
+    recalculated = 0
+    for batch in chunked(orders.order_by('id').values_list('id', 'state').iterator(), batch_size):
+        ids = [order_id for order_id, _ in batch]
+        placed = {order_id for order_id, state in batch if state != 'basket'}
+        order_totals = {order_id: [0, 0, 0] for order_id in ids}
+        rows = list(OrderItem.objects.filter(order_id__in=ids).values('order_id', 'product_info__shop_id').annotate(
+            total_sum=Sum(F('quantity') * F('price')), items_count=Sum('quantity')))
+        shops = Shop.objects.in_bulk({row['product_info__shop_id'] for row in rows if row['order_id'] in placed})
+        shop_orders = []
+        for row in rows:
+            delivery_cost = 0
+            if row['order_id'] in placed:
+                delivery_cost = shops[row['product_info__shop_id']].get_delivery_cost(row['total_sum'])
+            order_totals[row['order_id']][0] += row['total_sum']
+            order_totals[row['order_id']][1] += row['items_count']
+            order_totals[row['order_id']][2] += delivery_cost
+            shop_orders.append(ShopOrder(order_id=row['order_id'], shop_id=row['product_info__shop_id'],
+                                         total_sum=row['total_sum'], items_count=row['items_count'],
+                                         delivery_cost=delivery_cost))
+
+        with transaction.atomic():
+            Order.objects.bulk_update([Order(id=order_id, total_sum=total, items_count=count, delivery_cost=delivery)
+                                       for order_id, (total, count, delivery) in order_totals.items()],
+                                      ['total_sum', 'items_count', 'delivery_cost'])
+            keep = {(shop_order.order_id, shop_order.shop_id) for shop_order in shop_orders}
+            ShopOrder.objects.filter(id__in=[
+                shop_order_id for shop_order_id, order_id, shop_id in
+                ShopOrder.objects.filter(order_id__in=ids).values_list('id', 'order_id', 'shop_id')
+                if (order_id, shop_id) not in keep
+            ]).delete()
+            ShopOrder.objects.bulk_create(shop_orders, update_conflicts=True, unique_fields=['order', 'shop'],
+                                          update_fields=['total_sum', 'items_count', 'delivery_cost'])
+        recalculated += len(ids)
+    return recalculated
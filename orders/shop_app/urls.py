@@ -1,19 +1,30 @@
 from django.urls import path
 from .views import CreateShopView, RegisterBuyerView, ConfirmEmailView, \
-    LoginView, UserProfileView, ProductSearchView, ShopOrdersView, \
-        ContactView, UserOrdersView, CartView, UpdatePriceView, ShopStatusView, ShopUpdateView
+    LoginView, LogoutView, TokenRotateView, UserProfileView, ProductSearchView, ShopOrdersView, \
+        ContactView, UserOrdersView, CartView, CartItemsView, CheckoutView, UpdatePriceView, ShopStatusView, ShopUpdateView, \
+        PartnerUpdateView, ImportJobView, ImportJobDetailView, \
+        PartnerExportView, OrderStateView
 
 urlpatterns = [
     path('register/', RegisterBuyerView.as_view(), name='register'),
     path('confirm-email/', ConfirmEmailView.as_view(), name='confirm-email'),
     path('login/', LoginView.as_view(), name='login'),
+    path('logout/', LogoutView.as_view(), name='logout'),
+    path('token/rotate/', TokenRotateView.as_view(), name='token-rotate'),
     path('profile/', UserProfileView.as_view(), name='profile'),
     path('search/', ProductSearchView.as_view(), name='search'),
     path('shop-orders/', ShopOrdersView.as_view(), name='shop-orders'),
+    path('orders/state/', OrderStateView.as_view(), name='order-state'),
     path('contacts/', ContactView.as_view(), name='contacts'),
     path('user-orders/', UserOrdersView.as_view(), name='user-orders'),
     path('cart/', CartView.as_view(), name='cart'),
+    path('cart/items/', CartItemsView.as_view(), name='cart-items'),
+    path('checkout/', CheckoutView.as_view(), name='checkout'),
     path('update-price/', UpdatePriceView.as_view(), name='update-price'),
+    path('partner/update/', PartnerUpdateView.as_view(), name='partner-update'),
+    path('partner/export/', PartnerExportView.as_view(), name='partner-export'),
+    path('partner/imports/', ImportJobView.as_view(), name='import-jobs'),
+    path('partner/imports/<int:pk>/', ImportJobDetailView.as_view(), name='import-job'),
     path('shop-status/', ShopStatusView.as_view(), name='shop-status'),
     path('shop-update/', ShopUpdateView.as_view(), name='shop-update'),
     path('create-shop/', CreateShopView.as_view(), name='create-shop'),
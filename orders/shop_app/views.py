@@ -1,25 +1,49 @@
 import os
+import requests
+from django.conf import settings
 from django.contrib.auth import get_user_model, authenticate
+from django.core.exceptions import ValidationError
+from django.core.validators import URLValidator
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.authtoken.models import Token
+from django.db import transaction
+from django.http import StreamingHttpResponse
+from django.db.models import Prefetch
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
-from orders.settings import EMAIL_HOST_PASSWORD, EMAIL_HOST_USER
-from shop_app.permissions import IsShop
-from .models import Product, Order, OrderItem, ProductInfo, Shop, Contact, ConfirmEmailToken
+from shop_app.permissions import IsShop, IsStaffOrShop
+from shop_app.signals import new_user_registered
+from shop_app.cart import get_cart_storage
+from shop_app.checkout import checkout, CheckoutError, InsufficientStock
+from shop_app.idempotency import idempotent, IDEMPOTENCY_KEY_PARAMETER
+from shop_app.importer import PriceListError
+from shop_app.sources import import_shop_file, import_url
+from shop_app.states import transition_orders, TransitionError
+from shop_app.exporter import EXPORT_FORMATS
+from shop_app.tasks import run_import_job
+from .models import Product, Order, OrderItem, ProductInfo, Shop, Contact, ConfirmEmailToken, ImportJob, ShopOrder, \
+    ProductParameter
+from .pagination import ContactPagination, OrderPagination, ProductPagination, SearchPagination, \
+    ShopOrderPagination
 from .serializers import UserSerializer, ProductSerializer, OrderSerializer, \
-    OrderItemSerializer, ProductInfoSerializer, ShopSerializer, ContactSerializer
+    ShopSerializer, ContactSerializer, ImportJobSerializer, \
+    ProductInfoPriceSerializer, CartItemSerializer, CartItemsDeleteSerializer, ShopOrderSerializer, \
+    OrderHistorySerializer, OrderFilterSerializer, OrderTransitionSerializer
 User = get_user_model()
-from django.core.mail import send_mail
 
-from drf_spectacular.utils import extend_schema
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import extend_schema, OpenApiParameter
 
 class RegisterBuyerView(APIView):
     """
     Регистрация покупателя.
     """
+    permission_classes = [AllowAny]
+
     @extend_schema(
         request=UserSerializer,
         responses={status.HTTP_201_CREATED: UserSerializer},
@@ -28,30 +52,25 @@ class RegisterBuyerView(APIView):
     def post(self, request, format=None):
         """
         Создает нового пользователя с ролью "buyer".
+        Письмо с ключом подтверждения отправляет задача Celery после
+        фиксации транзакции, поэтому ответ не ждет почтовый сервер.
         """
         serializer = UserSerializer(data=request.data)
         if serializer.is_valid():
             user_type = serializer.validated_data.get('type', 'buyer')
-            user = User.objects.create_user(
-                email=serializer.validated_data['email'],
-                username=serializer.validated_data['username'],
-                password=serializer.validated_data['password'],
-                type=user_type
-            )
-            user.save()
-            
-            # Создание ключа подтверждения
-            token = ConfirmEmailToken.objects.create(user=user)
-
-            # Отправка сообщения с ключом подтверждения
-            send_mail(
-                'Подтверждение электронной почты',
-                f'Ваш ключ подтверждения: {token.key}',
-                EMAIL_HOST_USER,
-                [user.email],
-                auth_password=EMAIL_HOST_PASSWORD,
-                fail_silently=False,
-            )
+            with transaction.atomic():
+                user = User.objects.create_user(
+                    email=serializer.validated_data['email'],
+                    username=serializer.validated_data['username'],
+                    password=serializer.validated_data['password'],
+                    type=user_type
+                )
+
+                # Создание ключа подтверждения
+                ConfirmEmailToken.objects.create(user=user)
+
+                # Отправка сообщения с ключом подтверждения
+                transaction.on_commit(lambda: new_user_registered.send(sender=self.__class__, user_id=user.id))
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -100,6 +119,44 @@ class LoginView(APIView):
         else:
             return Response({'error': "Invalid Credentials"}, status=status.HTTP_400_BAD_REQUEST)
 
+class LogoutView(APIView):
+    """
+    Выход из системы.
+    """
+    permission_classes = [IsAuthenticated]
+
+    @extend_schema(
+        request=None,
+        responses={status.HTTP_200_OK: {"message": "string"}},
+        description="Выход из системы"
+    )
+    def post(self, request, format=None):
+        """
+        Удаляет токен доступа текущего пользователя.
+        """
+        Token.objects.filter(user=request.user).delete()
+        return Response({"message": "Logged out"})
+
+class TokenRotateView(APIView):
+    """
+    Смена токена доступа.
+    """
+    permission_classes = [IsAuthenticated]
+
+    @extend_schema(
+        request=None,
+        responses={status.HTTP_200_OK: {"token": "string"}},
+        description="Смена токена доступа"
+    )
+    def post(self, request, format=None):
+        """
+        Заменяет токен доступа текущего пользователя новым.
+        """
+        with transaction.atomic():
+            Token.objects.filter(user=request.user).delete()
+            token = Token.objects.create(user=request.user)
+        return Response({'token': token.key})
+
 class UserProfileView(APIView):
     """
     Профиль пользователя.
@@ -137,80 +194,177 @@ class ProductSearchView(APIView):
     Поиск продуктов.
     """
     @extend_schema(
+        parameters=[OpenApiParameter('query', str), OpenApiParameter('cursor', str),
+                    OpenApiParameter('page_size', int)],
         responses={status.HTTP_200_OK: ProductSerializer(many=True)},
         description="Поиск продуктов"
     )
     def get(self, request, format=None):
         """
         Выполняет поиск продуктов по заданному запросу.
+        Результаты поиска отдаются постранично в порядке релевантности;
+        без запроса каталог отдается постранично по названию.
         """
-        query = request.query_params.get('query', '')
-        products = Product.objects.filter(name__icontains=query)
-        serializer = ProductSerializer(products, many=True)
-        return Response(serializer.data)
+        query = request.query_params.get('query', '').strip()
+        if query:
+            paginator = SearchPagination()
+            page = paginator.paginate_search(query, request)
+        else:
+            paginator = ProductPagination()
+            page = paginator.paginate_queryset(Product.objects.all(), request, view=self)
+        serializer = ProductSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
 
 class CartView(APIView):
     """
-    Корзина пользователя.
+    Корзина пользователя. Строки корзины хранятся в хранилище корзин
+    (Redis) и переносятся в БД отложенно, см. shop_app.cart.
     """
     permission_classes = [IsAuthenticated]
 
     @extend_schema(
-        responses={status.HTTP_200_OK: OrderSerializer},
+        responses={status.HTTP_200_OK: {"items": "array", "total": "number", "delivery_cost": "number"}},
         description="Получение корзины пользователя"
     )
     def get(self, request, format=None):
         """
         Возвращает корзину пользователя.
         """
-        order = Order.objects.filter(user=request.user, state='cart').first()
-        if order:
-            serializer = OrderSerializer(order)
-            return Response(serializer.data)
-        else:
+        lines = get_cart_storage().get(request.user.id)
+        if not lines:
             return Response({"message": "Cart is empty"})
+        product_infos = ProductInfo.objects.filter(id__in=list(lines)).select_related('product', 'shop')
+        items, subtotals, shops = [], {}, {}
+        for product_info in product_infos.order_by('id'):
+            quantity = lines[product_info.id]
+            items.append({
+                "product_info_id": product_info.id,
+                "product": product_info.product.name,
+                "shop": product_info.shop.name,
+                "price": product_info.price,
+                "quantity": quantity,
+            })
+            subtotals[product_info.shop_id] = subtotals.get(product_info.shop_id, 0) + product_info.price * quantity
+            shops[product_info.shop_id] = product_info.shop
+        delivery_cost = sum(shops[shop_id].get_delivery_cost(total) for shop_id, total in subtotals.items())
+        return Response({"items": items, "total": sum(subtotals.values()), "delivery_cost": delivery_cost})
 
     @extend_schema(
-        request={"product_id": "integer", "quantity": "integer"},
+        request=CartItemSerializer,
         responses={status.HTTP_200_OK: {"message": "string"}, status.HTTP_400_BAD_REQUEST: {"error": "string"}},
         description="Добавление продукта в корзину"
     )
     def post(self, request, format=None):
         """
-        Добавляет продукт в корзину пользователя.
-        """
-        product_id = request.data.get('product_id')
-        quantity = request.data.get('quantity', 1)
-        product = Product.objects.filter(id=product_id).first()
-        if product:
-            order = Order.objects.filter(user=request.user, state='cart').first()
-            if not order:
-                order = Order.objects.create(user=request.user, state='cart')
-            OrderItem.objects.create(order=order, product=product, quantity=quantity)
-            return Response({"message": "Product added to cart"})
-        else:
+        Добавляет позицию магазина в корзину пользователя или меняет ее количество.
+        """
+        serializer = CartItemSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        if not ProductInfo.objects.filter(id=serializer.validated_data['product_info_id']).exists():
             return Response({"error": "Product not found"}, status=status.HTTP_400_BAD_REQUEST)
+        get_cart_storage().set(request.user.id, serializer.validated_data['product_info_id'],
+                               serializer.validated_data['quantity'])
+        return Response({"message": "Product added to cart"})
 
     @extend_schema(
-        request={"product_id": "integer"},
+        request={"product_info_id": "integer"},
         responses={status.HTTP_200_OK: {"message": "string"}, status.HTTP_400_BAD_REQUEST: {"error": "string"}},
         description="Удаление продукта из корзины"
     )
     def delete(self, request, format=None):
         """
-        Удаляет продукт из корзины пользователя.
+        Удаляет позицию магазина из корзины пользователя.
         """
-        product_id = request.data.get('product_id')
-        order = Order.objects.filter(user=request.user, state='cart').first()
-        if order:
-            item = OrderItem.objects.filter(order=order, product_id=product_id).first()
-            if item:
-                item.delete()
-                return Response({"message": "Product removed from cart"})
-            else:
-                return Response({"error": "Product not in cart"}, status=status.HTTP_400_BAD_REQUEST)
-        else:
-            return Response({"error": "Cart is empty"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            product_info_id = int(request.data.get('product_info_id'))
+        except (TypeError, ValueError):
+            return Response({"error": "product_info_id is required"}, status=status.HTTP_400_BAD_REQUEST)
+        if get_cart_storage().remove(request.user.id, [product_info_id]):
+            return Response({"message": "Product removed from cart"})
+        return Response({"error": "Product not in cart"}, status=status.HTTP_400_BAD_REQUEST)
+
+class CartItemsView(APIView):
+    """
+    Пакетное изменение корзины.
+    """
+    permission_classes = [IsAuthenticated]
+
+    @extend_schema(
+        request={"items": [{"product_info_id": "integer", "quantity": "integer"}]},
+        parameters=[IDEMPOTENCY_KEY_PARAMETER],
+        responses={status.HTTP_200_OK: {"items": "object"}, status.HTTP_400_BAD_REQUEST: {"error": "string"}},
+        description="Пакетное добавление позиций в корзину"
+    )
+    @idempotent
+    def post(self, request, format=None):
+        """
+        Добавляет список позиций в корзину одной операцией. Количество уже
+        лежащих в корзине позиций увеличивается, повторы в списке суммируются.
+        Если хотя бы одной позиции нет в каталоге, корзина не изменяется.
+        """
+        serializer = CartItemSerializer(data=request.data.get('items', []), many=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        lines = {}
+        for item in serializer.validated_data:
+            lines[item['product_info_id']] = lines.get(item['product_info_id'], 0) + item['quantity']
+        if not lines:
+            return Response({"error": "items is required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        missing = sorted(set(lines) - set(ProductInfo.objects.filter(id__in=list(lines)).values_list('id', flat=True)))
+        if missing:
+            return Response({"error": "Product infos not found", "ids": missing}, status=status.HTTP_400_BAD_REQUEST)
+        quantities = get_cart_storage().increment(request.user.id, lines)
+        return Response({"items": quantities})
+
+    @extend_schema(
+        request=CartItemsDeleteSerializer,
+        responses={status.HTTP_200_OK: {"deleted": "integer"}, status.HTTP_400_BAD_REQUEST: {"error": "string"}},
+        description="Пакетное удаление позиций из корзины"
+    )
+    def delete(self, request, format=None):
+        """
+        Удаляет из корзины список позиций одной операцией.
+        """
+        serializer = CartItemsDeleteSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        deleted = get_cart_storage().remove(request.user.id, sorted(set(serializer.validated_data['items'])))
+        return Response({"deleted": deleted})
+
+class CheckoutView(APIView):
+    """
+    Оформление заказа из корзины.
+    """
+    permission_classes = [IsAuthenticated]
+
+    @extend_schema(
+        request={"contact_id": "integer"},
+        parameters=[IDEMPOTENCY_KEY_PARAMETER],
+        responses={status.HTTP_201_CREATED: {"order_id": "integer", "state": "string"},
+                   status.HTTP_400_BAD_REQUEST: {"error": "string", "items": "array"}},
+        description="Оформление заказа из корзины"
+    )
+    @idempotent
+    def post(self, request, format=None):
+        """
+        Оформляет корзину в новый заказ со списанием остатков. Если каких-то
+        позиций не хватает, заказ не создается, а в ответе возвращается
+        список недостающих позиций.
+        """
+        contact = None
+        if request.data.get('contact_id'):
+            contact = Contact.objects.filter(id=request.data['contact_id'], user=request.user).first()
+            if contact is None:
+                return Response({"error": "Contact not found"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            order = checkout(request.user, contact)
+        except InsufficientStock as e:
+            return Response({"error": str(e), "items": e.items}, status=status.HTTP_400_BAD_REQUEST)
+        except CheckoutError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({"order_id": order.id, "state": order.state}, status=status.HTTP_201_CREATED)
 
 class CreateShopView(APIView):
     permission_classes = [IsAuthenticated, IsShop]
@@ -243,33 +397,160 @@ class UpdatePriceView(APIView):
             "shop_id": "integer",
             "product_infos": [{
                 "id": "integer",
+                "price": "integer",
+                "price_rrc": "integer",
                 "quantity": "integer",
-                "other_field": "string"  # Дополнительные поля сериализатора
             }]
         },
-        responses={status.HTTP_200_OK: {"message": "string"}, status.HTTP_400_BAD_REQUEST: {"error": "string"}},
+        responses={status.HTTP_200_OK: {"message": "string", "updated": "integer"},
+                   status.HTTP_400_BAD_REQUEST: {"error": "string"}},
         description="Обновление цен на товары"
     )
     def put(self, request, format=None):
         """
-        Обновляет информацию о ценах на товары для определенного магазина.
+        Обновляет цены и остатки товаров магазина одной пачкой.
+        Весь список проверяется заранее: если хотя бы одна позиция некорректна
+        или не принадлежит магазину, ничего не изменяется.
         """
-        shop_id = request.data.get('shop_id')
-        product_infos = request.data.get('product_infos', [])
-        shop = Shop.objects.filter(id=shop_id).first()
-        if shop:
-            for product_info_data in product_infos:
-                product_info = ProductInfo.objects.filter(id=product_info_data.get('id')).first()
-                if product_info:
-                    serializer = ProductInfoSerializer(product_info, data=product_info_data)
-                    if serializer.is_valid():
-                        serializer.save()
-                    else:
-                        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-            return Response({"message": "Prices updated"})
-        else:
+        shop = Shop.objects.filter(id=request.data.get('shop_id'), user=request.user).first()
+        if not shop:
+            return Response({"error": "Shop not found"}, status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = ProductInfoPriceSerializer(data=request.data.get('product_infos', []), many=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        changes = {item.pop('id'): item for item in serializer.validated_data}
+
+        fields = sorted({name for item in changes.values() for name in item})
+        with transaction.atomic():
+            # Строки блокируются до записи, чтобы параллельное изменение не потерялось
+            product_infos = ProductInfo.objects.select_for_update().filter(shop=shop).only('id', *fields) \
+                .in_bulk(list(changes))
+            missing = sorted(set(changes) - set(product_infos))
+            if missing:
+                return Response({"error": "Product infos not found in shop", "ids": missing},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+            # Каждая позиция записывается только по своим измененным полям
+            changed = {}
+            for product_info_id, values in changes.items():
+                product_info = product_infos[product_info_id]
+                changed_fields = tuple(sorted(name for name, value in values.items()
+                                              if getattr(product_info, name) != value))
+                if changed_fields:
+                    for name in changed_fields:
+                        setattr(product_info, name, values[name])
+                    changed.setdefault(changed_fields, []).append(product_info)
+            for changed_fields, product_info_list in changed.items():
+                ProductInfo.objects.bulk_update(product_info_list, changed_fields,
+                                                batch_size=settings.IMPORT_BATCH_SIZE)
+        return Response({"message": "Prices updated",
+                         "updated": sum(len(product_info_list) for product_info_list in changed.values())})
+
+class PartnerUpdateView(APIView):
+    permission_classes = [IsAuthenticated, IsShop]
+
+    @extend_schema(
+        request={"url": "string", "mode": "string", "force": "boolean"},
+        responses={status.HTTP_200_OK: {"shop_id": "integer", "items": "integer", "skipped": "boolean"},
+                   status.HTTP_400_BAD_REQUEST: {"error": "string"}},
+        description="Импорт прайс-листа поставщика"
+    )
+    def post(self, request, format=None):
+        """
+        Импортирует прайс-лист в формате YAML по ссылке, а без ссылки - из
+        загруженного файла магазина. Неизменившийся прайс-лист пропускается
+        (skipped), force - импортировать без проверки изменений.
+        Режим "diff" применяет только изменения относительно текущего каталога.
+        """
+        url = request.data.get('url')
+        mode = request.data.get('mode', 'full')
+        force = str(request.data.get('force', '')).lower() in ('1', 'true')
+        try:
+            if url:
+                URLValidator()(url)
+                stats = import_url(url, user=request.user, mode=mode, force=force)
+            else:
+                shop = Shop.objects.filter(user=request.user).exclude(filename='').first()
+                if shop is None:
+                    return Response({"error": "url is required"}, status=status.HTTP_400_BAD_REQUEST)
+                stats = import_shop_file(shop, mode=mode, force=force)
+        except ValidationError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except (requests.RequestException, OSError, PriceListError) as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(stats.as_dict())
+
+class ImportJobView(APIView):
+    permission_classes = [IsAuthenticated, IsShop]
+
+    @extend_schema(
+        responses={status.HTTP_200_OK: ImportJobSerializer(many=True)},
+        description="Список импортов прайс-листов"
+    )
+    def get(self, request, format=None):
+        """
+        Возвращает импорты прайс-листов текущего пользователя.
+        """
+        jobs = ImportJob.objects.filter(user=request.user)
+        serializer = ImportJobSerializer(jobs, many=True)
+        return Response(serializer.data)
+
+    @extend_schema(
+        request=ImportJobSerializer,
+        responses={status.HTTP_202_ACCEPTED: ImportJobSerializer, status.HTTP_400_BAD_REQUEST: {"error": "string"}},
+        description="Постановка импорта прайс-листа в очередь"
+    )
+    def post(self, request, format=None):
+        """
+        Ставит импорт прайс-листа в очередь Celery и сразу возвращает задание.
+        """
+        serializer = ImportJobSerializer(data=request.data)
+        if serializer.is_valid():
+            job = serializer.save(user=request.user, shop=Shop.objects.filter(user=request.user).first())
+            transaction.on_commit(lambda: run_import_job.delay(job.id))
+            return Response(ImportJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+class ImportJobDetailView(APIView):
+    permission_classes = [IsAuthenticated, IsShop]
+
+    @extend_schema(
+        responses={status.HTTP_200_OK: ImportJobSerializer, status.HTTP_404_NOT_FOUND: {"error": "string"}},
+        description="Статус импорта прайс-листа"
+    )
+    def get(self, request, pk, format=None):
+        """
+        Возвращает статус импорта: обработанные позиции, скорость, ошибки и длительность.
+        """
+        job = ImportJob.objects.filter(id=pk, user=request.user).first()
+        if job:
+            return Response(ImportJobSerializer(job).data)
+        return Response({"error": "Import job not found"}, status=status.HTTP_404_NOT_FOUND)
+
+class PartnerExportView(APIView):
+    permission_classes = [IsAuthenticated, IsShop]
+
+    @extend_schema(
+        responses={status.HTTP_200_OK: {"file": "string"}, status.HTTP_400_BAD_REQUEST: {"error": "string"}},
+        description="Экспорт каталога магазина (type=yaml|jsonl|csv)"
+    )
+    def get(self, request, format=None):
+        """
+        Потоково выгружает каталог магазина текущего пользователя.
+        """
+        export_type = request.query_params.get('type', 'yaml')
+        if export_type not in EXPORT_FORMATS:
+            return Response({"error": f"Unknown export type: {export_type}"}, status=status.HTTP_400_BAD_REQUEST)
+        shop = Shop.objects.filter(user=request.user).first()
+        if not shop:
             return Response({"error": "Shop not found"}, status=status.HTTP_400_BAD_REQUEST)
 
+        export, content_type = EXPORT_FORMATS[export_type]
+        response = StreamingHttpResponse(export(shop), content_type=f'{content_type}; charset=utf-8')
+        response['Content-Disposition'] = f'attachment; filename="shop-{shop.id}.{export_type}"'
+        return response
+
 class ShopStatusView(APIView):
     permission_classes = [IsAuthenticated, IsShop]
 
@@ -316,21 +597,79 @@ class ShopOrdersView(APIView):
     permission_classes = [IsAuthenticated, IsShop]
 
     @extend_schema(
-        responses={status.HTTP_200_OK: OrderSerializer(many=True)},
+        parameters=[OpenApiParameter('since', OpenApiTypes.DATETIME), OpenApiParameter('cursor', str),
+                    OpenApiParameter('page_size', int)],
+        responses={status.HTTP_200_OK: ShopOrderSerializer(many=True), status.HTTP_400_BAD_REQUEST: {"error": "string"}},
         description="Получение заказов магазина"
     )
     def get(self, request, format=None):
         """
-        Получает список заказов для магазина текущего пользователя.
+        Получает оформленные заказы (части заказов) магазина текущего пользователя
+        с позициями этого магазина и контактом покупателя, начиная с самых новых.
+        since - только заказы, созданные не раньше указанного времени.
+        Число запросов к БД не зависит от числа заказов и позиций.
+        """
+        shop_id = Shop.objects.filter(user=request.user).values_list('id', flat=True).first()
+        shop_orders = ShopOrder.objects.filter(shop_id=shop_id).exclude(state='basket') \
+            .select_related('order__contact').prefetch_related(
+                Prefetch('order__ordered_items', to_attr='shop_lines', queryset=OrderItem.objects.filter(
+                    product_info__shop_id=shop_id).select_related('product_info__product').prefetch_related(
+                    Prefetch('product_info__product_parameters', to_attr='parameter_list',
+                             queryset=ProductParameter.objects.select_related('parameter'))).order_by('id')))
+        if request.query_params.get('since'):
+            since = parse_datetime(request.query_params['since'])
+            if since is None:
+                return Response({"error": "Invalid since"}, status=status.HTTP_400_BAD_REQUEST)
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+            shop_orders = shop_orders.filter(order__dt__gte=since)
+
+        paginator = ShopOrderPagination()
+        page = paginator.paginate_queryset(shop_orders, request, view=self)
+        serializer = ShopOrderSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+class OrderStateView(APIView):
+    permission_classes = [IsAuthenticated, IsStaffOrShop]
+
+    @extend_schema(
+        request=OrderTransitionSerializer,
+        responses={status.HTTP_200_OK: {"change_id": "integer", "state": "string", "requested": "integer",
+                                        "changed": "integer", "skipped": "array"},
+                   status.HTTP_400_BAD_REQUEST: {"error": "string"}},
+        description="Массовая смена статуса заказов"
+    )
+    def post(self, request, format=None):
         """
-        orders = Order.objects.filter(shop__user=request.user)
-        serializer = OrderSerializer(orders, many=True)
-        return Response(serializer.data)
+        Переводит заказы в новый статус. Администратор меняет статус заказов,
+        магазин - своих частей заказов. Заказы, для которых переход
+        недопустим, пропускаются и возвращаются в skipped.
+        """
+        serializer = OrderTransitionSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        shop = None
+        if not request.user.is_staff:
+            shop = Shop.objects.filter(user=request.user).first()
+            if shop is None:
+                return Response({"error": "Shop not found"}, status=status.HTTP_400_BAD_REQUEST)
+
+        order_ids = serializer.validated_data['order_ids']
+        try:
+            change = transition_orders(order_ids, serializer.validated_data['state'], user=request.user, shop=shop)
+        except TransitionError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        # Магазин меняет свои части заказов, статус самого заказа может остаться прежним
+        changed = change.orders if shop is None else set(
+            ShopOrder.objects.filter(id__in=change.shop_orders).values_list('order_id', flat=True))
+        return Response({"change_id": change.id, "state": change.state, "requested": change.requested,
+                         "changed": len(changed), "skipped": sorted(set(order_ids) - set(changed))})
 
 class ContactView(APIView):
     permission_classes = [IsAuthenticated]
 
     @extend_schema(
+        parameters=[OpenApiParameter('cursor', str), OpenApiParameter('page_size', int)],
         responses={status.HTTP_200_OK: ContactSerializer(many=True)},
         description="Получение контактов пользователя"
     )
@@ -338,9 +677,10 @@ class ContactView(APIView):
         """
         Получает список контактов текущего пользователя.
         """
-        contacts = Contact.objects.filter(user=request.user)
-        serializer = ContactSerializer(contacts, many=True)
-        return Response(serializer.data)
+        paginator = ContactPagination()
+        page = paginator.paginate_queryset(Contact.objects.filter(user=request.user), request, view=self)
+        serializer = ContactSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
 
     @extend_schema(
         request=ContactSerializer,
@@ -362,29 +702,51 @@ class UserOrdersView(APIView):
     permission_classes = [IsAuthenticated]
 
     @extend_schema(
-        responses={status.HTTP_200_OK: OrderSerializer(many=True)},
+        parameters=[OrderFilterSerializer, OpenApiParameter('cursor', str), OpenApiParameter('page_size', int)],
+        responses={status.HTTP_200_OK: OrderHistorySerializer(many=True)},
         description="Получение заказов пользователя"
     )
     def get(self, request, format=None):
         """
-        Получает список заказов пользователя.
+        Получает заказы пользователя с позициями, начиная с самых новых.
+        Корзина в список не входит, если не запрошена явно (state=basket).
+        Фильтры: state, date_from, date_to. Два запроса к БД на страницу.
         """
+        filters = OrderFilterSerializer(data=request.query_params)
+        if not filters.is_valid():
+            return Response(filters.errors, status=status.HTTP_400_BAD_REQUEST)
         orders = Order.objects.filter(user=request.user)
-        serializer = OrderSerializer(orders, many=True)
-        return Response(serializer.data)
+        if 'state' in filters.validated_data:
+            orders = orders.filter(state=filters.validated_data['state'])
+        else:
+            orders = orders.exclude(state='basket')
+        if 'date_from' in filters.validated_data:
+            orders = orders.filter(dt__gte=filters.validated_data['date_from'])
+        if 'date_to' in filters.validated_data:
+            orders = orders.filter(dt__lte=filters.validated_data['date_to'])
+        orders = orders.prefetch_related(Prefetch(
+            'ordered_items', to_attr='item_list',
+            queryset=OrderItem.objects.select_related('product_info__product', 'product_info__shop').order_by('id')))
+
+        paginator = OrderPagination()
+        page = paginator.paginate_queryset(orders, request, view=self)
+        serializer = OrderHistorySerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
 
     @extend_schema(
         request=OrderSerializer,
+        parameters=[IDEMPOTENCY_KEY_PARAMETER],
         responses={status.HTTP_200_OK: OrderSerializer, status.HTTP_400_BAD_REQUEST: {"error": "string"}},
         description="Создание заказа пользователя"
     )
+    @idempotent
     def post(self, request, format=None):
         """
         Создает новый заказ для пользователя.
         """
         serializer = OrderSerializer(data=request.data)
         if serializer.is_valid():
-            serializer.save(user=request.user)
+            serializer.save(user=request.user, state='basket')
             return Response(serializer.data)
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
\ No newline at end of file